@@ -1,15 +1,18 @@
 from torch import nn
+from torch.nn import functional as F
+from .LowRankLinear import LowRankLinear, input_linear, output_linear
 
 
 class Encoder(nn.Module):
-    def __init__(self, input_size, hidden_dimensions, num_classes, latent_activation):
+    def __init__(self, input_size, hidden_dimensions, num_classes, latent_activation, input_rank=None):
         super(Encoder, self).__init__()
 
         dims = [input_size] + hidden_dimensions
 
+        # the first layer also takes sparse inputs, and is factorized through input_rank if that is given
         layers = [
             nn.Sequential(
-                nn.Linear(dims[i], dims[i+1]),
+                input_linear(dims[i], dims[i+1], input_rank) if i == 0 else nn.Linear(dims[i], dims[i+1]),
                 nn.ReLU(),
             )
             for i in range(0, len(dims)-1)
@@ -17,7 +20,8 @@ class Encoder(nn.Module):
 
         self.hidden_layers = nn.ModuleList(layers)
 
-        self.latent = nn.Linear(dims[-1], num_classes)
+        self.latent = input_linear(dims[-1], num_classes, input_rank) if not hidden_dimensions else \
+            nn.Linear(dims[-1], num_classes)
         self.latent_activation = latent_activation
 
     def forward(self, x):
@@ -28,7 +32,7 @@ class Encoder(nn.Module):
 
 
 class Decoder(nn.Module):
-    def __init__(self, input_size, hidden_dimensions, latent_dim, output_activation):
+    def __init__(self, input_size, hidden_dimensions, latent_dim, output_activation, output_rank=None):
         super(Decoder, self).__init__()
 
         dims = [latent_dim] + hidden_dimensions[::-1]
@@ -42,22 +46,58 @@ class Decoder(nn.Module):
 
         self.hidden_layers = nn.ModuleList(layers)
 
-        self.out = nn.Linear(dims[-1], input_size)
+        # factorized through output_rank if that is given
+        self.out = output_linear(dims[-1], input_size, output_rank)
         self.output_activation = output_activation
 
-    def forward(self, z):
+    def logits(self, z, features=None):
+        """Output before the output activation, only of the given output features if features is not None"""
         for layer in self.hidden_layers:
             z = layer(z)
 
-        return self.output_activation(self.out(z))
+        if features is None:
+            return self.out(z)
+
+        # only the rows of the output weight for those features are multiplied
+        out = self.out
+        if isinstance(out, LowRankLinear):
+            z, out = out.down(z), out.up
+
+        return F.linear(z, out.weight[features], out.bias[features])
+
+    def forward(self, z):
+        return self.output_activation(self.logits(z))
+
+    def reconstruction_loss(self, logits, x, sample=None):
+        """
+        Binary cross entropy of each sample's reconstruction, summed over features, from the decoder's logits. With a
+        sigmoid output activation this is fused into one pass that never forms the probabilities, which also keeps it
+        stable in reduced precision.
+
+        With a FeatureSample, logits only hold the sampled features (see logits) and the weighted sum over them
+        estimates the sum over all features.
+        """
+        if sample is not None:
+            x = x[:, sample.indices]
+
+        if isinstance(self.output_activation, nn.Sigmoid):
+            loss = F.binary_cross_entropy_with_logits(logits, x, reduction='none')
+        else:
+            loss = F.binary_cross_entropy(self.output_activation(logits), x, reduction='none')
+
+        if sample is not None:
+            loss = loss * sample.weights
+
+        return loss.sum(dim=1)
 
 
 class Autoencoder(nn.Module):
-    def __init__(self, input_size, hidden_dimensions, latent_dim, latent_activation, output_activation):
+    def __init__(self, input_size, hidden_dimensions, latent_dim, latent_activation, output_activation,
+                 input_rank=None):
         super(Autoencoder, self).__init__()
 
-        self.encoder = Encoder(input_size, hidden_dimensions, latent_dim, latent_activation)
-        self.decoder = Decoder(input_size, hidden_dimensions, latent_dim, output_activation)
+        self.encoder = Encoder(input_size, hidden_dimensions, latent_dim, latent_activation, input_rank)
+        self.decoder = Decoder(input_size, hidden_dimensions, latent_dim, output_activation, input_rank)
 
     def forward(self, x):
         z = self.encoder(x)
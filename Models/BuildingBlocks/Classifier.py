@@ -1,15 +1,17 @@
 from torch import nn
+from .LowRankLinear import input_linear
 
 
 class Classifier(nn.Module):
-    def __init__(self, input_size, hidden_dimensions, num_classes):
+    def __init__(self, input_size, hidden_dimensions, num_classes, input_rank=None):
         super(Classifier, self).__init__()
 
         dims = [input_size] + hidden_dimensions
 
+        # the first layer also takes sparse inputs, and is factorized through input_rank if that is given
         layers = [
             nn.Sequential(
-                nn.Linear(dims[i], dims[i+1]),
+                input_linear(dims[i], dims[i+1], input_rank) if i == 0 else nn.Linear(dims[i], dims[i+1]),
                 nn.ReLU(),
             )
             for i in range(0, len(dims)-1)
@@ -17,7 +19,8 @@ class Classifier(nn.Module):
 
         self.hidden_layers = nn.ModuleList(layers)
 
-        self.out = nn.Linear(dims[-1], num_classes)
+        self.out = input_linear(dims[-1], num_classes, input_rank) if not hidden_dimensions else \
+            nn.Linear(dims[-1], num_classes)
 
     def forward(self, x):
         for layer in self.hidden_layers:
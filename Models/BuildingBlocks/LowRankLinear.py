@@ -0,0 +1,79 @@
+import torch
+from torch import nn
+from .SparseLinear import SparseInputLinear
+
+
+class LowRankLinear(nn.Module):
+    """
+    in_features -> rank -> out_features factorization of an nn.Linear, with rank * (in_features + out_features)
+    weights instead of in_features * out_features. The input side takes sparse inputs like SparseInputLinear.
+    """
+    def __init__(self, in_features, out_features, rank):
+        super(LowRankLinear, self).__init__()
+
+        self.in_features = in_features
+        self.out_features = out_features
+        self.rank = rank
+
+        self.down = SparseInputLinear(in_features, rank, bias=False)
+        self.up = nn.Linear(rank, out_features)
+
+    @property
+    def weight(self):
+        """The equivalent full out_features x in_features weight"""
+        return self.up.weight @ self.down.weight
+
+    @property
+    def bias(self):
+        return self.up.bias
+
+    def forward(self, x):
+        return self.up(self.down(x))
+
+    @classmethod
+    def from_linear(cls, linear, rank):
+        """
+        Compresses a trained nn.Linear by truncated SVD, keeping its rank largest singular values split evenly
+        between the two factors. The result is the best rank-r approximation of the layer's weight.
+        """
+        up, down = truncated_svd(linear.weight, rank)
+
+        layer = cls(linear.in_features, linear.out_features, rank).to(linear.weight.device)
+
+        with torch.no_grad():
+            layer.down.weight.copy_(down)
+            layer.up.weight.copy_(up)
+            layer.up.bias.copy_(linear.bias)
+
+        return layer
+
+
+def truncated_svd(weight, rank):
+    """
+    (left, right) such that left @ right is the best rank-r approximation of weight, with the singular values split
+    evenly between the two factors
+    """
+    u, s, vh = torch.linalg.svd(weight.detach().float(), full_matrices=False)
+    root = s[:rank].sqrt()
+
+    return u[:, :rank] * root, root[:, None] * vh[:rank]
+
+
+def saves_parameters(in_features, out_features, rank):
+    return rank is not None and rank * (in_features + out_features) < in_features * out_features
+
+
+def input_linear(in_features, out_features, rank=None):
+    """First layer of a network: factorized if rank is given and that saves parameters, taking sparse inputs either way"""
+    if not saves_parameters(in_features, out_features, rank):
+        return SparseInputLinear(in_features, out_features)
+
+    return LowRankLinear(in_features, out_features, rank)
+
+
+def output_linear(in_features, out_features, rank=None):
+    """Last layer of a decoder: factorized if rank is given and that saves parameters"""
+    if not saves_parameters(in_features, out_features, rank):
+        return nn.Linear(in_features, out_features)
+
+    return LowRankLinear(in_features, out_features, rank)
@@ -0,0 +1,17 @@
+import torch
+from torch import nn
+
+
+class SparseInputLinear(nn.Linear):
+    """
+    nn.Linear that takes its input as either a dense or a CSR tensor. CSR batches go through a sparse-dense matmul,
+    forward and backward, whose cost scales with the number of non-zeros instead of the full input width. The
+    parameters are those of nn.Linear, so checkpoints are interchangeable.
+    """
+    def forward(self, x):
+        if x.layout != torch.sparse_csr:
+            return super(SparseInputLinear, self).forward(x)
+
+        output = torch.sparse.mm(x, self.weight.t())
+
+        return output if self.bias is None else output + self.bias
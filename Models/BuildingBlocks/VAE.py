@@ -1,17 +1,19 @@
 import torch
 from torch import nn
 from .Autoencoder import Decoder
+from .LowRankLinear import input_linear
 
 
 class VariationalEncoder(nn.Module):
-    def __init__(self, input_size, hidden_dimensions, latent_dim):
+    def __init__(self, input_size, hidden_dimensions, latent_dim, input_rank=None):
         super(VariationalEncoder, self).__init__()
 
         dims = [input_size] + hidden_dimensions
 
+        # the first layer also takes sparse inputs, and is factorized through input_rank if that is given
         layers = [
             nn.Sequential(
-                nn.Linear(dims[i], dims[i+1]),
+                input_linear(dims[i], dims[i+1], input_rank) if i == 0 else nn.Linear(dims[i], dims[i+1]),
                 nn.ReLU(),
             )
             for i in range(0, len(dims)-1)
@@ -19,14 +21,18 @@ class VariationalEncoder(nn.Module):
 
         self.hidden_layers = nn.ModuleList(layers)
 
-        self.mu = nn.Linear(dims[-1], latent_dim)
+        def latent():
+            return input_linear(dims[-1], latent_dim, input_rank) if not hidden_dimensions else \
+                nn.Linear(dims[-1], latent_dim)
+
+        self.mu = latent()
         # ReLU as variance has to be greater than 0
         # TODO: this is not true, check results without
         # self.logvar = nn.Sequential(
         #     nn.Linear(dims[-1], latent_dim),
         #     nn.Softplus(),
         # )
-        self.logvar = nn.Linear(dims[-1], latent_dim)
+        self.logvar = latent()
 
     def encode(self, x):
         for layer in self.hidden_layers:
@@ -46,11 +52,11 @@ class VariationalEncoder(nn.Module):
 
 
 class VAE(nn.Module):
-    def __init__(self, input_size, hidden_dimensions, latent_dim, output_activation):
+    def __init__(self, input_size, hidden_dimensions, latent_dim, output_activation, input_rank=None):
         super(VAE, self).__init__()
 
-        self.encoder = VariationalEncoder(input_size, hidden_dimensions, latent_dim)
-        self.decoder = Decoder(input_size, hidden_dimensions, latent_dim, output_activation)
+        self.encoder = VariationalEncoder(input_size, hidden_dimensions, latent_dim, input_rank)
+        self.decoder = Decoder(input_size, hidden_dimensions, latent_dim, output_activation, input_rank)
 
     def forward(self, x):
         z, mu, logvar = self.encoder(x)
@@ -58,3 +64,9 @@ class VAE(nn.Module):
         out = self.decoder(z)
 
         return out, mu, logvar
+
+    def forward_logits(self, x, features=None):
+        """As forward, but returns the decoder's logits instead of its output, only of features if that is given"""
+        z, mu, logvar = self.encoder(x)
+
+        return self.decoder.logits(z, features), mu, logvar
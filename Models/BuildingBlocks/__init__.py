@@ -1,3 +1,5 @@
+from .SparseLinear import SparseInputLinear
+from .LowRankLinear import LowRankLinear
 from .Classifier import Classifier
 from .Autoencoder import Encoder, Decoder, Autoencoder
 from .VAE import VariationalEncoder, VAE
@@ -3,14 +3,31 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 from itertools import cycle
-from Models.Model import Model
-from utils.trainingutils import EarlyStopping
+from Models.Model import Model, LR, hidden_layer_size
+from Models.BuildingBlocks.LowRankLinear import saves_parameters
+from utils.instrumentation import memory_tracker
+from utils.profiling import profile_classify
+from utils.trainingutils import accuracy, predict, EarlyStopping
+from utils.engine import EarlyStoppingHook
+from utils.sparse import is_sparse, to_dense, cat_rows, split_rows
+from utils.distributed import is_distributed, is_main_process, train_loader
+from utils.tuning import tuned_batch_size
+from utils.storage import UnlabelledDataset
 import pickle
 from sklearn.preprocessing import StandardScaler
 from torch.utils.data import DataLoader, TensorDataset
 from statistics import mean
 
 
+# numbers of hidden layers hyperparameter_loop and tool_hyperparams try, which utils.costmodel also reads
+HIDDEN_LAYERS = range(1, 5)
+
+
+def denoising_cost(num_hidden_layers):
+    """Weights of the reconstruction costs of the input, the hidden layers and the output, in the grid's networks"""
+    return [1000.0, 10.0] + [0.1] * num_hidden_layers
+
+
 def bi(inits, size):
     return nn.Parameter(inits * torch.ones(size))
 
@@ -26,9 +43,14 @@ split_lu = lambda x, batch_size: (labeled(x, batch_size), unlabeled(x, batch_siz
 
 
 class encoders(nn.Module):
-    def __init__(self, shapes, layer_sizes, L, device):
+    def __init__(self, shapes, layer_sizes, L, device, input_rank=None):
         super(encoders, self).__init__()
         self.W = nn.ParameterList([wi(s) for s in shapes])
+        # with input_rank the first weight is factorized into W[0] (input x rank) followed by W0_up (rank x hidden)
+        self.W0_up = None
+        if saves_parameters(shapes[0][0], shapes[0][1], input_rank):
+            self.W[0] = wi((shapes[0][0], input_rank))
+            self.W0_up = wi((input_rank, shapes[0][1]))
         self.beta = nn.ParameterList([bi(0.0, s[1]) for s in shapes])
         self.gamma = nn.Parameter(bi(1.0, layer_sizes[-1]))
         self.batch_norm_clean_labelled = nn.ModuleList([nn.BatchNorm1d(s[1], affine=False) for s in shapes])
@@ -39,17 +61,37 @@ class encoders(nn.Module):
         self.device = device
 
     def forward(self, inputs, noise_std, training, batch_size):
-        h = inputs + noise_std * torch.randn_like(inputs).to(self.device)  # add noise to input
+        # A CSR batch stays sparse through the first matmul of the clean pass and when classifying. The noisy pass
+        # makes it dense, as the noise fills it in, and the clean pass only densifies the unlabelled inputs, which the
+        # decoder denoises and reconstructs.
+        if noise_std > 0:
+            # add noise to input
+            inputs = to_dense(inputs) + noise_std * torch.randn(inputs.size(), device=inputs.device)
+
         d = {}  # to store the pre-activation, activation, mean and variance for each layer
         # The data for labeled and unlabeled examples are stored separately
         d['labeled'] = {'z': {}, 'm': {}, 'v': {}, 'h': {}}
         d['unlabeled'] = {'z': {}, 'm': {}, 'v': {}, 'h': {}}
-        d['labeled']['z'][0], d['unlabeled']['z'][0] = split_lu(h, batch_size)
+
+        labelled_inputs, unlabelled_inputs = split_rows(inputs, batch_size)
+        if training:
+            unlabelled_inputs = to_dense(unlabelled_inputs)
+        d['labeled']['z'][0], d['unlabeled']['z'][0] = labelled_inputs, unlabelled_inputs
+
+        h = inputs
         for l in range(1, self.L+1):
             # print("Layer ", l, ": ", layer_sizes[l-1], " -> ", layer_sizes[l])
 
-            d['labeled']['h'][l-1], d['unlabeled']['h'][l-1] = split_lu(h, batch_size)
-            z_pre = torch.mm(h, self.W[l-1])  # pre-activation
+            if l == 1:
+                d['labeled']['h'][0], d['unlabeled']['h'][0] = labelled_inputs, unlabelled_inputs
+                z_pre = torch.sparse.mm(inputs, self.W[0]) if is_sparse(inputs) else torch.mm(inputs, self.W[0])
+            else:
+                d['labeled']['h'][l-1], d['unlabeled']['h'][l-1] = split_lu(h, batch_size)
+                z_pre = torch.mm(h, self.W[l-1])  # pre-activation
+
+            # networks saved before the factorization existed have no W0_up
+            if l == 1 and getattr(self, 'W0_up', None) is not None:
+                z_pre = torch.mm(z_pre, self.W0_up)
 
             if training:
                 z_pre_l, z_pre_u = split_lu(z_pre, batch_size)  # split labeled and unlabeled examples
@@ -86,10 +128,15 @@ class encoders(nn.Module):
 
 
 class decoders(nn.Module):
-    def __init__(self, shapes, layer_sizes, L):
+    def __init__(self, shapes, layer_sizes, L, input_rank=None):
         super(decoders, self).__init__()
 
         self.V = nn.ParameterList([wi(s[::-1]) for s in shapes])
+        # with input_rank the last weight is factorized into V0_down (hidden x rank) followed by V[0] (rank x input)
+        self.V0_down = None
+        if saves_parameters(shapes[0][0], shapes[0][1], input_rank):
+            self.V0_down = wi((shapes[0][1], input_rank))
+            self.V[0] = wi((input_rank, shapes[0][0]))
 
         self.batch_norm = nn.ModuleList([nn.BatchNorm1d(size, affine=False) for size in layer_sizes])
 
@@ -124,7 +171,9 @@ class decoders(nn.Module):
             if l == self.L:
                 u = unlabeled(y_c, batch_size)
             else:
-                u = torch.mm(z_est[l+1], self.V[l])
+                u = z_est[l+1] if l > 0 or getattr(self, 'V0_down', None) is None else \
+                    torch.mm(z_est[l+1], self.V0_down)
+                u = torch.mm(u, self.V[l])
             u = self.batch_norm[l](u)
             z_est[l] = self.g_gauss(z_c, u, l)
 
@@ -138,12 +187,42 @@ class decoders(nn.Module):
         return z_est_bn
 
 
+class LadderEncoder(nn.Module):
+    """
+    The clean evaluation pass of a Ladder's encoders as a classifier from inputs to logits, sharing the encoders'
+    weights. Its hidden activations go through an nn.ReLU, so guided backpropagation sees them.
+    """
+    def __init__(self, encoders):
+        super(LadderEncoder, self).__init__()
+        self.encoders = encoders
+        self.relu = nn.ReLU()
+
+    def forward(self, x):
+        e = self.encoders
+        h = x
+
+        for l in range(1, e.L+1):
+            z = torch.sparse.mm(h, e.W[0]) if l == 1 and is_sparse(h) else torch.mm(h, e.W[l-1])
+
+            if l == 1 and getattr(e, 'W0_up', None) is not None:
+                z = torch.mm(z, e.W0_up)
+
+            z = e.batch_norm_clean_labelled[l-1](z)
+
+            h = e.gamma * (z + e.beta[l-1]) if l == e.L else self.relu(z + e.beta[l-1])
+
+        return h
+
+
 class Ladder(nn.Module):
-    def __init__(self, shapes, layer_sizes, L, device):
+    def __init__(self, shapes, layer_sizes, L, device, input_rank=None):
         super(Ladder, self).__init__()
 
-        self.encoders = encoders(shapes, layer_sizes, L, device)
-        self.decoders = decoders(shapes, layer_sizes, L)
+        self.encoders = encoders(shapes, layer_sizes, L, device, input_rank)
+        self.decoders = decoders(shapes, layer_sizes, L, input_rank)
+
+    def export_encoder(self):
+        return LadderEncoder(self.encoders)
 
     def forward_encoders(self, inputs, noise_std, train, batch_size):
         return self.encoders.forward(inputs, noise_std, train, batch_size)
@@ -153,13 +232,14 @@ class Ladder(nn.Module):
 
 
 class LadderNetwork(Model):
-    def __init__(self, input_size, hidden_dimensions, num_classes, denoising_cost, lr, device, model_name, state_path):
+    def __init__(self, input_size, hidden_dimensions, num_classes, denoising_cost, lr, device, model_name, state_path,
+                 input_rank=None):
         super(LadderNetwork, self).__init__(device, state_path, model_name)
 
         layer_sizes = [input_size] + hidden_dimensions + [num_classes]
         shapes = list(zip(layer_sizes[:-1], layer_sizes[1:]))
         self.L = len(layer_sizes) - 1
-        self.ladder = Ladder(shapes, layer_sizes, self.L, device).to(device)
+        self.ladder = Ladder(shapes, layer_sizes, self.L, device, input_rank).to(device)
         self.optimizer = torch.optim.Adam(self.ladder.parameters(), lr=lr)
         self.supervised_cost_function = nn.CrossEntropyLoss()
         self.unsupervised_cost_function = nn.MSELoss(reduction='mean')
@@ -170,81 +250,48 @@ class LadderNetwork(Model):
     def accuracy(self, dataloader, batch_size):
         self.ladder.eval()
 
-        correct = 0
-
-        with torch.no_grad():
-            for batch_idx, (data, labels) in enumerate(dataloader):
-                data = data.to(self.device)
-                labels = labels.to(self.device)
-
-                outputs, _ = self.ladder.forward_encoders(data, 0.0, False, batch_size)
-
-                _, predicted = torch.max(F.softmax(outputs, dim=1).data, 1)
-                correct += (predicted == labels).sum().item()
-
-        return correct / len(dataloader.dataset)
+        return accuracy(lambda data: self.ladder.forward_encoders(data, 0.0, False, batch_size)[0], dataloader,
+                        self.device)
 
-    def train_ladder(self, max_epochs, supervised_dataloader, unsupervised_dataloader, validation_dataloader):
-        epochs = []
-        train_losses = []
-        validation_accs = []
-
-        early_stopping = EarlyStopping('{}/{}_inner.pt'.format(self.state_path, self.model_name))
-
-        for epoch in range(max_epochs):
-            if early_stopping.early_stop:
-                break
-
-            train_loss = 0
-            for batch_idx, (labelled_data, unlabelled_data) in enumerate(
-                    zip(cycle(supervised_dataloader), unsupervised_dataloader)):
-                self.ladder.train()
-
-                self.optimizer.zero_grad()
-
-                labelled_images, labels = labelled_data
-                labelled_images = labelled_images.to(self.device)
-                labels = labels.to(self.device)
-
-                unlabelled_images, _ = unlabelled_data
-                unlabelled_images = unlabelled_images.to(self.device)
-
-                inputs = torch.cat((labelled_images, unlabelled_images), 0)
-
-                batch_size = labelled_images.size(0)
-
-                y_c, corr = self.ladder.forward_encoders(inputs, self.noise_std, True, batch_size)
-                y, clean = self.ladder.forward_encoders(inputs, 0.0, True, batch_size)
+    def loss(self, labelled_images, labels, unlabelled_images):
+        inputs = cat_rows(labelled_images, unlabelled_images)
+        batch_size = labelled_images.size(0)
 
-                z_est_bn = self.ladder.forward_decoders(F.softmax(y_c, dim=1), corr, clean, batch_size)
+        y_c, corr = self.ladder.forward_encoders(inputs, self.noise_std, True, batch_size)
+        y, clean = self.ladder.forward_encoders(inputs, 0.0, True, batch_size)
 
-                cost = self.supervised_cost_function.forward(labeled(y_c, batch_size), labels)
+        z_est_bn = self.ladder.forward_decoders(F.softmax(y_c, dim=1), corr, clean, batch_size)
 
-                zs = clean['unlabeled']['z']
+        cost = self.supervised_cost_function.forward(labeled(y_c, batch_size), labels)
 
-                u_cost = 0
-                for l in range(self.L, -1, -1):
-                    u_cost += self.unsupervised_cost_function.forward(z_est_bn[l], zs[l]) * self.denoising_cost[l]
+        zs = clean['unlabeled']['z']
 
-                loss = cost + u_cost
+        u_cost = 0
+        for l in range(self.L, -1, -1):
+            u_cost += self.unsupervised_cost_function.forward(z_est_bn[l], zs[l]) * self.denoising_cost[l]
 
-                loss.backward()
-                self.optimizer.step()
+        return cost + u_cost
 
-                train_loss += loss.item()
+    def prepare_batch(self, batch):
+        (labelled_images, labels), unlabelled_images = batch
 
-            if validation_dataloader is not None:
-                acc = self.accuracy(validation_dataloader, 0)
-                validation_accs.append(acc)
-                early_stopping(1 - acc, self.ladder)
+        return (labelled_images.to(self.device), labels.to(self.device), unlabelled_images.to(self.device)), \
+            labelled_images.size(0) + unlabelled_images.size(0)
 
-            epochs.append(epoch)
-            train_losses.append(train_loss/len(unsupervised_dataloader))
+    def train_ladder(self, max_epochs, supervised_dataloader, unsupervised_dataloader, validation_dataloader):
+        early_stopping = EarlyStopping('{}/{}_inner.pt'.format(self.state_path, self.model_name))
+        hooks = [EarlyStoppingHook(early_stopping, self.ladder, self.instrumentation,
+                                   restore=validation_dataloader is not None)]
 
+        validate = None
         if validation_dataloader is not None:
-            early_stopping.load_checkpoint(self.ladder)
+            validate = lambda: self.accuracy(validation_dataloader, 0)
 
-        return epochs, train_losses, validation_accs
+        epochs, train_losses, validation_accs = self.engine.run(
+            self, 'ladder', self.ladder, self.optimizer, self.prepare_batch, self.loss,
+            lambda: zip(cycle(supervised_dataloader), unsupervised_dataloader), max_epochs, validate, hooks)
+
+        return epochs, [loss/len(unsupervised_dataloader) for loss in train_losses], validation_accs
 
     def train_model(self, max_epochs, dataloaders):
         unsupervised_dataloader, supervised_dataloader, validation_dataloader = dataloaders
@@ -260,7 +307,9 @@ class LadderNetwork(Model):
     def classify(self, data):
         self.ladder.eval()
 
-        return self.forward(data)
+        forward = self.classify_forward()
+
+        return predict(forward, data, self.device)
 
     def forward(self, data):
         y, _ = self.ladder.forward_encoders(data.to(self.device), 0.0, False, 0)
@@ -269,44 +318,49 @@ class LadderNetwork(Model):
 
 
 def hyperparameter_loop(fold, validation_fold, state_path, results_path, dataloaders, input_size,
-                        num_classes, max_epochs, device):
-    hidden_layer_size = min(500, (input_size + num_classes) // 2)
-    hidden_layers = range(1, 5)
+                        num_classes, max_epochs, device, budget=None,
+                        evaluation_schedule=None, instrument=False, profiler=None, engine=None):
+    hidden_size = hidden_layer_size(input_size, num_classes)
     unsupervised, supervised, validation, test = dataloaders
     train_dataloaders = (unsupervised, supervised, validation)
     num_labelled = len(supervised.dataset)
-    lr = 1e-3
 
     best_acc = 0
     best_params = None
 
     logging_list = []
     hyperparameter_file = '{}/{}_{}_{}_hyperparameters.p'.format(results_path, fold, validation_fold, num_labelled)
-    pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
+    if is_main_process():
+        pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
 
-    for h in hidden_layers:
+    timings_file = '{}/{}_{}_{}_timings.jsonl'.format(results_path, fold, validation_fold, num_labelled)
+    if instrument:
+        open(timings_file, 'w').close()
+
+    if budget is not None:
+        budget.start_sweep(len(HIDDEN_LAYERS))
+
+    for h in HIDDEN_LAYERS:
         print('Ladder hidden layers {}'.format(h))
-        logging_list = pickle.load(open(hyperparameter_file, 'rb'))
 
-        denoising_cost = [1000.0, 10.0] + ([0.1] * h)
 
         model_name = '{}_{}_{}_{}'.format(fold, validation_fold, num_labelled, h)
-        model = LadderNetwork(input_size, [hidden_layer_size] * h, num_classes, denoising_cost, lr, device, model_name,
+        model = LadderNetwork(input_size, [hidden_size] * h, num_classes, denoising_cost(h), LR, device, model_name,
                               state_path)
+        model.configure(evaluation_schedule, instrument, profiler, engine)
 
-        epochs, losses, val_accs = model.train_model(max_epochs, train_dataloaders)
-        validation_result = model.test_model(validation)
+        epochs, losses, val_accs, run = model.train_configuration(max_epochs, train_dataloaders, budget, timings_file)
 
-        model_path = '{}/{}.pt'.format(state_path, model_name)
-        torch.save(model.state_dict(), model_path)
+        validation_result = model.test_model(validation)
 
-        params = {'model name': model_name, 'input size': input_size, 'hidden layers': h * [hidden_layer_size],
+        params = {'model name': model_name, 'input size': input_size, 'hidden layers': h * [hidden_size],
                   'num classes': num_classes}
-        logging = {'params': params, 'model name': model_name, 'accuracy': validation_result, 'epochs': epochs,
-                   'losses': losses, 'accuracies': val_accs}
+        logging = dict({'params': params, 'model name': model_name, 'accuracy': validation_result, 'epochs': epochs,
+                        'losses': losses, 'accuracies': val_accs}, **run)
 
         logging_list.append(logging)
-        pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
+        if is_main_process():
+            pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
 
         if validation_result > best_acc:
             best_acc = validation_result
@@ -317,54 +371,60 @@ def hyperparameter_loop(fold, validation_fold, state_path, results_path, dataloa
 
     model_name = best_params['model name']
     hidden_layers = best_params['hidden layers']
-    denoising_cost = [1000.0, 10.0] + ([0.1] * len(hidden_layers))
-    model = LadderNetwork(input_size, hidden_layers, num_classes, denoising_cost, lr, device, model_name, state_path)
+    model = LadderNetwork(input_size, hidden_layers, num_classes, denoising_cost(len(hidden_layers)), LR, device,
+                          model_name, state_path)
     model.load_state_dict(torch.load('{}/{}.pt'.format(state_path, model_name)))
+    if engine is not None:
+        model.engine = engine
     test_acc = model.test_model(test)
-    classify = model.classify(test.dataset.tensors[0])
+    with profile_classify(profiler), memory_tracker.phase('classify'):
+        classify = model.classify(test.dataset.tensors[0])
 
     return model_name, test_acc, classify
 
 
-def tool_hyperparams(train_val_folds, labelled_data, labels, unlabelled_data, output_folder, device):
+def tool_hyperparams(train_val_folds, labelled_data, labels, unlabelled_data, output_folder, device,
+                     profiler=None, unlabelled_storage='float32'):
     input_size = labelled_data.size(1)
     num_classes = labels.unique().size(0)
     state_path = '{}/state'.format(output_folder)
+    # tuned thread counts were measured in one process, data-parallel runs split the cores between the processes
+    batch_size = tuned_batch_size('ladder', input_size, num_classes, threads=not is_distributed())
 
-    hidden_layer_size = min(500, (input_size + num_classes) // 2)
-    hidden_layers = range(1, 5)
-    lr = 1e-3
+    hidden_size = hidden_layer_size(input_size, num_classes)
 
     best_accuracies = [0, 0]
     best_params = None
 
     normalizer = StandardScaler()
-    all_data = torch.tensor(normalizer.fit_transform(torch.cat((labelled_data, unlabelled_data)).numpy())).float()
+    with memory_tracker.phase('normalize'):
+        all_data = torch.tensor(normalizer.fit_transform(torch.cat((labelled_data, unlabelled_data)).numpy())).float()
     labelled_data = all_data[:len(labels)]
 
-    for h in hidden_layers:
+    for h in HIDDEN_LAYERS:
         print('Ladder params {}'.format(h))
 
         model_name = '{}'.format(h)
-        denoising_cost = [1000.0, 10.0] + ([0.1] * h)
-        params = {'model name': model_name, 'input size': input_size, 'hidden layers': h * [hidden_layer_size],
-                  'denoising cost': denoising_cost, 'num classes': num_classes}
+        params = {'model name': model_name, 'input size': input_size, 'hidden layers': h * [hidden_size],
+                  'denoising cost': denoising_cost(h), 'num classes': num_classes}
 
         accuracies = []
 
         for train_ind, val_ind in train_val_folds:
             s_d = TensorDataset(labelled_data[train_ind], labels[train_ind])
 
-            unlabelled_data = torch.cat((all_data[len(labels):], labelled_data[train_ind]))
-            u_d = TensorDataset(unlabelled_data, -1 * torch.ones(unlabelled_data.size(0)))
+            # the unlabelled samples and the fold's labelled training samples, which are the first rows of all_data
+            unlabelled_rows = torch.cat((torch.arange(len(labels), all_data.size(0)), torch.as_tensor(train_ind)))
+            u_d = UnlabelledDataset(all_data, unlabelled_storage, unlabelled_rows)
             v_d = TensorDataset(labelled_data[val_ind], labels[val_ind])
 
-            s_dl = DataLoader(s_d, batch_size=100, shuffle=True)
-            u_dl = DataLoader(u_d, batch_size=100, shuffle=True)
+            s_dl = train_loader(s_d, batch_size)
+            u_dl = train_loader(u_d, batch_size)
             v_dl = DataLoader(v_d, batch_size=v_d.__len__())
 
-            model = LadderNetwork(input_size, [hidden_layer_size] * h, num_classes, denoising_cost, lr,
+            model = LadderNetwork(input_size, [hidden_size] * h, num_classes, denoising_cost(h), LR,
                                   device, model_name, state_path)
+            model.profiler = profiler
             model.train_model(100, (u_dl, s_dl, v_dl))
             validation_result = model.test_model(v_dl)
             print('Validation accuracy: {}'.format(validation_result))
@@ -379,14 +439,16 @@ def tool_hyperparams(train_val_folds, labelled_data, labels, unlabelled_data, ou
             best_params = params
 
     s_d = TensorDataset(labelled_data, labels)
-    unlabelled_data = all_data
-    u_d = TensorDataset(unlabelled_data, -1 * torch.ones(unlabelled_data.size(0)))
+    u_d = UnlabelledDataset(all_data, unlabelled_storage)
 
-    s_dl = DataLoader(s_d, batch_size=100, shuffle=True)
-    u_dl = DataLoader(u_d, batch_size=100, shuffle=True)
+    s_dl = train_loader(s_d, batch_size)
+    u_dl = train_loader(u_d, batch_size)
 
     final_model = LadderNetwork(best_params['input size'], best_params['hidden layers'], best_params['num classes'],
-                                best_params['denoising cost'], lr, device, 'ladder', state_path)
+                                best_params['denoising cost'], LR, device, 'ladder', state_path)
+    final_model.profiler = profiler
     final_model.train_model(100, (u_dl, s_dl, None))
+    # the profiler can't be pickled with the model
+    final_model.profiler = None
 
     return final_model, normalizer, best_accuracies
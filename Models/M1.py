@@ -1,18 +1,29 @@
 import torch
 from torch import nn
-from torch.nn import functional as F
 from Models.BuildingBlocks import VAE, Classifier
-from Models.Model import Model
-from utils.trainingutils import EarlyStopping
+from Models.Model import Model, LR, hidden_layer_size
+from utils.instrumentation import memory_tracker
+from utils.profiling import profile_classify
+from utils.trainingutils import accuracy, evaluation_batches, predict, EarlyStopping
+from utils.engine import EarlyStoppingHook
+from utils.sparse import to_dense
+from utils.subsampling import sample_indices
+from utils.distributed import is_main_process
 import pickle
 
 
+# (VAE hidden layers, classifier hidden layers, latent size) of each configuration hyperparameter_loop trains, which
+# utils.costmodel also reads
+PARAMETER_GRID = [(h_v, h_c, z) for h_v in range(1, 3) for h_c in range(0, 2) for z in [200, 100, 50]]
+CLASSIFIER_HIDDEN_SIZE = 50
+
+
 class M1(Model):
     def __init__(self, input_size, hidden_dimensions_encoder, latent_size, hidden_dimensions_classifier,
-                 num_classes, output_activation, lr, device, model_name, state_path):
+                 num_classes, output_activation, lr, device, model_name, state_path, input_rank=None):
         super(M1, self).__init__(device, state_path, model_name)
 
-        self.VAE = VAE(input_size, hidden_dimensions_encoder, latent_size, output_activation).to(device)
+        self.VAE = VAE(input_size, hidden_dimensions_encoder, latent_size, output_activation, input_rank).to(device)
         self.VAE_optim = torch.optim.Adam(self.VAE.parameters(), lr=lr)
         self.Encoder = self.VAE.encoder
 
@@ -20,9 +31,9 @@ class M1(Model):
         self.Classifier_criterion = nn.CrossEntropyLoss()
         self.Classifier_optim = torch.optim.Adam(self.Classifier.parameters(), lr=lr)
 
-    def VAE_criterion(self, batch_params, x):
+    def VAE_criterion(self, batch_params, x, sample=None):
         # KL divergence between two normal distributions (N(0, 1) and parameterized)
-        recons, mu, logvar = batch_params
+        recons_logits, mu, logvar = batch_params
 
         KLD = 0.5*torch.sum(logvar.exp() + mu.pow(2) - logvar - 1, dim=1)
 
@@ -30,7 +41,7 @@ class M1(Model):
         # recons = F.mse_loss(recons, x, reduction='none').sum(dim=1)
 
         # BCE used as data is normalised
-        recons = F.binary_cross_entropy(recons, x, reduction='none').sum(dim=1)
+        recons = self.VAE.decoder.reconstruction_loss(recons_logits, x, sample)
 
         return (KLD + recons).mean()
 
@@ -38,112 +49,68 @@ class M1(Model):
         self.VAE.eval()
 
         validation_loss = 0
-        with torch.no_grad():
-            for batch_idx, (data, _) in enumerate(dataloader):
-                data = data.to(self.device)
-
-                params = self.VAE(data)
+        with torch.inference_mode():
+            for data, _ in evaluation_batches(dataloader, self.device):
+                params = self.VAE.forward_logits(data)
 
                 loss = self.VAE_criterion(params, data)
 
-                validation_loss += loss.item()
-
-        return validation_loss / len(dataloader)
+                validation_loss += loss * data.size(0)
 
-    def train_VAE(self, max_epochs, train_dataloader, validation_dataloader):
-        early_stopping = EarlyStopping('{}/{}_autoencoder.pt'.format(self.state_path, self.model_name), patience=10)
-
-        for epoch in range(max_epochs):
-            if early_stopping.early_stop:
-                break
+        return validation_loss.item() / len(dataloader.dataset)
 
-            train_loss = 0
-            for batch_idx, (data, _) in enumerate(train_dataloader):
-                self.VAE.train()
+    def vae_loss(self, data):
+        # training may only reconstruct a sample of the features, validation always reconstructs all of them
+        sample = self.engine.sample_features(self.device)
 
-                data = data.to(self.device)
+        # the encoder takes sparse batches, the reconstruction target has to be dense
+        return self.VAE_criterion(self.VAE.forward_logits(data, sample_indices(sample)), to_dense(data), sample)
 
-                self.VAE_optim.zero_grad()
-
-                batch_params = self.VAE(data)
+    def train_VAE(self, max_epochs, train_dataloader, validation_dataloader):
+        early_stopping = EarlyStopping('{}/{}_autoencoder.pt'.format(self.state_path, self.model_name), patience=10)
+        hooks = [EarlyStoppingHook(early_stopping, self.VAE, self.instrumentation, to_loss=lambda loss: loss,
+                                   restore=validation_dataloader is not None)]
 
-                loss = self.VAE_criterion(batch_params, data)
+        validate = None
+        if validation_dataloader is not None:
+            validate = lambda: self.unsupervised_validation_loss(validation_dataloader)
 
-                train_loss += loss.item()
+        self.engine.run(self, 'vae', self.VAE, self.VAE_optim, self.unlabelled_batch, self.vae_loss,
+                        lambda: train_dataloader, max_epochs, validate, hooks)
 
-                loss.backward()
-                self.VAE_optim.step()
+    def classifier_loss(self, data, labels):
+        with torch.no_grad():
+            z, _, _ = self.Encoder(data)
 
-            if validation_dataloader is not None:
-                validation_loss = self.unsupervised_validation_loss(validation_dataloader)
-                early_stopping(validation_loss, self.VAE)
+        pred = self.Classifier(z)
 
-        if validation_dataloader is not None:
-            early_stopping.load_checkpoint(self.VAE)
+        return self.Classifier_criterion(pred, labels)
 
     def train_classifier(self, max_epochs, train_dataloader, validation_dataloader):
-        epochs = []
-        train_losses = []
-        validation_accs = []
-
         early_stopping = EarlyStopping('{}/{}_classifier.pt'.format(self.state_path, self.model_name))
+        hooks = [EarlyStoppingHook(early_stopping, self.Classifier, self.instrumentation,
+                                   restore=validation_dataloader is not None)]
 
-        for epoch in range(max_epochs):
-            if early_stopping.early_stop:
-                break
-
-            train_loss = 0
-            for batch_idx, (data, labels) in enumerate(train_dataloader):
-                self.Classifier.train()
-
-                data = data.to(self.device)
-                labels = labels.to(self.device)
-
-                self.Classifier_optim.zero_grad()
-
-                with torch.no_grad():
-                    z, _, _ = self.Encoder(data)
-
-                pred = self.Classifier(z)
-
-                loss = self.Classifier_criterion(pred, labels)
-
-                loss.backward()
-                self.Classifier_optim.step()
-
-                train_loss += loss.item()
-
-            if validation_dataloader is not None:
-                acc = self.accuracy(validation_dataloader)
-                validation_accs.append(acc)
-
-                early_stopping(1 - acc, self.Classifier)
-
-            epochs.append(epoch)
-            train_losses.append(train_loss / len(train_dataloader))
-
+        validate = None
         if validation_dataloader is not None:
-            early_stopping.load_checkpoint(self.Classifier)
+            validate = lambda: self.accuracy(validation_dataloader)
+
+        epochs, train_losses, validation_accs = self.engine.run(self, 'classifier', self.Classifier,
+                                                                self.Classifier_optim, self.labelled_batch,
+                                                                self.classifier_loss, lambda: train_dataloader,
+                                                                max_epochs, validate, hooks)
 
-        return epochs, train_losses, validation_accs
+        return epochs, [loss/len(train_dataloader) for loss in train_losses], validation_accs
 
     def accuracy(self, dataloader):
         self.Encoder.eval()
         self.Classifier.eval()
 
-        correct = 0
-
-        with torch.no_grad():
-            for batch_idx, (data, labels) in enumerate(dataloader):
-                data = data.to(self.device)
-                labels = labels.to(self.device)
+        return accuracy(self.forward, dataloader, self.device)
 
-                z, _, _ = self.Encoder(data)
-                outputs = self.Classifier(z)
-                _, predicted = torch.max(outputs.data, 1)
-                correct += (predicted == labels).sum().item()
-
-        return correct / len(dataloader.dataset)
+    def training_stages(self):
+        # the VAE and then the classifier, each for up to max_epochs
+        return 2
 
     def train_model(self, max_epochs, dataloaders):
         unsupervised_dataloader, supervised_dataloader, validation_dataloader = dataloaders
@@ -162,7 +129,9 @@ class M1(Model):
         self.Encoder.eval()
         self.Classifier.eval()
 
-        return self.forward(data)
+        forward = self.classify_forward()
+
+        return predict(forward, data, self.device)
 
     def forward(self, data):
         z, _, _ = self.Encoder(data.to(self.device))
@@ -171,14 +140,9 @@ class M1(Model):
 
 
 def hyperparameter_loop(fold, validation_fold, state_path, results_path, dataloaders, input_size,
-                        num_classes, max_epochs, device):
-    hidden_layer_vae_size = min(500, (input_size + num_classes) // 2)
-    hidden_layer_classifier_size = 50
-    hidden_layers_vae = range(1, 3)
-    hidden_layers_classifier = range(0, 2)
-    z_size = [200, 100, 50]
-    param_combinations = [(i, j, k) for i in hidden_layers_vae for j in hidden_layers_classifier for k in z_size]
-    lr = 1e-3
+                        num_classes, max_epochs, device, budget=None,
+                        evaluation_schedule=None, instrument=False, profiler=None, engine=None):
+    hidden_layer_vae_size = hidden_layer_size(input_size, num_classes)
 
     unsupervised, supervised, validation, test = dataloaders
     train_dataloaders = (unsupervised, supervised, validation)
@@ -189,31 +153,39 @@ def hyperparameter_loop(fold, validation_fold, state_path, results_path, dataloa
 
     logging_list = []
     hyperparameter_file = '{}/{}_{}_{}_hyperparameters.p'.format(results_path, fold, validation_fold, num_labelled)
-    pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
+    if is_main_process():
+        pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
+
+    timings_file = '{}/{}_{}_{}_timings.jsonl'.format(results_path, fold, validation_fold, num_labelled)
+    if instrument:
+        open(timings_file, 'w').close()
+
+    if budget is not None:
+        budget.start_sweep(len(PARAMETER_GRID))
 
-    for p in param_combinations:
+    for p in PARAMETER_GRID:
         print('M1 params {}'.format(p))
-        logging_list = pickle.load(open(hyperparameter_file, 'rb'))
 
         h_v, h_c, z = p
 
         model_name = '{}_{}_{}_{}_{}_{}'.format(fold, validation_fold, num_labelled, h_v, h_c, z)
-        model = M1(input_size, h_v * [hidden_layer_vae_size], z, h_c * [hidden_layer_classifier_size], num_classes,
-                   nn.Sigmoid(), lr, device, model_name, state_path)
-        epochs, losses, val_accs = model.train_model(max_epochs, train_dataloaders)
-        validation_result = model.test_model(validation)
+        model = M1(input_size, h_v * [hidden_layer_vae_size], z, h_c * [CLASSIFIER_HIDDEN_SIZE], num_classes,
+                   nn.Sigmoid(), LR, device, model_name, state_path)
+        model.configure(evaluation_schedule, instrument, profiler, engine)
+
+        epochs, losses, val_accs, run = model.train_configuration(max_epochs, train_dataloaders, budget, timings_file)
 
-        model_path = '{}/{}.pt'.format(state_path, model_name)
-        torch.save(model.state_dict(), model_path)
+        validation_result = model.test_model(validation)
 
         params = {'model name': model_name, 'input size': input_size, 'hidden layers vae': h_v * [hidden_layer_vae_size],
-                  'hidden layers classifier': h_c * [hidden_layer_classifier_size], 'latent dim': z,
+                  'hidden layers classifier': h_c * [CLASSIFIER_HIDDEN_SIZE], 'latent dim': z,
                   'num classes': num_classes}
-        logging = {'params': params, 'filepath': model_path, 'accuracy': validation_result, 'epochs': epochs,
-                   'losses': losses, 'accuracies': val_accs}
+        logging = dict({'params': params, 'accuracy': validation_result, 'epochs': epochs,
+                        'losses': losses, 'accuracies': val_accs}, **run)
 
         logging_list.append(logging)
-        pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
+        if is_main_process():
+            pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
 
         if validation_result > best_acc:
             best_acc = validation_result
@@ -226,9 +198,12 @@ def hyperparameter_loop(fold, validation_fold, state_path, results_path, dataloa
     hidden_v = best_params['hidden layers vae']
     hidden_c = best_params['hidden layers classifier']
     latent = best_params['latent dim']
-    model = M1(input_size, hidden_v, latent, hidden_c, num_classes, nn.Sigmoid(), lr, device, model_name, state_path)
+    model = M1(input_size, hidden_v, latent, hidden_c, num_classes, nn.Sigmoid(), LR, device, model_name, state_path)
     model.load_state_dict(torch.load('{}/{}.pt'.format(state_path, model_name)))
+    if engine is not None:
+        model.engine = engine
     test_acc = model.test_model(test)
-    classify = model.classify(test.dataset.tensors[0])
+    with profile_classify(profiler), memory_tracker.phase('classify'):
+        classify = model.classify(test.dataset.tensors[0])
 
     return model_name, test_acc, classify
@@ -5,8 +5,16 @@ from torch.nn import functional as F
 from torch.utils.data import TensorDataset, DataLoader
 from itertools import cycle
 from Models.BuildingBlocks import VariationalEncoder, Decoder, Classifier
-from Models.Model import Model
-from utils.trainingutils import EarlyStopping
+from Models.Model import Model, LR, hidden_layer_size
+from utils.instrumentation import memory_tracker
+from utils.profiling import profile_classify
+from utils.trainingutils import accuracy, predict, EarlyStopping
+from utils.engine import EarlyStoppingHook
+from utils.sparse import to_dense
+from utils.subsampling import sample_indices
+from utils.distributed import is_distributed, is_main_process, train_loader
+from utils.tuning import tuned_batch_size
+from utils.storage import UnlabelledDataset
 from statistics import mean
 from sklearn.preprocessing import MinMaxScaler
 
@@ -15,13 +23,19 @@ from sklearn.preprocessing import MinMaxScaler
 # -----------------------------------------------------------------------
 
 
+# (VAE hidden layers, classifier hidden layers, latent size) of each configuration hyperparameter_loop and
+# tool_hyperparams train, which utils.costmodel also reads
+PARAMETER_GRID = [(h_v, h_c, z) for h_v in range(1, 3) for h_c in range(1, 3) for z in [200, 100, 50]]
+
+
 class VAE_M2(nn.Module):
     def __init__(self, input_size, hidden_dimensions_encoder, hidden_dimensions_decoder, latent_dim, num_classes,
-                 output_activation):
+                 output_activation, input_rank=None):
         super(VAE_M2, self).__init__()
 
-        self.encoder = VariationalEncoder(input_size + num_classes, hidden_dimensions_encoder, latent_dim)
-        self.decoder = Decoder(input_size, hidden_dimensions_decoder, latent_dim + num_classes, output_activation)
+        self.encoder = VariationalEncoder(input_size + num_classes, hidden_dimensions_encoder, latent_dim, input_rank)
+        self.decoder = Decoder(input_size, hidden_dimensions_decoder, latent_dim + num_classes, output_activation,
+                               input_rank)
 
     def forward(self, x, y):
         z, mu, logvar = self.encoder(torch.cat((x, y), dim=1))
@@ -30,15 +44,21 @@ class VAE_M2(nn.Module):
 
         return out, mu, logvar
 
+    def forward_logits(self, x, y, features=None):
+        """As forward, but returns the decoder's logits instead of its output, only of features if that is given"""
+        z, mu, logvar = self.encoder(torch.cat((x, y), dim=1))
+
+        return self.decoder.logits(torch.cat((z, y), dim=1), features), mu, logvar
+
 
 class M2(nn.Module):
     def __init__(self, input_size, hidden_dimensions_VAE, hidden_dimensions_clas, latent_dim, num_classes,
-                 output_activation):
+                 output_activation, input_rank=None):
         super(M2, self).__init__()
 
         self.VAE = VAE_M2(input_size, hidden_dimensions_VAE, hidden_dimensions_VAE, latent_dim, num_classes,
-                          output_activation)
-        self.Classifier = Classifier(input_size, hidden_dimensions_clas, num_classes)
+                          output_activation, input_rank)
+        self.Classifier = Classifier(input_size, hidden_dimensions_clas, num_classes, input_rank)
 
     def classify(self, x):
         return self.Classifier(x)
@@ -46,14 +66,17 @@ class M2(nn.Module):
     def forward(self, x, y):
         return self.VAE(x, y)
 
+    def forward_logits(self, x, y, features=None):
+        return self.VAE.forward_logits(x, y, features)
+
 
 class M2Runner(Model):
     def __init__(self, input_size, hidden_dimensions_VAE, hidden_dimensions_clas, latent_dim, num_classes, activation,
-                 lr, device, model_name, state_path):
+                 lr, device, model_name, state_path, input_rank=None):
         super(M2Runner, self).__init__(device, state_path, model_name)
 
         self.M2 = M2(input_size, hidden_dimensions_VAE, hidden_dimensions_clas, latent_dim,
-                     num_classes, activation).to(device)
+                     num_classes, activation, input_rank).to(device)
         # change this to something more applicable with softmax
         self.optimizer = torch.optim.Adam(self.M2.parameters(), lr=lr)
         self.num_classes = num_classes
@@ -66,12 +89,12 @@ class M2Runner(Model):
 
         return y
 
-    def minus_L(self, x, recons, mu, logvar, y):
+    def minus_L(self, x, recons_logits, mu, logvar, y, sample=None):
         # KL divergence between two normal distributions (N(0, 1) and parameterized)
         KLD = 0.5*torch.sum(logvar.exp() + mu.pow(2) - logvar - 1, dim=1)
 
         # reconstruction error (use BCE because we normalize input data to [0, 1] and sigmoid output)
-        accuracy = -F.binary_cross_entropy(recons, x, reduction='none').sum(dim=1)
+        accuracy = -self.M2.VAE.decoder.reconstruction_loss(recons_logits, x, sample)
         # accuracy = -F.mse_loss(recons, x, reduction='none').sum(dim=1)
 
         # prior over y
@@ -94,7 +117,7 @@ class M2Runner(Model):
 
         return labels
 
-    def minus_U(self, x, pred_y):
+    def minus_U(self, x, pred_y, sample=None):
         # gives probability for each label
         logits = F.softmax(pred_y, dim=1)
 
@@ -102,9 +125,9 @@ class M2Runner(Model):
         y_onehot = self.onehot(y)
         x = x.repeat(self.num_classes, 1)
 
-        recons, mu, logvar = self.M2(x, y_onehot)
+        recons_logits, mu, logvar = self.M2.forward_logits(x, y_onehot, sample_indices(sample))
 
-        minus_L = self.minus_L(x, recons, mu, logvar, y)
+        minus_L = self.minus_L(x, recons_logits, mu, logvar, y, sample)
         minus_L = minus_L.view_as(logits.t()).t()
 
         minus_L = (logits * minus_L).sum(dim=1)
@@ -118,98 +141,81 @@ class M2Runner(Model):
     def H(self, logits):
         return -torch.sum(logits * torch.log(logits + 1e-8), dim=1)
 
-    def elbo(self, x, y=None):
+    def elbo(self, x, y=None, sample=None):
         if y is not None:
-            recons, mu, logvar = self.M2(x, self.onehot(y))
+            recons_logits, mu, logvar = self.M2.forward_logits(x, self.onehot(y), sample_indices(sample))
 
-            return -self.minus_L(x, recons, mu, logvar, y).mean()
+            return -self.minus_L(x, recons_logits, mu, logvar, y, sample).mean()
 
         else:
             pred_y = self.M2.classify(x)
 
-            return -self.minus_U(x, pred_y)
+            return -self.minus_U(x, pred_y, sample)
 
-    def train_m2(self, max_epochs, labelled_loader, unlabelled_loader, validation_loader):
+    def loss(self, labelled_images, labels, unlabelled_images, alpha):
+        labelled_predictions = self.M2.classify(labelled_images)
+        labelled_loss = F.cross_entropy(labelled_predictions, labels)
 
-        if unlabelled_loader is None:
-            alpha = 1
-        else:
-            alpha = 0.1 * len(unlabelled_loader.dataset)/len(labelled_loader.dataset)
-
-        epochs = []
-        train_losses = []
-        validation_accs = []
-
-        early_stopping = EarlyStopping('{}/{}_inner.pt'.format(self.state_path, self.model_name))
-
-        for epoch in range(max_epochs):
-            if early_stopping.early_stop:
-                break
+        # the reconstruction terms may only cover a sample of the features, the same one for the whole step
+        sample = self.engine.sample_features(self.device)
 
-            if unlabelled_loader is not None:
-                data_iterator = zip(cycle(labelled_loader), unlabelled_loader)
-            else:
-                data_iterator = zip(labelled_loader, cycle([None]))
+        # labelled images ELBO
+        L = self.elbo(labelled_images, y=labels, sample=sample)
 
-            train_loss = 0
-            for batch_idx, (labelled_data, unlabelled_data) in enumerate(data_iterator):
-                self.M2.train()
-                self.optimizer.zero_grad()
+        loss = L + alpha*labelled_loss
 
-                labelled_images, labels = labelled_data
-                labelled_images = labelled_images.float().to(self.device)
-                labels = labels.to(self.device)
+        if unlabelled_images is not None:
+            U = self.elbo(unlabelled_images, sample=sample)
 
-                labelled_predictions = self.M2.classify(labelled_images)
-                labelled_loss = F.cross_entropy(labelled_predictions, labels)
+            loss += U
 
-                # labelled images ELBO
-                L = self.elbo(labelled_images, y=labels)
+        return loss
 
-                loss = L + alpha*labelled_loss
+    def prepare_batch(self, batch):
+        labelled_data, unlabelled_data = batch
 
-                if unlabelled_data is not None:
-                    unlabelled_images, _ = unlabelled_data
-                    unlabelled_images = unlabelled_images.float().to(self.device)
+        labelled_images, labels = labelled_data
+        # M2 concatenates the one-hot labels onto its inputs and reconstructs them, so it works on dense batches
+        labelled_images = to_dense(labelled_images).float().to(self.device)
+        labels = labels.to(self.device)
+        num_samples = labelled_images.size(0)
 
-                    U = self.elbo(unlabelled_images)
+        unlabelled_images = None
+        if unlabelled_data is not None:
+            unlabelled_images = to_dense(unlabelled_data).float().to(self.device)
+            num_samples += unlabelled_images.size(0)
 
-                    loss += U
+        return (labelled_images, labels, unlabelled_images), num_samples
 
-                loss.backward()
-                self.optimizer.step()
+    def train_m2(self, max_epochs, labelled_loader, unlabelled_loader, validation_loader):
 
-                train_loss += loss.item()
+        if unlabelled_loader is None:
+            alpha = 1
+        else:
+            alpha = 0.1 * len(unlabelled_loader.dataset)/len(labelled_loader.dataset)
 
-            if validation_loader is not None:
-                acc = self.accuracy(validation_loader)
-                validation_accs.append(acc)
-                early_stopping(1 - acc, self.M2)
+        early_stopping = EarlyStopping('{}/{}_inner.pt'.format(self.state_path, self.model_name))
+        hooks = [EarlyStoppingHook(early_stopping, self.M2, self.instrumentation,
+                                   restore=validation_loader is not None)]
 
-            epochs.append(epoch)
-            train_losses.append(train_loss)
+        if unlabelled_loader is not None:
+            batches = lambda: zip(cycle(labelled_loader), unlabelled_loader)
+        else:
+            batches = lambda: zip(labelled_loader, cycle([None]))
 
+        validate = None
         if validation_loader is not None:
-            early_stopping.load_checkpoint(self.M2)
+            validate = lambda: self.accuracy(validation_loader)
 
-        return epochs, train_losses, validation_accs
+        return self.engine.run(self, 'm2', self.M2, self.optimizer, self.prepare_batch,
+                               lambda labelled_images, labels, unlabelled_images:
+                               self.loss(labelled_images, labels, unlabelled_images, alpha),
+                               batches, max_epochs, validate, hooks)
 
     def accuracy(self, dataloader):
         self.M2.eval()
 
-        correct = 0
-
-        with torch.no_grad():
-            for batch_idx, (data, labels) in enumerate(dataloader):
-                data = data.float().to(self.device)
-                labels = labels.to(self.device)
-
-                outputs = self.M2.classify(data)
-
-                _, predicted = torch.max(F.softmax(outputs, dim=1).data, 1)
-                correct += (predicted == labels).sum().item()
-
-        return correct / len(dataloader.dataset)
+        return accuracy(self.M2.classify, dataloader, self.device)
 
     def train_model(self, max_epochs, dataloaders):
         unsupervised_dataloader, supervised_dataloader, validation_dataloader = dataloaders
@@ -225,20 +231,18 @@ class M2Runner(Model):
     def classify(self, data):
         self.M2.eval()
 
-        return self.forward(data)
+        forward = self.classify_forward()
+
+        return predict(forward, data, self.device)
 
     def forward(self, data):
         return self.M2.classify(data.to(self.device))
 
 
 def hyperparameter_loop(fold, validation_fold, state_path, results_path, dataloaders, input_size,
-                        num_classes, max_epochs, device):
-    hidden_layer_size = min(500, (input_size + num_classes) // 2)
-    hidden_layers_vae = range(1, 3)
-    hidden_layers_classifier = range(1, 3)
-    z_size = [200, 100, 50]
-    param_combinations = [(i, j, k) for i in hidden_layers_vae for j in hidden_layers_classifier for k in z_size]
-    lr = 1e-3
+                        num_classes, max_epochs, device, budget=None,
+                        evaluation_schedule=None, instrument=False, profiler=None, engine=None):
+    hidden_size = hidden_layer_size(input_size, num_classes)
 
     unsupervised, supervised, validation, test = dataloaders
     train_dataloaders = (unsupervised, supervised, validation)
@@ -249,30 +253,38 @@ def hyperparameter_loop(fold, validation_fold, state_path, results_path, dataloa
 
     logging_list = []
     hyperparameter_file = '{}/{}_{}_{}_hyperparameters.p'.format(results_path, fold, validation_fold, num_labelled)
-    pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
+    if is_main_process():
+        pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
+
+    timings_file = '{}/{}_{}_{}_timings.jsonl'.format(results_path, fold, validation_fold, num_labelled)
+    if instrument:
+        open(timings_file, 'w').close()
+
+    if budget is not None:
+        budget.start_sweep(len(PARAMETER_GRID))
 
-    for p in param_combinations:
+    for p in PARAMETER_GRID:
         print('M2 params {}'.format(p))
-        logging_list = pickle.load(open(hyperparameter_file, 'rb'))
 
         h_v, h_c, z = p
 
         model_name = '{}_{}_{}_{}_{}_{}'.format(fold, validation_fold, num_labelled, h_v, h_c, z)
-        model = M2Runner(input_size, [hidden_layer_size] * h_v, [hidden_layer_size] * h_c, z, num_classes,
-                         nn.Sigmoid(), lr, device, model_name, state_path)
-        epochs, losses, val_accs = model.train_model(max_epochs, train_dataloaders)
-        validation_result = model.test_model(validation)
+        model = M2Runner(input_size, [hidden_size] * h_v, [hidden_size] * h_c, z, num_classes,
+                         nn.Sigmoid(), LR, device, model_name, state_path)
+        model.configure(evaluation_schedule, instrument, profiler, engine)
+
+        epochs, losses, val_accs, run = model.train_configuration(max_epochs, train_dataloaders, budget, timings_file)
 
-        model_path = '{}/{}.pt'.format(state_path, model_name)
-        torch.save(model.state_dict(), model_path)
+        validation_result = model.test_model(validation)
 
-        params = {'model name': model_name, 'input size': input_size, 'hidden layers vae': h_v * [hidden_layer_size],
-                  'hidden layers classifier': h_c * [hidden_layer_size], 'latent dim': z, 'num classes': num_classes}
-        logging = {'params': params, 'filepath': model_path, 'accuracy': validation_result, 'epochs': epochs,
-                   'losses': losses, 'accuracies': val_accs}
+        params = {'model name': model_name, 'input size': input_size, 'hidden layers vae': h_v * [hidden_size],
+                  'hidden layers classifier': h_c * [hidden_size], 'latent dim': z, 'num classes': num_classes}
+        logging = dict({'params': params, 'accuracy': validation_result, 'epochs': epochs,
+                        'losses': losses, 'accuracies': val_accs}, **run)
 
         logging_list.append(logging)
-        pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
+        if is_main_process():
+            pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
 
         if validation_result > best_acc:
             best_acc = validation_result
@@ -285,41 +297,44 @@ def hyperparameter_loop(fold, validation_fold, state_path, results_path, dataloa
     hidden_v = best_params['hidden layers vae']
     hidden_c = best_params['hidden layers classifier']
     latent = best_params['latent dim']
-    model = M2Runner(input_size, hidden_v, hidden_c, latent, num_classes, nn.Sigmoid(), lr, device,
+    model = M2Runner(input_size, hidden_v, hidden_c, latent, num_classes, nn.Sigmoid(), LR, device,
                      model_name, state_path)
     model.load_state_dict(torch.load('{}/{}.pt'.format(state_path, model_name)))
+    if engine is not None:
+        model.engine = engine
     test_acc = model.test_model(test)
-    classify = model.classify(test.dataset.tensors[0])
+    with profile_classify(profiler), memory_tracker.phase('classify'):
+        classify = model.classify(test.dataset.tensors[0])
 
     return model_name, test_acc, classify
 
 
-def tool_hyperparams(train_val_folds, labelled_data, labels, unlabelled_data, output_folder, device):
+def tool_hyperparams(train_val_folds, labelled_data, labels, unlabelled_data, output_folder, device,
+                     profiler=None, unlabelled_storage='float32'):
     input_size = labelled_data.size(1)
     num_classes = labels.unique().size(0)
     state_path = '{}/state'.format(output_folder)
+    # tuned thread counts were measured in one process, data-parallel runs split the cores between the processes
+    batch_size = tuned_batch_size('m2', input_size, num_classes, threads=not is_distributed())
 
-    hidden_layer_size = min(500, (input_size + num_classes) // 2)
-    hidden_layers_vae = range(1, 3)
-    hidden_layers_classifier = range(1, 3)
-    z_size = [200, 100, 50]
-    param_combinations = [(i, j, k) for i in hidden_layers_vae for j in hidden_layers_classifier for k in z_size]
-    lr = 1e-3
+    hidden_size = hidden_layer_size(input_size, num_classes)
 
     best_accuracies = [0, 0]
     best_params = None
 
     normalizer = MinMaxScaler()
-    data = torch.tensor(normalizer.fit_transform(torch.cat((labelled_data, unlabelled_data)).numpy())).float()
+    with memory_tracker.phase('normalize'):
+        data = torch.tensor(normalizer.fit_transform(torch.cat((labelled_data, unlabelled_data)).numpy())).float()
     labelled_data = data[:len(labels)]
-    unlabelled_data = data[len(labels):]
+    # the same unlabelled pool for every configuration and fold
+    u_d = UnlabelledDataset(data, unlabelled_storage, torch.arange(len(labels), data.size(0)))
 
-    for p in param_combinations:
+    for p in PARAMETER_GRID:
         print('M2 params {}'.format(p))
         h_v, h_c, z = p
         model_name = '{}_{}_{}'.format(h_v, h_c, z)
-        params = {'model name': model_name, 'input size': input_size, 'hidden layers vae': h_v * [hidden_layer_size],
-                  'hidden layers classifier': h_c * [hidden_layer_size], 'latent dim': z, 'num classes': num_classes}
+        params = {'model name': model_name, 'input size': input_size, 'hidden layers vae': h_v * [hidden_size],
+                  'hidden layers classifier': h_c * [hidden_size], 'latent dim': z, 'num classes': num_classes}
 
         accuracies = []
 
@@ -327,17 +342,14 @@ def tool_hyperparams(train_val_folds, labelled_data, labels, unlabelled_data, ou
             s_d = TensorDataset(labelled_data[train_ind], labels[train_ind])
             v_d = TensorDataset(labelled_data[val_ind], labels[val_ind])
 
-            s_dl = DataLoader(s_d, batch_size=100, shuffle=True)
+            s_dl = train_loader(s_d, batch_size)
             v_dl = DataLoader(v_d, batch_size=v_d.__len__())
 
-            if len(unlabelled_data) == 0:
-                u_dl = None
-            else:
-                u_d = TensorDataset(unlabelled_data, -1 * torch.ones(unlabelled_data.size(0)))
-                u_dl = DataLoader(u_d, batch_size=100, shuffle=True)
+            u_dl = train_loader(u_d, batch_size) if len(u_d) > 0 else None
 
-            model = M2Runner(input_size, [hidden_layer_size] * h_v, [hidden_layer_size] * h_c, z, num_classes,
-                             nn.Sigmoid(), lr, device, model_name, state_path)
+            model = M2Runner(input_size, [hidden_size] * h_v, [hidden_size] * h_c, z, num_classes,
+                             nn.Sigmoid(), LR, device, model_name, state_path)
+            model.profiler = profiler
             model.train_model(100, (u_dl, s_dl, v_dl))
             validation_result = model.test_model(v_dl)
             print('Validation accuracy: {}'.format(validation_result))
@@ -352,16 +364,15 @@ def tool_hyperparams(train_val_folds, labelled_data, labels, unlabelled_data, ou
             best_params = params
 
     s_d = TensorDataset(labelled_data, labels)
-    s_dl = DataLoader(s_d, batch_size=100, shuffle=True)
+    s_dl = train_loader(s_d, batch_size)
 
-    if len(unlabelled_data) == 0:
-        u_dl = None
-    else:
-        u_d = TensorDataset(unlabelled_data, -1 * torch.ones(unlabelled_data.size(0)))
-        u_dl = DataLoader(u_d, batch_size=100, shuffle=True)
+    u_dl = train_loader(u_d, batch_size) if len(u_d) > 0 else None
 
     final_model = M2Runner(best_params['input size'], best_params['hidden layers vae'], best_params['hidden layers classifier'],
-                           best_params['latent dim'], best_params['num classes'], nn.Sigmoid(), lr, device, 'm2', state_path)
+                           best_params['latent dim'], best_params['num classes'], nn.Sigmoid(), LR, device, 'm2', state_path)
+    final_model.profiler = profiler
     final_model.train_model(100, (u_dl, s_dl, None))
+    # the profiler can't be pickled with the model
+    final_model.profiler = None
 
     return final_model, normalizer, best_accuracies
@@ -1,4 +1,17 @@
+import time
 from torch import nn
+from utils.trainingutils import EvaluationSchedule
+from utils.instrumentation import Instrumentation
+from utils.engine import TrainingEngine
+from utils.distributed import save_state
+
+# learning rate of every configuration of the hyperparameter grids
+LR = 1e-3
+
+
+def hidden_layer_size(input_size, num_classes):
+    """Width of the hidden layers of the hyperparameter grids"""
+    return min(500, (input_size + num_classes) // 2)
 
 
 class Model(nn.Module):
@@ -7,6 +20,107 @@ class Model(nn.Module):
         self.device = device
         self.state_path = state_path
         self.model_name = model_name
+        # wall-clock time (time.time()) after which training stops at the end of the current epoch
+        self.deadline = None
+        self.evaluation_schedule = EvaluationSchedule()
+        self.instrumentation = Instrumentation()
+        self.profiler = None
+        self.engine = TrainingEngine()
+        # epochs run by the engine across all training stages, what a time budget measures the cost of an epoch by
+        self.epochs_trained = 0
+
+    def out_of_time(self):
+        return self.deadline is not None and time.time() > self.deadline
+
+    def end_step(self, num_samples):
+        self.instrumentation.step(num_samples)
+
+        if self.profiler is not None:
+            self.profiler.step()
+
+    def labelled_batch(self, batch):
+        data, labels = batch
+
+        return (data.to(self.device), labels.to(self.device)), data.size(0)
+
+    def unlabelled_batch(self, data):
+        # unlabelled datasets (utils.storage) have no labels, their batches are the data alone
+        return (data.to(self.device),), data.size(0)
+
+    def configure(self, evaluation_schedule=None, instrument=False, profiler=None, engine=None):
+        """Applies the options a hyperparameter sweep shares between its configurations"""
+        if evaluation_schedule is not None:
+            self.evaluation_schedule = evaluation_schedule
+        if instrument:
+            self.instrumentation = Instrumentation(enabled=True)
+        self.profiler = profiler
+        if engine is not None:
+            self.engine = engine
+
+    def train_configuration(self, max_epochs, dataloaders, budget=None, timings_file=None):
+        """
+        Trains the model as one configuration of a hyperparameter sweep, within its share of budget if one is given,
+        appends its timings to timings_file and saves its state to the state path.
+
+        Returns:
+            (list, list, list, dict): The results of train_model, and the file the state was saved to, the epoch cap
+            and the seconds per epoch for the sweep's log
+        """
+        epoch_cap = max_epochs
+        if budget is not None:
+            epoch_cap, self.deadline = budget.start_configuration(max_epochs, self.training_stages())
+            print('Epoch cap {} per stage ({} seconds per epoch measured)'.format(epoch_cap, budget.seconds_per_epoch))
+
+        start_time = time.time()
+        epochs, losses, validation_scores = self.train_model(epoch_cap, dataloaders)
+        train_time = time.time() - start_time
+
+        if budget is not None:
+            budget.record(self.epochs_trained, train_time)
+
+        if timings_file is not None:
+            self.instrumentation.dump(timings_file, model_name=self.model_name)
+
+        model_path = '{}/{}.pt'.format(self.state_path, self.model_name)
+        save_state(self.state_dict(), model_path)
+
+        return epochs, losses, validation_scores, {'filepath': model_path, 'epoch cap': epoch_cap,
+                                                   'seconds per epoch': train_time / max(self.epochs_trained, 1)}
+
+    def classify_forward(self):
+        """
+        forward compiled by the engine for classification. It is built on the first call and reused by the following
+        ones, so the compiled graph, or the fallback to eager mode, carries over between classify calls.
+        """
+        cached = getattr(self, '_classify_forward', None)
+
+        if cached is None or cached[0] is not self.engine:
+            cached = (self.engine, self.engine.compile(self.forward, '{} classify'.format(self.model_name)))
+            self._classify_forward = cached
+
+        return cached[1]
+
+    def __getstate__(self):
+        # compiled functions don't pickle, a loaded model compiles its own
+        state = self.__dict__.copy()
+        state.pop('_classify_forward', None)
+
+        return state
+
+    def __setstate__(self, state):
+        super(Model, self).__setstate__(state)
+
+        # models pickled before these attributes existed get the defaults of __init__
+        defaults = {'deadline': None, 'evaluation_schedule': EvaluationSchedule, 'instrumentation': Instrumentation,
+                    'profiler': None, 'engine': TrainingEngine, 'epochs_trained': 0}
+
+        for name, default in defaults.items():
+            if name not in self.__dict__:
+                setattr(self, name, default() if callable(default) else default)
+
+    def training_stages(self):
+        """Number of stages of train_model that each train for up to its max_epochs"""
+        return 1
 
     def train_model(self,  max_epochs, dataloaders):
         raise NotImplementedError
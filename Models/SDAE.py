@@ -1,18 +1,29 @@
 import torch
 from torch import nn
-from utils.trainingutils import accuracy
+from utils.trainingutils import accuracy, predict
 from Models.BuildingBlocks import Encoder, Decoder
-from Models.Model import Model
+from Models.Model import Model, LR, hidden_layer_size
+from utils.instrumentation import memory_tracker
+from utils.profiling import profile_classify
 from utils.trainingutils import EarlyStopping
+from utils.engine import EarlyStoppingHook
+from utils.sparse import to_dense
+from utils.distributed import is_main_process
 import pickle
 
 
+# numbers of hidden layers hyperparameter_loop tries, which utils.costmodel also reads
+HIDDEN_LAYERS = range(1, 5)
+
+
 class AutoencoderSDAE(nn.Module):
     def __init__(self, encoder):
         super(AutoencoderSDAE, self).__init__()
 
         self.encoder = encoder
-        self.decoder = Decoder(encoder.latent.in_features, [], encoder.latent.out_features, lambda x: x)
+        # a factorized encoder layer gets a decoder factorized to the same rank
+        self.decoder = Decoder(encoder.latent.in_features, [], encoder.latent.out_features, lambda x: x,
+                               getattr(encoder.latent, 'rank', None))
 
     def forward(self, x):
         z = self.encoder(x)
@@ -22,12 +33,12 @@ class AutoencoderSDAE(nn.Module):
 
 
 class SDAEClassifier(nn.Module):
-    def __init__(self, input_size, hidden_dimensions, num_classes):
+    def __init__(self, input_size, hidden_dimensions, num_classes, input_rank=None):
         super(SDAEClassifier, self).__init__()
 
         dims = [input_size] + hidden_dimensions
 
-        layers = [Encoder(dims[i], [], dims[i+1], nn.ReLU())
+        layers = [Encoder(dims[i], [], dims[i+1], nn.ReLU(), input_rank if i == 0 else None)
                   for i in range(0, len(dims)-1)]
 
         self.hidden_layers = nn.ModuleList(layers)
@@ -41,14 +52,29 @@ class SDAEClassifier(nn.Module):
 
 
 class SDAE(Model):
-    def __init__(self, input_size, hidden_dimensions, num_classes, lr, device, model_name, state_path):
+    def __init__(self, input_size, hidden_dimensions, num_classes, lr, device, model_name, state_path,
+                 pretraining_epochs=50, input_rank=None):
         super(SDAE, self).__init__(device, state_path, model_name)
 
-        self.SDAEClassifier = SDAEClassifier(input_size, hidden_dimensions, num_classes).to(device)
+        self.SDAEClassifier = SDAEClassifier(input_size, hidden_dimensions, num_classes, input_rank).to(device)
         self.optimizer = torch.optim.Adam(self.SDAEClassifier.parameters(), lr=lr)
         self.criterion = nn.CrossEntropyLoss()
+        self.pretraining_epochs = pretraining_epochs
+
+    def pretraining_loss(self, dae, criterion, previous_layers, data):
+        with torch.no_grad():
+            for layer in previous_layers:
+                data = layer(data)
+
+        # only the first layer takes sparse batches, and noise makes them dense anyway
+        data = to_dense(data)
+        noisy_data = data.add(0.3 * torch.randn_like(data).to(self.device))
 
-    def pretrain_hidden_layers(self, pretraining_dataloader):
+        predictions = dae(noisy_data)
+
+        return criterion(predictions, data)
+
+    def pretrain_hidden_layers(self, pretraining_dataloader, max_epochs):
         for i in range(len(self.SDAEClassifier.hidden_layers)):
             dae = AutoencoderSDAE(self.SDAEClassifier.hidden_layers[i]).to(self.device)
             criterion = nn.MSELoss()
@@ -56,72 +82,36 @@ class SDAE(Model):
 
             previous_layers = self.SDAEClassifier.hidden_layers[0:i]
 
-            for epoch in range(50):
-                for batch_idx, (data, _) in enumerate(pretraining_dataloader):
-                    dae.train()
-                    data = data.to(self.device)
-
-                    with torch.no_grad():
-                        for layer in previous_layers:
-                            data = layer(data)
-
-                    noisy_data = data.add(0.3 * torch.randn_like(data).to(self.device))
+            self.engine.run(self, 'pretrain layer {}'.format(i), dae, optimizer, self.unlabelled_batch,
+                            lambda data: self.pretraining_loss(dae, criterion, previous_layers, data),
+                            lambda: pretraining_dataloader, min(self.pretraining_epochs, max_epochs))
 
-                    optimizer.zero_grad()
-
-                    predictions = dae(noisy_data)
-
-                    loss = criterion(predictions, data)
-
-                    loss.backward()
-                    optimizer.step()
+    def classifier_loss(self, data, labels):
+        return self.criterion(self.SDAEClassifier(data), labels)
 
     def train_classifier(self, max_epochs, train_dataloader, validation_dataloader):
-        epochs = []
-        train_losses = []
-        validation_accs = []
-
         early_stopping = EarlyStopping('{}/{}_inner.pt'.format(self.state_path, self.model_name))
+        hooks = [EarlyStoppingHook(early_stopping, self.SDAEClassifier, self.instrumentation)]
 
-        for epoch in range(max_epochs):
-            if early_stopping.early_stop:
-                break
-
-            train_loss = 0
-            for batch_idx, (data, labels) in enumerate(train_dataloader):
-                self.SDAEClassifier.train()
-
-                data = data.to(self.device)
-                labels = labels.to(self.device)
-
-                self.optimizer.zero_grad()
+        validate = None
+        if validation_dataloader is not None:
+            validate = lambda: accuracy(self.SDAEClassifier, validation_dataloader, self.device)
 
-                predictions = self.SDAEClassifier(data)
+        epochs, train_losses, validation_accs = self.engine.run(self, 'classifier', self.SDAEClassifier,
+                                                                self.optimizer, self.labelled_batch,
+                                                                self.classifier_loss, lambda: train_dataloader,
+                                                                max_epochs, validate, hooks)
 
-                loss = self.criterion(predictions, labels)
+        return epochs, [loss/len(train_dataloader) for loss in train_losses], validation_accs
 
-                loss.backward()
-                self.optimizer.step()
-
-                train_loss += loss.item()
-
-            if validation_dataloader is not None:
-                acc = accuracy(self.SDAEClassifier, validation_dataloader, self.device)
-                validation_accs.append(acc)
-
-                early_stopping(1 - acc, self.SDAEClassifier)
-
-            epochs.append(epoch)
-            train_losses.append(train_loss/len(train_dataloader))
-
-        early_stopping.load_checkpoint(self.SDAEClassifier)
-
-        return epochs, train_losses, validation_accs
+    def training_stages(self):
+        # pretraining each hidden layer, for up to pretraining_epochs, and then the classifier
+        return len(self.SDAEClassifier.hidden_layers) + 1
 
     def train_model(self, max_epochs, dataloaders):
         unsupervised_dataloader, supervised_dataloader, validation_dataloader = dataloaders
 
-        self.pretrain_hidden_layers(unsupervised_dataloader)
+        self.pretrain_hidden_layers(unsupervised_dataloader, max_epochs)
 
         classifier_epochs, classifier_train_losses, classifier_validation_accs = \
             self.train_classifier(max_epochs, supervised_dataloader, validation_dataloader)
@@ -134,47 +124,56 @@ class SDAE(Model):
     def classify(self, data):
         self.SDAEClassifier.eval()
 
-        return self.forward(data)
+        forward = self.classify_forward()
+
+        return predict(forward, data, self.device)
 
     def forward(self, data):
         return self.SDAEClassifier(data.to(self.device))
 
 
 def hyperparameter_loop(fold, validation_fold, state_path, results_path, dataloaders, input_size,
-                        num_classes, max_epochs, device):
-    hidden_layer_size = min(500, (input_size + num_classes) // 2)
-    hidden_layers = range(1, 5)
+                        num_classes, max_epochs, device, budget=None,
+                        evaluation_schedule=None, instrument=False, profiler=None, engine=None):
+    hidden_size = hidden_layer_size(input_size, num_classes)
     unsupervised, supervised, validation, test = dataloaders
     train_dataloaders = (unsupervised, supervised, validation)
     num_labelled = len(supervised.dataset)
-    lr = 1e-3
 
     best_acc = 0
     best_params = None
 
     logging_list = []
     hyperparameter_file = '{}/{}_{}_{}_hyperparameters.p'.format(results_path, fold, validation_fold, num_labelled)
-    pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
+    if is_main_process():
+        pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
+
+    timings_file = '{}/{}_{}_{}_timings.jsonl'.format(results_path, fold, validation_fold, num_labelled)
+    if instrument:
+        open(timings_file, 'w').close()
 
-    for h in hidden_layers:
+    if budget is not None:
+        budget.start_sweep(len(HIDDEN_LAYERS))
+
+    for h in HIDDEN_LAYERS:
         print('SDAE hidden layers {}'.format(h))
-        logging_list = pickle.load(open(hyperparameter_file, 'rb'))
 
         model_name = '{}_{}_{}_{}'.format(fold, validation_fold, num_labelled, h)
-        model = SDAE(input_size, [hidden_layer_size] * h, num_classes, lr, device, model_name, state_path)
-        epochs, losses, val_accs = model.train_model(max_epochs, train_dataloaders)
-        validation_result = model.test_model(validation)
+        model = SDAE(input_size, [hidden_size] * h, num_classes, LR, device, model_name, state_path)
+        model.configure(evaluation_schedule, instrument, profiler, engine)
 
-        model_path = '{}/{}.pt'.format(state_path, model_name)
-        torch.save(model.state_dict(), model_path)
+        epochs, losses, val_accs, run = model.train_configuration(max_epochs, train_dataloaders, budget, timings_file)
 
-        params = {'model name': model_name, 'input size': input_size, 'hidden layers': h * [hidden_layer_size],
+        validation_result = model.test_model(validation)
+
+        params = {'model name': model_name, 'input size': input_size, 'hidden layers': h * [hidden_size],
                   'num classes': num_classes}
-        logging = {'params': params, 'filepath': model_path, 'accuracy': validation_result, 'epochs': epochs,
-                   'losses': losses, 'accuracies': val_accs}
+        logging = dict({'params': params, 'accuracy': validation_result, 'epochs': epochs,
+                        'losses': losses, 'accuracies': val_accs}, **run)
 
         logging_list.append(logging)
-        pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
+        if is_main_process():
+            pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
 
         if validation_result > best_acc:
             best_acc = validation_result
@@ -184,9 +183,12 @@ def hyperparameter_loop(fold, validation_fold, state_path, results_path, dataloa
             torch.cuda.empty_cache()
 
     model_name = best_params['model name']
-    model = SDAE(input_size, best_params['hidden layers'], num_classes, lr, device, model_name, state_path)
+    model = SDAE(input_size, best_params['hidden layers'], num_classes, LR, device, model_name, state_path)
     model.load_state_dict(torch.load('{}/{}.pt'.format(state_path, model_name)))
+    if engine is not None:
+        model.engine = engine
     test_acc = model.test_model(test)
-    classify = model.classify(test.dataset.tensors[0])
+    with profile_classify(profiler), memory_tracker.phase('classify'):
+        classify = model.classify(test.dataset.tensors[0])
 
     return model_name, test_acc, classify
@@ -1,64 +1,48 @@
 import torch
 from torch import nn
 from Models.BuildingBlocks import Classifier
-from Models.Model import Model
-from utils.trainingutils import accuracy, EarlyStopping
+from Models.Model import Model, LR, hidden_layer_size
+from utils.instrumentation import memory_tracker
+from utils.profiling import profile_classify
+from utils.trainingutils import accuracy, predict, EarlyStopping
+from utils.engine import EarlyStoppingHook
+from utils.distributed import is_main_process
 import pickle
 
 
+# numbers of hidden layers hyperparameter_loop tries, which utils.costmodel also reads
+HIDDEN_LAYERS = range(1, 5)
+
+
 class SimpleNetwork(Model):
-    def __init__(self, input_size, hidden_dimensions, num_classes, lr, device, model_name, state_path):
+    def __init__(self, input_size, hidden_dimensions, num_classes, lr, device, model_name, state_path,
+                 input_rank=None):
         super(SimpleNetwork, self).__init__(device, state_path, model_name)
 
-        self.Classifier = Classifier(input_size, hidden_dimensions, num_classes).to(device)
+        self.Classifier = Classifier(input_size, hidden_dimensions, num_classes, input_rank).to(device)
         self.optimizer = torch.optim.Adam(self.Classifier.parameters(), lr=lr)
         self.criterion = nn.CrossEntropyLoss()
 
         self.state_path = state_path
         self.model_name = model_name
 
-    def train_classifier(self, max_epochs, train_dataloader, validation_dataloader):
-        epochs = []
-        train_losses = []
-        validation_accs = []
+    def classifier_loss(self, data, labels):
+        return self.criterion(self.Classifier(data), labels)
 
+    def train_classifier(self, max_epochs, train_dataloader, validation_dataloader):
         early_stopping = EarlyStopping('{}/{}_inner.pt'.format(self.state_path, self.model_name))
+        hooks = [EarlyStoppingHook(early_stopping, self.Classifier, self.instrumentation,
+                                   restore=validation_dataloader is not None)]
 
-        for epoch in range(max_epochs):
-            if early_stopping.early_stop:
-                break
-
-            train_loss = 0
-            for batch_idx, (data, labels) in enumerate(train_dataloader):
-                self.Classifier.train()
-
-                data = data.to(self.device)
-                labels = labels.to(self.device)
-
-                self.optimizer.zero_grad()
-
-                preds = self.Classifier(data)
-
-                loss = self.criterion(preds, labels)
-
-                loss.backward()
-                self.optimizer.step()
-
-                train_loss += loss.item()
-
-            if validation_dataloader is not None:
-                acc = accuracy(self.Classifier, validation_dataloader, self.device)
-                validation_accs.append(acc)
-
-                early_stopping(1 - acc, self.Classifier)
-
-            epochs.append(epoch)
-            train_losses.append(train_loss/len(train_dataloader))
-
+        validate = None
         if validation_dataloader is not None:
-            early_stopping.load_checkpoint(self.Classifier)
+            validate = lambda: accuracy(self.Classifier, validation_dataloader, self.device)
 
-        return epochs, train_losses, validation_accs
+        epochs, train_losses, validation_accs = self.engine.run(self, 'classifier', self.Classifier, self.optimizer,
+                                                                self.labelled_batch, self.classifier_loss,
+                                                                lambda: train_dataloader, max_epochs, validate, hooks)
+
+        return epochs, [loss/len(train_dataloader) for loss in train_losses], validation_accs
 
     def train_model(self, max_epochs, dataloaders):
         _, supervised_dataloader, validation_dataloader = dataloaders
@@ -74,47 +58,56 @@ class SimpleNetwork(Model):
     def classify(self, data):
         self.Classifier.eval()
 
-        return self.forward(data)
+        forward = self.classify_forward()
+
+        return predict(forward, data, self.device)
 
     def forward(self, data):
         return self.Classifier(data.to(self.device))
 
 
 def hyperparameter_loop(fold, validation_fold, state_path, results_path, dataloaders, input_size,
-                        num_classes, max_epochs, device):
-    hidden_layer_size = min(500, (input_size + num_classes) // 2)
-    hidden_layers = range(1, 5)
+                        num_classes, max_epochs, device, budget=None,
+                        evaluation_schedule=None, instrument=False, profiler=None, engine=None):
+    hidden_size = hidden_layer_size(input_size, num_classes)
     unsupervised, supervised, validation, test = dataloaders
     train_dataloaders = (unsupervised, supervised, validation)
     num_labelled = len(supervised.dataset)
-    lr = 1e-3
 
     best_acc = 0
     best_params = None
 
     logging_list = []
     hyperparameter_file = '{}/{}_{}_{}_hyperparameters.p'.format(results_path, fold, validation_fold, num_labelled)
-    pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
+    if is_main_process():
+        pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
 
-    for h in hidden_layers:
+    timings_file = '{}/{}_{}_{}_timings.jsonl'.format(results_path, fold, validation_fold, num_labelled)
+    if instrument:
+        open(timings_file, 'w').close()
+
+    if budget is not None:
+        budget.start_sweep(len(HIDDEN_LAYERS))
+
+    for h in HIDDEN_LAYERS:
         print('Simple hidden layers {}'.format(h))
-        logging_list = pickle.load(open(hyperparameter_file, 'rb'))
 
         model_name = '{}_{}_{}_{}'.format(fold, validation_fold, num_labelled, h)
-        model = SimpleNetwork(input_size, [hidden_layer_size] * h, num_classes, lr, device, model_name, state_path)
-        epochs, losses, val_accs = model.train_model(max_epochs, train_dataloaders)
-        validation_result = model.test_model(validation)
+        model = SimpleNetwork(input_size, [hidden_size] * h, num_classes, LR, device, model_name, state_path)
+        model.configure(evaluation_schedule, instrument, profiler, engine)
 
-        model_path = '{}/{}.pt'.format(state_path, model_name)
-        torch.save(model.state_dict(), model_path)
+        epochs, losses, val_accs, run = model.train_configuration(max_epochs, train_dataloaders, budget, timings_file)
 
-        params = {'model name': model_name, 'input size': input_size, 'hidden layers': h * [hidden_layer_size],
+        validation_result = model.test_model(validation)
+
+        params = {'model name': model_name, 'input size': input_size, 'hidden layers': h * [hidden_size],
                   'num classes': num_classes}
-        logging = {'params': params, 'filepath': model_path, 'accuracy': validation_result, 'epochs': epochs,
-                   'losses': losses, 'accuracies': val_accs}
+        logging = dict({'params': params, 'accuracy': validation_result, 'epochs': epochs,
+                        'losses': losses, 'accuracies': val_accs}, **run)
 
         logging_list.append(logging)
-        pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
+        if is_main_process():
+            pickle.dump(logging_list, open(hyperparameter_file, 'wb'))
 
         if validation_result > best_acc:
             best_acc = validation_result
@@ -124,9 +117,12 @@ def hyperparameter_loop(fold, validation_fold, state_path, results_path, dataloa
             torch.cuda.empty_cache()
 
     model_name = best_params['model name']
-    model = SimpleNetwork(input_size, best_params['hidden layers'], num_classes, lr, device, model_name, state_path)
+    model = SimpleNetwork(input_size, best_params['hidden layers'], num_classes, LR, device, model_name, state_path)
     model.load_state_dict(torch.load('{}/{}.pt'.format(state_path, model_name)))
+    if engine is not None:
+        model.engine = engine
     test_acc = model.test_model(test)
-    classify = model.classify(test.dataset.tensors[0])
+    with profile_classify(profiler), memory_tracker.phase('classify'):
+        classify = model.classify(test.dataset.tensors[0])
 
     return model_name, test_acc, classify
@@ -1,2 +1,5 @@
 from .vanilla import VanillaSaliency
 from .guided_backprop import GuidedSaliency
+from .integrated_gradients import IntegratedGradients
+from .smoothgrad import SmoothGrad
+from .aggregation import CohortStatistics
@@ -0,0 +1,73 @@
+import numpy as np
+import torch
+
+
+class CohortStatistics(object):
+    """
+    Running per-class statistics of saliency maps over a cohort, in memory independent of the number of samples:
+    the mean and mean absolute saliency of each feature, and how often each feature is among the top_k features of a
+    sample by absolute saliency.
+    """
+    def __init__(self, num_classes, num_features, top_k=100):
+        self.top_k = min(top_k, num_features)
+        self.counts = torch.zeros(num_classes, dtype=torch.long)
+        # float64 sums, so that adding small maps to large totals over a whole cohort loses no precision
+        self.sums = torch.zeros(num_classes, num_features, dtype=torch.float64)
+        self.absolute_sums = torch.zeros(num_classes, num_features, dtype=torch.float64)
+        self.top_k_counts = torch.zeros(num_classes, num_features, dtype=torch.long)
+
+    def update(self, maps, classes):
+        """
+        Args:
+            maps (Tensor): Saliency maps of shape (n, features).
+            classes (Tensor): Class each map was computed for, of shape (n,)
+        """
+        maps = maps.detach().cpu().double()
+        classes = classes.cpu()
+        absolute = maps.abs()
+
+        self.counts += torch.bincount(classes, minlength=self.counts.size(0))
+        self.sums.index_add_(0, classes, maps)
+        self.absolute_sums.index_add_(0, classes, absolute)
+
+        top = absolute.topk(self.top_k, dim=1).indices
+        self.top_k_counts.index_put_((classes.repeat_interleave(self.top_k), top.flatten()),
+                                     torch.ones(top.numel(), dtype=torch.long), accumulate=True)
+
+    def mean(self):
+        return self.sums / self.counts.clamp(min=1).unsqueeze(1)
+
+    def mean_absolute(self):
+        return self.absolute_sums / self.counts.clamp(min=1).unsqueeze(1)
+
+    def top_k_frequency(self):
+        """Fraction of each class' samples that have the feature among their top_k"""
+        return self.top_k_counts.double() / self.counts.clamp(min=1).unsqueeze(1)
+
+    def rankings(self):
+        """Features of each class, of shape (classes, features), from the largest mean absolute saliency down"""
+        return self.mean_absolute().argsort(dim=1, descending=True)
+
+    def save_csv(self, filename, class_names, feature_names, num_features=None):
+        """One row per class and feature, ranked by mean absolute saliency, the num_features first of each class"""
+        mean, mean_absolute, frequency = self.mean(), self.mean_absolute(), self.top_k_frequency()
+
+        with open(filename, 'w') as f:
+            f.write('class,samples,rank,feature,mean,mean_absolute,top_{}_frequency\n'.format(self.top_k))
+
+            for c, ranking in enumerate(self.rankings()):
+                if self.counts[c] == 0:
+                    continue
+
+                for rank, i in enumerate(ranking[:num_features].tolist()):
+                    f.write('{},{},{},{},{:.6g},{:.6g},{:.6g}\n'.format(
+                        class_names[c], self.counts[c].item(), rank + 1, feature_names[i], mean[c, i].item(),
+                        mean_absolute[c, i].item(), frequency[c, i].item()))
+
+    def save_npz(self, filename, class_names, feature_names):
+        """The statistics of every class and feature as float32 arrays of shape (classes, features)"""
+        np.savez_compressed(filename, classes=np.array(class_names, dtype=str),
+                            features=np.array(feature_names, dtype=str), samples=self.counts.numpy(),
+                            mean=self.mean().float().numpy(), mean_absolute=self.mean_absolute().float().numpy(),
+                            top_k_frequency=self.top_k_frequency().float().numpy(),
+                            rankings=self.rankings().int().numpy(), top_k=self.top_k)
@@ -1,52 +1,58 @@
 import torch
 import torch.nn as nn
-from Saliency.saliency import Saliency
+from contextlib import contextmanager
+from Saliency.saliency import Saliency, MEMORY_BUDGET
 
 
-class GuidedSaliency(Saliency):
-    """Class for computing guided saliency"""
-    def __init__(self, model, device):
-        super(GuidedSaliency, self).__init__(model, device)
-        self.forward_relu_outputs = []
-
-    def relu_backward_hook_function(self, module, grad_in, grad_out):
-        """
-        If there is a negative gradient, change it to zero
-        """
-        # Get last forward output
-        corresponding_forward_output = self.forward_relu_outputs[-1]
-        positive_mask = (corresponding_forward_output > 0).type_as(corresponding_forward_output)
-
-        # add zeros to avoid -0.0
-        modified_grad_out = positive_mask * torch.clamp(grad_in[0], min=0.0)
-
-        del self.forward_relu_outputs[-1]  # Remove last forward output
-        return (modified_grad_out,)
+class GuidedReLUFunction(torch.autograd.Function):
+    """ReLU whose backward pass only lets positive gradients through where the input was positive"""
+    generate_vmap_rule = True
 
-    def relu_forward_hook_function(self, module, ten_in, ten_out):
-        """
-        Store results of forward pass
-        """
-        self.forward_relu_outputs.append(ten_out)
+    @staticmethod
+    def forward(x):
+        return x.clamp(min=0)
 
-    def generate_saliency(self, input, target):
-        input.requires_grad = True
+    @staticmethod
+    def setup_context(ctx, inputs, output):
+        ctx.save_for_backward(output)
 
-        self.model.zero_grad()
+    @staticmethod
+    def backward(ctx, grad_output):
+        output, = ctx.saved_tensors
 
-        for module in self.model.modules():
-            if type(module) == nn.ReLU:
-                module.register_forward_hook(self.relu_forward_hook_function)
-                module.register_backward_hook(self.relu_backward_hook_function)
+        # the positive mask is multiplied in, rather than selected with, to avoid -0.0
+        return (output > 0).type_as(grad_output) * grad_output.clamp(min=0)
 
-        output = self.model(input.to(self.device))
 
-        grad_outputs = torch.zeros_like(output)
+class GuidedReLU(nn.Module):
+    def forward(self, x):
+        return GuidedReLUFunction.apply(x)
 
-        grad_outputs[:, target] = 1
 
-        self.model.zero_grad()
-
-        output.backward(gradient=grad_outputs)
-
-        return input.grad.clone()[0]
+class GuidedSaliency(Saliency):
+    """Class for computing guided saliency"""
+    def __init__(self, model, device, memory_budget=MEMORY_BUDGET):
+        super(GuidedSaliency, self).__init__(model, device, memory_budget)
+
+        # the modules holding a ReLU, and its name in them, found once instead of on every pass
+        self.relus = [(parent, name) for parent in self.model.modules()
+                      for name, child in parent.named_children() if type(child) == nn.ReLU]
+        self.guided_relu = GuidedReLU()
+
+    @contextmanager
+    def guided(self):
+        """Swaps the model's ReLUs for guided ones for the duration, and back afterwards"""
+        relus = [parent._modules[name] for parent, name in self.relus]
+
+        for parent, name in self.relus:
+            parent._modules[name] = self.guided_relu
+
+        try:
+            yield
+        finally:
+            for (parent, name), relu in zip(self.relus, relus):
+                parent._modules[name] = relu
+
+    def forward(self, x):
+        with self.guided():
+            return super(GuidedSaliency, self).forward(x)
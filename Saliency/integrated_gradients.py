@@ -0,0 +1,31 @@
+import torch
+from Saliency.saliency import Saliency, MEMORY_BUDGET
+
+
+class IntegratedGradients(Saliency):
+    """
+    Integrated gradients: the difference between the input and a baseline, times the average gradient along the
+    straight path between them. The average is a midpoint Riemann sum over steps points, and the steps of a chunk of
+    samples go through the model as one batch.
+    """
+    def __init__(self, model, device, memory_budget=MEMORY_BUDGET, steps=50, baseline=None):
+        """
+        Args:
+            steps (int): Points on the path to average the gradients over.
+            baseline (Tensor): Input of shape (features,) to integrate from. Default: all zeros
+        """
+        super(IntegratedGradients, self).__init__(model, device, memory_budget)
+        self.passes = steps
+        self.baseline = baseline
+
+    def attribute(self, x, cotangents):
+        baseline = torch.zeros_like(x[0]) if self.baseline is None else self.baseline.to(x.device)
+        alphas = (torch.arange(self.passes, device=x.device) + 0.5) / self.passes
+
+        difference = x - baseline
+        # the steps of each sample are consecutive rows of the batch
+        path = (baseline + alphas.view(1, -1, 1) * difference.unsqueeze(1)).flatten(0, 1)
+
+        grads = self.gradients(path, cotangents.repeat_interleave(self.passes, dim=1))
+
+        return difference * grads.view(cotangents.size(0), x.size(0), self.passes, -1).mean(2)
@@ -1,12 +1,140 @@
-from copy import deepcopy
+import torch
+from contextlib import contextmanager
+from torch.func import vjp, vmap
+
+# bytes of gradients and backward intermediates a chunk of samples may take up
+MEMORY_BUDGET = 2 ** 28
+
+
+@contextmanager
+def evaluation_mode(model):
+    """Puts model in evaluation mode for the duration, then back in the mode it was in"""
+    training = model.training
+    model.eval()
+
+    try:
+        yield model
+    finally:
+        model.train(training)
 
 
 class Saliency(object):
+    """
+    Gradients of a classifier's outputs with respect to its inputs. Inputs are processed in chunks sized to
+    memory_budget, and the gradients for several classes come out of one batched vector-Jacobian product per chunk.
+    The model's weights are shared, not copied, and it only runs in evaluation mode while saliency is computed.
+    """
+    # forward and backward passes each sample takes, over which subclasses such as SmoothGrad average
+    passes = 1
 
-    def __init__(self, model, device):
-        self.model = deepcopy(model)
-        self.model.eval()
+    def __init__(self, model, device, memory_budget=MEMORY_BUDGET):
+        self.model = model
         self.device = device
+        self.memory_budget = memory_budget
+        self.activation_size = None
+
+    def forward(self, x):
+        with evaluation_mode(self.model):
+            return self.model(x)
+
+    def gradients(self, x, cotangents):
+        """
+        Gradients of the model's outputs on x weighted by each of cotangents, of shape (k, samples, outputs).
+        Returns them as (k, samples, features).
+        """
+        _, pullback = vjp(self.forward, x)
+
+        return vmap(pullback)(cotangents)[0]
+
+    def attribute(self, x, cotangents):
+        """Saliency of x for each of cotangents, of shape (k, samples, features)"""
+        return self.gradients(x, cotangents)
+
+    def chunk_size(self, inputs, num_classes):
+        """
+        Samples per chunk such that num_classes gradients of each of their passes, with the backward intermediates, fit
+        the budget
+        """
+        if self.activation_size is None:
+            self.activation_size = self.measure_activations(inputs[:1])
+
+        bytes_per_sample = inputs.element_size() * num_classes * self.passes * (inputs[0].numel() +
+                                                                               self.activation_size)
+
+        return max(1, self.memory_budget // bytes_per_sample)
+
+    def measure_activations(self, x):
+        """Number of values the forward pass of one sample produces"""
+        sizes = []
+        handles = [m.register_forward_hook(lambda module, ten_in, ten_out: sizes.append(ten_out.numel()))
+                   for m in self.model.modules() if not list(m.children())]
+
+        try:
+            with evaluation_mode(self.model), torch.no_grad():
+                self.model(x.to(self.device))
+        finally:
+            for handle in handles:
+                handle.remove()
+
+        return sum(sizes)
+
+    def saliency_maps(self, inputs, classes=None):
+        """
+        Args:
+            inputs (Tensor): Samples of shape (n, features).
+            classes (list): Classes to compute the gradients of. Default: all of the model's outputs
+
+        Returns:
+            Tensor: Gradients of shape (n, len(classes), features), on the device of inputs
+        """
+        if classes is None:
+            with torch.no_grad():
+                classes = list(range(self.forward(inputs[:1].to(self.device)).size(1)))
+
+        maps = []
+        size = self.chunk_size(inputs, len(classes))
+
+        for chunk in inputs.split(size):
+            x = chunk.to(self.device)
+
+            with torch.no_grad():
+                num_outputs = self.forward(x[:1]).size(1)
+
+            # one one-hot cotangent per class, the same for every sample of the chunk
+            cotangents = torch.zeros(len(classes), x.size(0), num_outputs, device=self.device)
+            cotangents[torch.arange(len(classes)), :, torch.as_tensor(classes)] = 1
+
+            maps.append(self.attribute(x, cotangents).transpose(0, 1).to(inputs.device))
+
+        return torch.cat(maps)
+
+    def saliency(self, inputs, targets):
+        """
+        Args:
+            inputs (Tensor): Samples of shape (n, features).
+            targets (int or Tensor): Class to compute the gradient of, one for all samples or one per sample
+
+        Returns:
+            Tensor: Gradients of shape (n, features), on the device of inputs
+        """
+        targets = torch.as_tensor(targets).expand(inputs.size(0))
+
+        maps = []
+        size = self.chunk_size(inputs, 1)
+
+        for chunk, chunk_targets in zip(inputs.split(size), targets.split(size)):
+            x = chunk.to(self.device)
+
+            with torch.no_grad():
+                num_outputs = self.forward(x[:1]).size(1)
+
+            cotangents = torch.zeros(1, x.size(0), num_outputs, device=self.device)
+            cotangents[0, torch.arange(x.size(0)), chunk_targets.to(self.device)] = 1
+
+            maps.append(self.attribute(x, cotangents)[0].to(inputs.device))
+
+        return torch.cat(maps)
 
     def generate_saliency(self, input, target):
-        raise NotImplementedError
+        """Gradient of the first sample of input for target, of shape (features,)"""
+        return self.saliency(input.detach(), target)[0]
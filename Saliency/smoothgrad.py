@@ -0,0 +1,32 @@
+import torch
+from Saliency.saliency import Saliency, MEMORY_BUDGET
+
+
+class SmoothGrad(Saliency):
+    """
+    SmoothGrad: the gradient averaged over copies of the input with Gaussian noise added. The noisy copies of a chunk
+    of samples go through the model as one batch.
+    """
+    def __init__(self, model, device, memory_budget=MEMORY_BUDGET, samples=50, noise_level=0.15, squared=False):
+        """
+        Args:
+            samples (int): Noisy copies of each input to average over.
+            noise_level (float): Standard deviation of the noise, relative to the range of each input.
+            squared (bool): Average the squared gradients instead, as SmoothGrad-squared does
+        """
+        super(SmoothGrad, self).__init__(model, device, memory_budget)
+        self.passes = samples
+        self.noise_level = noise_level
+        self.squared = squared
+
+    def attribute(self, x, cotangents):
+        sigma = self.noise_level * (x.max(dim=1, keepdim=True).values - x.min(dim=1, keepdim=True).values)
+
+        # the copies of each sample are consecutive rows of the batch
+        noise = torch.randn(x.size(0), self.passes, x.size(1), device=x.device)
+        noisy = (x.unsqueeze(1) + sigma.unsqueeze(1) * noise).flatten(0, 1)
+
+        grads = self.gradients(noisy, cotangents.repeat_interleave(self.passes, dim=1))
+        grads = grads.view(cotangents.size(0), x.size(0), self.passes, -1)
+
+        return (grads ** 2 if self.squared else grads).mean(2)
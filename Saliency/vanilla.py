@@ -1,25 +1,8 @@
-import torch
-from torch import nn
-from Saliency.saliency import Saliency
+from Saliency.saliency import Saliency, MEMORY_BUDGET
 
 
 class VanillaSaliency(Saliency):
     """Vanilla Saliency to visualize plain gradient information"""
 
-    def __init__(self, model, device):
-        super(VanillaSaliency, self).__init__(model, device)
-
-    def generate_saliency(self, input, target):
-        input.requires_grad = True
-
-        self.model.zero_grad()
-
-        output = self.model(input.to(self.device))
-
-        grad_outputs = torch.zeros_like(output)
-
-        grad_outputs[:, target] = 1
-
-        output.backward(gradient=grad_outputs)
-
-        return input.grad.clone()[0]
+    def __init__(self, model, device, memory_budget=MEMORY_BUDGET):
+        super(VanillaSaliency, self).__init__(model, device, memory_budget)
@@ -0,0 +1,139 @@
+import argparse
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+import torch
+from sklearn.preprocessing import MinMaxScaler, StandardScaler
+from benchmarks.common import SHAPES, build_model, make_dataloaders, summarize, measure, save_results, load_results, \
+    compare, print_comparison
+from utils.datautils import load_synthetic_data
+from utils.inference import load_bundle, ensemble_classify, EnsembleClassifier
+
+device = torch.device('cpu')
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STARTUP_SCRIPT = 'import time; start = time.perf_counter(); import torch, Models, utils.inference; ' \
+                 'print(time.perf_counter() - start)'
+
+
+def build_bundle(state_path, data, labels, num_classes, num_labelled, batch_size, epochs):
+    """Trains M2 and the Ladder network briefly and saves them the way main.py train does"""
+    torch.manual_seed(0)
+
+    for model_name, normalizer in [('m2', MinMaxScaler()), ('ladder', StandardScaler())]:
+        normalized = torch.tensor(normalizer.fit_transform(data.numpy())).float()
+
+        model = build_model(model_name, data.size(1), num_classes, device, state_path)
+        model.train_model(epochs, make_dataloaders(model_name, normalized, labels, num_labelled, batch_size))
+
+        torch.save(model, '{}/{}.pt'.format(state_path, model_name))
+        pickle.dump(normalizer, open('{}/{}_normalizer.p'.format(state_path, model_name), 'wb'))
+
+    pickle.dump(data.mean(0).numpy(), open('{}/imputation_means.p'.format(state_path), 'wb'))
+    pickle.dump({i: 'class_{}'.format(i) for i in range(num_classes)}, open('{}/label_map.p'.format(state_path), 'wb'))
+
+
+def startup_times(repeats):
+    """Wall-clock time of a fresh interpreter importing the classify dependencies, and of the imports alone"""
+    process_times = []
+    import_times = []
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd=root, check=True, capture_output=True,
+                                text=True).stdout
+        process_times.append(time.perf_counter() - start)
+        import_times.append(float(output.split()[-1]))
+
+    return summarize(process_times), summarize(import_times)
+
+
+def inference_paths(bundle):
+    """
+    Functions from a batch of imputed data to class probabilities. 'current' is the path main.py classify takes,
+    the others should give the same predictions faster.
+    """
+    return {
+        'current': lambda data: ensemble_classify(bundle['m2'], bundle['m2_normalizer'], bundle['ladder'],
+                                                  bundle['ladder_normalizer'], data),
+        'optimized': EnsembleClassifier(bundle['m2'], bundle['m2_normalizer'], bundle['ladder'],
+                                        bundle['ladder_normalizer'], device),
+    }
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Cold-start, latency and throughput benchmark of classification with '
+                                                 'a trained M2 and Ladder bundle')
+    parser.add_argument('--shape', type=str, choices=list(SHAPES), default='tcga', help='Dataset shape to imitate')
+    parser.add_argument('--num_samples', type=int, default=2000, help='Samples to train the bundle on')
+    parser.add_argument('--input_size', type=int, default=None, help='Override the number of features')
+    parser.add_argument('--epochs', type=int, default=1, help='Epochs to train each model of the bundle for')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 10, 100, 1000, 10000])
+    parser.add_argument('--repeats', type=int, default=30, help='Timed calls per batch size')
+    parser.add_argument('--startup_repeats', type=int, default=5, help='Fresh interpreters to time')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--output', type=str, default=None, help='JSON file to write the results to')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative increase in median time that counts as a regression')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    _, input_size, num_classes, sparsity = SHAPES[args.shape]
+    input_size = args.input_size or input_size
+
+    results = {}
+
+    print('==Measuring startup==')
+    results['startup/process'], results['startup/imports'] = startup_times(args.startup_repeats)
+
+    with tempfile.TemporaryDirectory() as state_path:
+        print('==Training bundle on {} x {} synthetic data=='.format(args.num_samples, input_size))
+        (data, labels), _ = load_synthetic_data(args.num_samples, input_size, num_classes, sparsity)
+        build_bundle(state_path, data, labels, num_classes, args.num_samples // 10, 100, args.epochs)
+
+        print('==Measuring model load==')
+        results['load'] = summarize(measure(lambda: load_bundle(state_path, device), repeats=5, warmup=1))
+        bundle = load_bundle(state_path, device)
+
+    paths = inference_paths(bundle)
+
+    print('==Measuring classification==')
+    for batch_size in args.batch_sizes:
+        batch = load_synthetic_data(batch_size, input_size, num_classes, sparsity, seed=1)[0][0]
+
+        for name, path in paths.items():
+            key = '{}/batch_{}'.format(name, batch_size)
+            results[key] = summarize(measure(lambda: path(batch), args.repeats))
+            results[key]['samples_per_sec'] = batch_size / results[key]['median']
+
+            print('{}: p50 {:.3f} ms, p99 {:.3f} ms, {:.1f} samples/sec'.format(
+                key, 1e3 * results[key]['median'], 1e3 * results[key]['p99'], results[key]['samples_per_sec']))
+
+        reference = paths['current'](batch)
+        for name, path in paths.items():
+            difference = (path(batch) - reference).abs().max().item()
+            results['{}/batch_{}'.format(name, batch_size)]['max_difference'] = difference
+
+    for key in ['startup/process', 'startup/imports', 'load']:
+        print('{}: median {:.3f} s'.format(key, results[key]['median']))
+
+    if args.output is not None:
+        save_results(results, args.output, shape=args.shape, input_size=input_size, num_classes=num_classes,
+                     num_samples=args.num_samples, epochs=args.epochs, repeats=args.repeats)
+
+    if args.baseline is not None:
+        rows = compare(results, load_results(args.baseline), 'median', args.threshold, higher_is_better=False)
+        print_comparison(rows, 'median')
+
+        if any(regressed for *_, regressed in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    __main__()
@@ -0,0 +1,139 @@
+import json
+import math
+import platform
+import statistics
+import time
+import torch
+from torch import nn
+from torch.profiler import profile, ProfilerActivity
+from torch.utils.data import DataLoader, TensorDataset
+from Models import SimpleNetwork, M1, SDAE, M2Runner, LadderNetwork
+from utils.distributed import train_loader
+from utils.storage import UnlabelledDataset
+
+# (num samples, input size, num classes, sparsity) of the datasets the synthetic data stands in for
+SHAPES = {
+    'tcga': (10000, 20000, 33, 0.),
+    'mnist': (60000, 784, 10, 0.8),
+}
+
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+def summarize(times):
+    """Median, 95th and 99th percentiles and mean of a list of timings"""
+    ordered = sorted(times)
+
+    return {'median': statistics.median(ordered), 'p95': percentile(ordered, 0.95), 'p99': percentile(ordered, 0.99),
+            'mean': statistics.mean(ordered), 'n': len(ordered)}
+
+
+def environment():
+    return {
+        'torch': torch.__version__,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'threads': torch.get_num_threads(),
+    }
+
+
+def save_results(results, filename, **metadata):
+    with open(filename, 'w') as f:
+        json.dump({'environment': environment(), 'metadata': metadata, 'results': results}, f, indent=2,
+                  sort_keys=True)
+
+
+def load_results(filename):
+    with open(filename) as f:
+        return json.load(f)['results']
+
+
+def compare(results, baseline, metric, threshold, higher_is_better=True):
+    """
+    Compares metric between two result dicts with the same keys.
+    Returns rows (key, baseline value, new value, relative change, regressed) for keys present in both.
+    """
+    rows = []
+
+    for key in sorted(set(results) & set(baseline)):
+        old = baseline[key][metric]
+        new = results[key][metric]
+
+        change = (new - old) / old if old else 0.
+        regressed = change < -threshold if higher_is_better else change > threshold
+
+        rows.append((key, old, new, change, regressed))
+
+    return rows
+
+
+def print_comparison(rows, metric):
+    print('{:<40} {:>14} {:>14} {:>9}'.format('benchmark', 'baseline', 'current', 'change'))
+
+    for key, old, new, change, regressed in rows:
+        print('{:<40} {:>14.4g} {:>14.4g} {:>+8.1%}{}'.format(key, old, new, change, '  REGRESSION' if regressed else ''))
+
+    print('metric: {}'.format(metric))
+
+
+def build_model(model_name, input_size, num_classes, device, state_path, lr=1e-3):
+    """A mid-grid configuration of each model, following the hyperparameter loops"""
+    hidden = min(500, (input_size + num_classes) // 2)
+
+    if model_name == 'simple':
+        return SimpleNetwork(input_size, [hidden] * 2, num_classes, lr, device, model_name, state_path)
+    if model_name == 'm1':
+        return M1(input_size, [hidden], 50, [50], num_classes, nn.Sigmoid(), lr, device, model_name, state_path)
+    if model_name == 'sdae':
+        return SDAE(input_size, [hidden] * 2, num_classes, lr, device, model_name, state_path, pretraining_epochs=1)
+    if model_name == 'm2':
+        return M2Runner(input_size, [hidden], [hidden], 50, num_classes, nn.Sigmoid(), lr, device, model_name,
+                        state_path)
+    if model_name == 'ladder':
+        return LadderNetwork(input_size, [hidden] * 2, num_classes, [1000.0, 10.0, 0.1, 0.1], lr, device, model_name,
+                             state_path)
+
+    raise ValueError('Unknown model {}'.format(model_name))
+
+
+def make_dataloaders(model_name, data, labels, num_labelled, batch_size, num_validation=500, storage='float32'):
+    """(unsupervised, supervised, validation) loaders laid out, and sharded, the way the sweep scripts build them"""
+    validation = TensorDataset(data[:num_validation], labels[:num_validation])
+    data = data[num_validation:]
+    labels = labels[num_validation:]
+
+    s_d = TensorDataset(data[:num_labelled], labels[:num_labelled])
+
+    # M2 only sees the unlabelled part of the data as unlabelled, the other models see all of it
+    u_d = UnlabelledDataset(data, storage, torch.arange(num_labelled, data.size(0)) if model_name == 'm2' else None)
+
+    u_dl = train_loader(u_d, batch_size)
+    s_dl = train_loader(s_d, batch_size)
+    v_dl = DataLoader(validation, batch_size=len(validation))
+
+    return u_dl, s_dl, v_dl
+
+
+def measure(fn, repeats=20, warmup=3):
+    """Wall-clock times of repeated calls to fn after some warm-up calls"""
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+def allocated_bytes(fn):
+    """Total bytes of tensor memory allocated during one call to fn, from the profiler's memory events"""
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+
+    return sum(e.cpu_memory_usage for e in prof.events() if e.name == '[memory]' and e.cpu_memory_usage > 0)
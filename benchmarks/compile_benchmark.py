@@ -0,0 +1,129 @@
+import argparse
+import sys
+import tempfile
+import time
+import torch
+from benchmarks.common import SHAPES, build_model, make_dataloaders, summarize, measure, save_results, load_results, \
+    compare, print_comparison
+from utils.compilation import COMPILE_CACHE, enable_compile_cache
+from utils.datautils import load_synthetic_data
+from utils.engine import TrainingEngine
+from utils.instrumentation import Instrumentation
+
+MODELS = ['simple', 'm1', 'sdae', 'm2', 'ladder']
+MODES = ['eager', 'compiled']
+device = torch.device('cpu')
+
+
+def benchmark_model(model_name, mode, data, labels, num_classes, num_labelled, batch_size, epochs, repeats,
+                    state_path):
+    torch.manual_seed(0)
+
+    model = build_model(model_name, data.size(1), num_classes, device, state_path)
+    model.engine = TrainingEngine(compiled=mode == 'compiled')
+    model.instrumentation = Instrumentation(enabled=True)
+
+    dataloaders = make_dataloaders(model_name, data, labels, num_labelled, batch_size)
+    model.train_model(epochs, dataloaders)
+
+    records = model.instrumentation.records
+    # the first epoch of every stage includes compilation, the rest show the steady state
+    first = [r for r in records if r['epoch'] == 0]
+    steady = [r for r in records if r['epoch'] > 0]
+
+    x = data[:batch_size]
+
+    start = time.perf_counter()
+    outputs = model.classify(x)
+    first_classify_seconds = time.perf_counter() - start
+
+    classify = summarize(measure(lambda: model.classify(x), repeats))
+
+    return {
+        'first_epoch_seconds': sum(r['seconds'] for r in first),
+        'samples_per_sec': sum(r['samples'] for r in steady) / sum(r['seconds'] for r in steady),
+        'first_classify_seconds': first_classify_seconds,
+        'classify_median': classify['median'],
+        'classify_p95': classify['p95'],
+    }, outputs
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Training and classify speed of torch.compile against eager mode on '
+                                                 'synthetic data')
+    parser.add_argument('--shape', type=str, choices=list(SHAPES), default='mnist', help='Dataset shape to imitate')
+    parser.add_argument('--num_samples', type=int, default=5000, help='Override the number of samples')
+    parser.add_argument('--input_size', type=int, default=None, help='Override the number of features')
+    parser.add_argument('--label_fraction', type=float, default=0.1, help='Fraction of training samples labelled')
+    parser.add_argument('--models', type=str, nargs='+', choices=MODELS, default=MODELS)
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--epochs', type=int, default=3,
+                        help='Epochs per training stage, the first is reported separately as it includes compilation')
+    parser.add_argument('--repeats', type=int, default=20, help='Timed classify calls')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--compile_cache', type=str, default=COMPILE_CACHE)
+    parser.add_argument('--output', type=str, default=None, help='JSON file to write the results to')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative drop in samples/sec that counts as a regression')
+    args = parser.parse_args()
+
+    if args.epochs < 2:
+        parser.error('--epochs must be at least 2 to measure the steady state')
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    enable_compile_cache(args.compile_cache)
+
+    num_samples, input_size, num_classes, sparsity = SHAPES[args.shape]
+    num_samples = args.num_samples or num_samples
+    input_size = args.input_size or input_size
+
+    print('==Generating {} x {} synthetic data=='.format(num_samples, input_size))
+    (data, labels), _ = load_synthetic_data(num_samples, input_size, num_classes, sparsity)
+    num_labelled = max(num_classes + 1, int(args.label_fraction * num_samples))
+
+    results = {}
+    with tempfile.TemporaryDirectory() as state_path:
+        for model_name in args.models:
+            outputs = {}
+
+            for mode in MODES:
+                key = '{}/{}'.format(model_name, mode)
+                results[key], outputs[mode] = benchmark_model(model_name, mode, data, labels, num_classes,
+                                                              num_labelled, args.batch_size, args.epochs,
+                                                              args.repeats, state_path)
+
+            # both runs start from the same seed, but compiled code draws its own random numbers for the noise in
+            # the M1, M2 and Ladder losses, so only the deterministic models should match closely
+            results['{}/compiled'.format(model_name)]['max_difference'] = \
+                (outputs['eager'] - outputs['compiled']).abs().max().item()
+
+            for mode in MODES:
+                key = '{}/{}'.format(model_name, mode)
+                print('{}: first epoch {:.2f} s, {:.1f} samples/sec, first classify {:.3f} s, classify median '
+                      '{:.3f} ms'.format(key, results[key]['first_epoch_seconds'], results[key]['samples_per_sec'],
+                                         results[key]['first_classify_seconds'], 1e3 * results[key]['classify_median']))
+
+            eager = results['{}/eager'.format(model_name)]
+            compiled = results['{}/compiled'.format(model_name)]
+            print('{}: training {:.2f}x, classify {:.2f}x, max difference {:.2e}'.format(
+                model_name, compiled['samples_per_sec'] / eager['samples_per_sec'],
+                eager['classify_median'] / compiled['classify_median'], compiled['max_difference']))
+
+    if args.output is not None:
+        save_results(results, args.output, shape=args.shape, num_samples=num_samples, input_size=input_size,
+                     num_classes=num_classes, num_labelled=num_labelled, batch_size=args.batch_size,
+                     epochs=args.epochs)
+
+    if args.baseline is not None:
+        rows = compare(results, load_results(args.baseline), 'samples_per_sec', args.threshold)
+        print_comparison(rows, 'samples_per_sec')
+
+        if any(regressed for *_, regressed in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    __main__()
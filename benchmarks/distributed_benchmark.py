@@ -0,0 +1,141 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from benchmarks.common import SHAPES, build_model, make_dataloaders, save_results, load_results, compare, \
+    print_comparison
+from utils import distributed
+from utils.datautils import load_synthetic_data
+from utils.instrumentation import Instrumentation
+
+MODELS = ['simple', 'm1', 'sdae', 'm2', 'ladder']
+
+
+def replica_difference(model):
+    """Largest difference between any process' parameters and buffers and rank 0's"""
+    flat = torch.cat([t.detach().reshape(-1).float() for t in list(model.parameters()) + list(model.buffers())])
+    reference = flat.clone()
+    dist.broadcast(reference, src=0)
+
+    difference = (flat - reference).abs().max()
+    dist.all_reduce(difference, op=dist.ReduceOp.MAX)
+
+    return difference.item()
+
+
+def worker(rank, world_size, port, args, state_path, results_file):
+    os.environ.update({'MASTER_ADDR': '127.0.0.1', 'MASTER_PORT': str(port), 'RANK': str(rank),
+                       'WORLD_SIZE': str(world_size), 'LOCAL_WORLD_SIZE': str(world_size)})
+    distributed.init(args.threads)
+
+    num_samples, input_size, num_classes, sparsity = SHAPES[args.shape]
+    (data, labels), _ = load_synthetic_data(args.num_samples or num_samples, args.input_size or input_size,
+                                            num_classes, sparsity)
+    num_labelled = max(num_classes + 1, int(args.label_fraction * data.size(0)))
+
+    results = {}
+    for model_name in args.models:
+        torch.manual_seed(rank)
+
+        model = build_model(model_name, data.size(1), num_classes, torch.device('cpu'), state_path)
+        model.instrumentation = Instrumentation(enabled=True)
+        dataloaders = make_dataloaders(model_name, data, labels, num_labelled, args.batch_size)
+
+        distributed.barrier()
+        start = time.perf_counter()
+        model.train_model(args.epochs, dataloaders)
+        distributed.barrier()
+        seconds = time.perf_counter() - start
+
+        samples = torch.tensor(sum(r['samples'] for r in model.instrumentation.records), dtype=torch.float64)
+        if distributed.is_distributed():
+            dist.all_reduce(samples)
+            difference = replica_difference(model)
+        else:
+            difference = 0.
+
+        results[model_name] = {'seconds': seconds, 'samples_per_sec': samples.item() / seconds,
+                               'replica_difference': difference}
+
+    if rank == 0:
+        with open(results_file, 'w') as f:
+            json.dump(results, f)
+
+    distributed.shutdown()
+
+
+def run(world_size, args, state_path):
+    results_file = os.path.join(state_path, 'results_{}.json'.format(world_size))
+    # a fresh port per run, the previous group's may still be in TIME_WAIT
+    port = args.port + world_size
+
+    if world_size == 1:
+        worker(0, 1, port, args, state_path, results_file)
+    else:
+        mp.spawn(worker, (world_size, port, args, state_path, results_file), nprocs=world_size)
+
+    with open(results_file) as f:
+        return json.load(f)
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Data-parallel training throughput over local gloo processes on '
+                                                 'synthetic data, checking that the replicas stay identical')
+    parser.add_argument('--shape', type=str, choices=list(SHAPES), default='mnist', help='Dataset shape to imitate')
+    parser.add_argument('--num_samples', type=int, default=10000, help='Override the number of samples')
+    parser.add_argument('--input_size', type=int, default=None, help='Override the number of features')
+    parser.add_argument('--label_fraction', type=float, default=0.1, help='Fraction of training samples labelled')
+    parser.add_argument('--models', type=str, nargs='+', choices=MODELS, default=['m2', 'ladder'])
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Threads per process, defaults to the cores split between the processes')
+    parser.add_argument('--batch_size', type=int, default=100, help='Batch size of each process')
+    parser.add_argument('--epochs', type=int, default=2, help='Epochs per training stage')
+    parser.add_argument('--port', type=int, default=29600)
+    parser.add_argument('--tolerance', type=float, default=1e-5,
+                        help='Largest difference between replicas before the run counts as failed')
+    parser.add_argument('--output', type=str, default=None, help='JSON file to write the results to')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative drop in samples/sec that counts as a regression')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as state_path:
+        for world_size in args.processes:
+            for model_name, result in run(world_size, args, state_path).items():
+                results['{}/processes_{}'.format(model_name, world_size)] = result
+
+    failed = False
+    for model_name in args.models:
+        single = results.get('{}/processes_1'.format(model_name))
+
+        for world_size in args.processes:
+            result = results['{}/processes_{}'.format(model_name, world_size)]
+            speedup = result['samples_per_sec'] / single['samples_per_sec'] if single else float('nan')
+            diverged = result['replica_difference'] > args.tolerance
+            failed = failed or diverged
+
+            print('{} x{}: {:.1f} samples/sec, {:.2f}x, replica difference {:.2e}{}'.format(
+                model_name, world_size, result['samples_per_sec'], speedup, result['replica_difference'],
+                '  DIVERGED' if diverged else ''))
+
+    if args.output is not None:
+        save_results(results, args.output, shape=args.shape, batch_size=args.batch_size, epochs=args.epochs)
+
+    if args.baseline is not None:
+        rows = compare(results, load_results(args.baseline), 'samples_per_sec', args.threshold)
+        print_comparison(rows, 'samples_per_sec')
+        failed = failed or any(regressed for *_, regressed in rows)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    __main__()
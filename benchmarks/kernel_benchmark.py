@@ -0,0 +1,177 @@
+import argparse
+import sys
+import torch
+from torch import nn
+import torch.nn.functional as F
+from benchmarks.common import summarize, measure, allocated_bytes, save_results, load_results, compare, \
+    print_comparison
+from Models import M2Runner, LadderNetwork, SDAE
+from Models.BuildingBlocks import VariationalEncoder
+from Models.SDAE import AutoencoderSDAE
+
+device = torch.device('cpu')
+
+
+def hidden_size(input_size, num_classes):
+    return min(500, (input_size + num_classes) // 2)
+
+
+def m2_kernels(batch_size, input_size, num_classes):
+    runner = M2Runner(input_size, [hidden_size(input_size, num_classes)], [hidden_size(input_size, num_classes)], 50,
+                      num_classes, nn.Sigmoid(), 1e-3, device, 'kernel', None)
+
+    x = torch.rand(batch_size, input_size)
+    y = torch.randint(num_classes, (batch_size,))
+
+    recons_logits = torch.randn(batch_size, input_size, requires_grad=True)
+    mu = torch.randn(batch_size, 50, requires_grad=True)
+    logvar = torch.randn(batch_size, 50, requires_grad=True)
+
+    return {
+        'm2_minus_L': lambda: runner.minus_L(x, recons_logits, mu, logvar, y).sum(),
+        'm2_minus_U': lambda: runner.minus_U(x, runner.M2.classify(x)),
+        'm2_elbo_labelled': lambda: runner.elbo(x, y),
+        'm2_elbo_unlabelled': lambda: runner.elbo(x),
+    }
+
+
+def ladder_kernels(batch_size, input_size, num_classes):
+    hidden = hidden_size(input_size, num_classes)
+    network = LadderNetwork(input_size, [hidden] * 2, num_classes, [1000.0, 10.0, 0.1, 0.1], 1e-3, device, 'kernel',
+                            None)
+    encoders = network.ladder.encoders
+    decoders = network.ladder.decoders
+
+    # labelled and unlabelled halves, as in training
+    inputs = torch.rand(2 * batch_size, input_size)
+
+    with torch.no_grad():
+        y_c, corr = encoders(inputs, network.noise_std, True, batch_size)
+        _, clean = encoders(inputs, 0.0, True, batch_size)
+    y_c = F.softmax(y_c, dim=1)
+
+    z_c = torch.randn(batch_size, input_size)
+    u = torch.randn(batch_size, input_size)
+
+    return {
+        'ladder_encoders': lambda: encoders(inputs, network.noise_std, True, batch_size)[0].sum(),
+        'ladder_decoders': lambda: sum(z.sum() for z in decoders(y_c, corr, clean, batch_size).values()),
+        'ladder_g_gauss': lambda: decoders.g_gauss(z_c, u, 0).sum(),
+    }
+
+
+def vae_kernels(batch_size, input_size, num_classes):
+    encoder = VariationalEncoder(input_size, [hidden_size(input_size, num_classes)], 50)
+
+    x = torch.rand(batch_size, input_size)
+    mu = torch.randn(batch_size, 50, requires_grad=True)
+    logvar = torch.randn(batch_size, 50, requires_grad=True)
+
+    return {
+        'vae_reparameterize': lambda: encoder.reparameterize(mu, logvar).sum(),
+        'vae_encoder': lambda: encoder(x)[0].sum(),
+    }
+
+
+def pretraining_kernel(model, dae, optimizer, criterion, previous_layers, x):
+    def step():
+        optimizer.zero_grad()
+        model.pretraining_loss(dae, criterion, previous_layers, x).backward()
+        optimizer.step()
+
+    return step
+
+
+def sdae_kernels(batch_size, input_size, num_classes, num_layers=3):
+    model = SDAE(input_size, [hidden_size(input_size, num_classes)] * num_layers, num_classes, 1e-3, device, 'kernel',
+                 None)
+    criterion = nn.MSELoss()
+    x = torch.rand(batch_size, input_size)
+
+    kernels = {}
+    for i in range(num_layers):
+        dae = AutoencoderSDAE(model.SDAEClassifier.hidden_layers[i])
+        optimizer = torch.optim.Adam(dae.parameters(), lr=1e-3)
+        previous_layers = model.SDAEClassifier.hidden_layers[0:i]
+
+        kernels['sdae_pretrain_layer_{}'.format(i)] = pretraining_kernel(model, dae, optimizer, criterion,
+                                                                         previous_layers, x)
+
+    return kernels
+
+
+KERNELS = {
+    'm2': m2_kernels,
+    'ladder': ladder_kernels,
+    'vae': vae_kernels,
+    'sdae': sdae_kernels,
+}
+
+
+def benchmark_kernel(fn, mode, repeats):
+    if mode == 'forward':
+        def run():
+            with torch.no_grad():
+                fn()
+    elif mode == 'forward_backward':
+        def run():
+            fn().backward()
+    else:
+        # fn is a full training step
+        run = fn
+
+    result = summarize(measure(run, repeats))
+    result['allocated_bytes'] = allocated_bytes(run)
+
+    return result
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the model hot paths')
+    parser.add_argument('--groups', type=str, nargs='+', choices=list(KERNELS), default=list(KERNELS))
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[100])
+    parser.add_argument('--input_sizes', type=int, nargs='+', default=[784, 20000])
+    parser.add_argument('--num_classes', type=int, nargs='+', default=[10, 33])
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--output', type=str, default=None, help='JSON file to write the results to')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative increase in median time that counts as a regression')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    results = {}
+    for group in args.groups:
+        for batch_size in args.batch_sizes:
+            for input_size in args.input_sizes:
+                for num_classes in args.num_classes:
+                    torch.manual_seed(0)
+                    kernels = KERNELS[group](batch_size, input_size, num_classes)
+
+                    modes = ['step'] if group == 'sdae' else ['forward', 'forward_backward']
+
+                    for name, fn in kernels.items():
+                        for mode in modes:
+                            key = '{}/{}/b{}/in{}/c{}'.format(name, mode, batch_size, input_size, num_classes)
+                            results[key] = benchmark_kernel(fn, mode, args.repeats)
+
+                            print('{}: median {:.3f} ms, p95 {:.3f} ms, {:.1f} MB allocated'.format(
+                                key, 1e3 * results[key]['median'], 1e3 * results[key]['p95'],
+                                results[key]['allocated_bytes'] / 2 ** 20))
+
+    if args.output is not None:
+        save_results(results, args.output, repeats=args.repeats)
+
+    if args.baseline is not None:
+        rows = compare(results, load_results(args.baseline), 'median', args.threshold, higher_is_better=False)
+        print_comparison(rows, 'median')
+
+        if any(regressed for *_, regressed in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    __main__()
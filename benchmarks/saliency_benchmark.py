@@ -0,0 +1,152 @@
+import argparse
+import sys
+import time
+import torch
+import torch.nn as nn
+from copy import deepcopy
+from benchmarks.common import SHAPES, summarize, save_results, load_results, compare, print_comparison
+from Models.BuildingBlocks import Classifier
+from Saliency import GuidedSaliency
+from utils.instrumentation import peak_rss, reset_peak_rss
+
+device = torch.device('cpu')
+
+
+class HookedGuidedSaliency(object):
+    """
+    Guided backpropagation as it was before the guided ReLU: the model is deepcopied, and every call registers
+    another forward and backward hook on each ReLU without removing them
+    """
+    def __init__(self, model, device):
+        self.model = deepcopy(model)
+        self.model.eval()
+        self.device = device
+        self.forward_relu_outputs = []
+
+    def relu_backward_hook_function(self, module, grad_in, grad_out):
+        corresponding_forward_output = self.forward_relu_outputs[-1]
+        positive_mask = (corresponding_forward_output > 0).type_as(corresponding_forward_output)
+        modified_grad_out = positive_mask * torch.clamp(grad_in[0], min=0.0)
+
+        del self.forward_relu_outputs[-1]
+        return (modified_grad_out,)
+
+    def relu_forward_hook_function(self, module, ten_in, ten_out):
+        self.forward_relu_outputs.append(ten_out)
+
+    def generate_saliency(self, input, target):
+        input.requires_grad = True
+
+        self.model.zero_grad()
+
+        for module in self.model.modules():
+            if type(module) == nn.ReLU:
+                module.register_forward_hook(self.relu_forward_hook_function)
+                module.register_backward_hook(self.relu_backward_hook_function)
+
+        output = self.model(input.to(self.device))
+
+        grad_outputs = torch.zeros_like(output)
+        grad_outputs[:, target] = 1
+
+        self.model.zero_grad()
+
+        output.backward(gradient=grad_outputs)
+
+        return input.grad.clone()[0]
+
+
+def sample_loop(saliency, data, targets):
+    """Calls generate_saliency once per sample. Returns the maps and the time of each call"""
+    maps = []
+    times = []
+
+    for i in range(data.size(0)):
+        start = time.perf_counter()
+        maps.append(saliency.generate_saliency(data[i:i + 1].clone(), targets[i].item()))
+        times.append(time.perf_counter() - start)
+
+    return torch.stack(maps), times
+
+
+def benchmark(name, run, num_samples):
+    reset_peak_rss()
+
+    start = time.perf_counter()
+    maps, times = run()
+    seconds = time.perf_counter() - start
+
+    result = {'samples_per_sec': num_samples / seconds, 'seconds': seconds, 'peak_rss_bytes': peak_rss()}
+
+    if times is not None:
+        result['first_100'] = summarize(times[:100])
+        result['last_100'] = summarize(times[-100:])
+
+    print('{}: {:.1f} samples/sec, {:.2f} s, peak RSS {:.0f} MB'.format(name, result['samples_per_sec'], seconds,
+                                                                       result['peak_rss_bytes'] / 2 ** 20))
+    if times is not None:
+        print('    median call time over the first 100 samples {:.3f} ms, over the last 100 {:.3f} ms'.format(
+            1e3 * result['first_100']['median'], 1e3 * result['last_100']['median']))
+
+    return result, maps
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Guided backpropagation over a loop of samples with the per-call '
+                                                 'hooks it used to register, against the guided ReLU, one sample at a '
+                                                 'time and batched')
+    parser.add_argument('--shape', type=str, choices=list(SHAPES), default='tcga', help='Dataset shape to imitate')
+    parser.add_argument('--num_samples', type=int, default=10000, help='Samples to compute the saliency of')
+    parser.add_argument('--input_size', type=int, default=None, help='Override the number of features')
+    parser.add_argument('--hidden_layers', type=int, nargs='+', default=[500, 500])
+    parser.add_argument('--skip_hooked', action='store_true',
+                        help='Skip the hooked implementation, whose loop slows down quadratically')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--output', type=str, default=None, help='JSON file to write the results to')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative drop in samples/sec that counts as a regression')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    _, input_size, num_classes, _ = SHAPES[args.shape]
+    input_size = args.input_size or input_size
+
+    torch.manual_seed(0)
+    model = Classifier(input_size, args.hidden_layers, num_classes).to(device)
+    data = torch.randn(args.num_samples, input_size)
+    targets = torch.randint(num_classes, (args.num_samples,))
+
+    results = {}
+    maps = {}
+
+    if not args.skip_hooked:
+        results['hooked/loop'], maps['hooked'] = benchmark(
+            'hooked/loop', lambda: sample_loop(HookedGuidedSaliency(model, device), data, targets), args.num_samples)
+
+    results['guided/loop'], maps['loop'] = benchmark(
+        'guided/loop', lambda: sample_loop(GuidedSaliency(model, device), data, targets), args.num_samples)
+
+    results['guided/batched'], maps['batched'] = benchmark(
+        'guided/batched', lambda: (GuidedSaliency(model, device).saliency(data, targets), None), args.num_samples)
+
+    for name in maps:
+        error = (maps[name] - maps['loop']).abs().max().item()
+        print('largest difference between {} and guided/loop: {:.2e}'.format(name, error))
+
+    if args.output is not None:
+        save_results(results, args.output, shape=args.shape, num_samples=args.num_samples, input_size=input_size,
+                     num_classes=num_classes, hidden_layers=args.hidden_layers)
+
+    if args.baseline is not None:
+        rows = compare(results, load_results(args.baseline), 'samples_per_sec', args.threshold)
+        print_comparison(rows, 'samples_per_sec')
+
+        if any(regressed for *_, regressed in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    __main__()
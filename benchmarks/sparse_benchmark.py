@@ -0,0 +1,83 @@
+import argparse
+import sys
+import torch
+from benchmarks.common import summarize, measure, save_results, load_results, compare, print_comparison
+from Models.BuildingBlocks import SparseInputLinear
+from utils.sparse import DENSITY_THRESHOLD
+
+
+def random_inputs(batch_size, input_size, density, generator):
+    x = torch.rand(batch_size, input_size, generator=generator)
+    x[torch.rand(batch_size, input_size, generator=generator) >= density] = 0
+
+    return x
+
+
+def step(layer, x):
+    """Forward and backward through the layer, as one training step sees it"""
+    def run():
+        layer.zero_grad()
+        layer(x).relu().sum().backward()
+
+    return run
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Dense against CSR inputs through the sparse first layer, forward and '
+                                                 'backward, over input densities')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[100, 200])
+    parser.add_argument('--input_sizes', type=int, nargs='+', default=[784, 20000])
+    parser.add_argument('--hidden_size', type=int, default=500)
+    parser.add_argument('--densities', type=float, nargs='+', default=[0.01, 0.05, 0.1, 0.2, 0.3, 0.5])
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--output', type=str, default=None, help='JSON file to write the results to')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative increase in median time that counts as a regression')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    generator = torch.Generator().manual_seed(0)
+
+    results = {}
+    for input_size in args.input_sizes:
+        layer = SparseInputLinear(input_size, args.hidden_size)
+
+        for batch_size in args.batch_sizes:
+            crossover = None
+
+            for density in sorted(args.densities):
+                x = random_inputs(batch_size, input_size, density, generator)
+
+                for layout, inputs in [('dense', x), ('csr', x.to_sparse_csr())]:
+                    key = '{}/b{}/in{}/d{}'.format(layout, batch_size, input_size, density)
+                    results[key] = summarize(measure(step(layer, inputs), args.repeats))
+
+                dense = results['dense/b{}/in{}/d{}'.format(batch_size, input_size, density)]['median']
+                csr = results['csr/b{}/in{}/d{}'.format(batch_size, input_size, density)]['median']
+
+                if csr < dense:
+                    crossover = density
+
+                print('b{} in{} density {:.2f}: dense {:.3f} ms, csr {:.3f} ms, {:.2f}x'.format(
+                    batch_size, input_size, density, 1e3 * dense, 1e3 * csr, dense / csr))
+
+            print('b{} in{}: csr is faster up to density {} (DENSITY_THRESHOLD is {})'.format(
+                batch_size, input_size, crossover, DENSITY_THRESHOLD))
+
+    if args.output is not None:
+        save_results(results, args.output, hidden_size=args.hidden_size, repeats=args.repeats)
+
+    if args.baseline is not None:
+        rows = compare(results, load_results(args.baseline), 'median', args.threshold, higher_is_better=False)
+        print_comparison(rows, 'median')
+
+        if any(regressed for *_, regressed in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    __main__()
@@ -0,0 +1,105 @@
+import argparse
+import sys
+import tempfile
+import torch
+from benchmarks.common import SHAPES, build_model, make_dataloaders, save_results, load_results, compare, \
+    print_comparison
+from utils.datautils import load_synthetic_data
+from utils.instrumentation import Instrumentation, peak_rss, reset_peak_rss
+from utils.storage import STORAGE_TYPES, UnlabelledDataset
+
+MODELS = ['m1', 'sdae', 'm2', 'ladder']
+device = torch.device('cpu')
+
+
+def round_trip_error(data, storage):
+    """Size of the unlabelled pool stored as storage, and the largest difference between a stored sample and data"""
+    pool = UnlabelledDataset(data, storage)
+
+    error = max((pool[torch.arange(i, min(i + 1000, len(pool)))] - data[i:i + 1000]).abs().max().item()
+                for i in range(0, len(pool), 1000))
+
+    return pool.nbytes, error
+
+
+def benchmark_model(model_name, storage, data, labels, num_classes, num_labelled, batch_size, epochs, state_path):
+    torch.manual_seed(0)
+    reset_peak_rss()
+
+    model = build_model(model_name, data.size(1), num_classes, device, state_path)
+    model.instrumentation = Instrumentation(enabled=True)
+
+    dataloaders = make_dataloaders(model_name, data, labels, num_labelled, batch_size, storage=storage)
+    model.train_model(epochs, dataloaders)
+
+    records = model.instrumentation.records
+
+    return {
+        'samples_per_sec': sum(r['samples'] for r in records) / sum(r['seconds'] for r in records),
+        'validation_accuracy': model.test_model(dataloaders[2]),
+        'peak_rss_bytes': peak_rss(),
+    }
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Memory, speed and accuracy of training with the unlabelled pool '
+                                                 'stored as float32, float16 or per-feature scaled uint8')
+    parser.add_argument('--shape', type=str, choices=list(SHAPES), default='tcga', help='Dataset shape to imitate')
+    parser.add_argument('--num_samples', type=int, default=5000, help='Override the number of samples')
+    parser.add_argument('--input_size', type=int, default=None, help='Override the number of features')
+    parser.add_argument('--label_fraction', type=float, default=0.1, help='Fraction of training samples labelled')
+    parser.add_argument('--models', type=str, nargs='+', choices=MODELS, default=['m2', 'ladder'])
+    parser.add_argument('--storage', type=str, nargs='+', choices=STORAGE_TYPES, default=STORAGE_TYPES)
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--epochs', type=int, default=3, help='Epochs per training stage')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--output', type=str, default=None, help='JSON file to write the results to')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative drop in samples/sec that counts as a regression')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    num_samples, input_size, num_classes, sparsity = SHAPES[args.shape]
+    num_samples = args.num_samples or num_samples
+    input_size = args.input_size or input_size
+
+    print('==Generating {} x {} synthetic data=='.format(num_samples, input_size))
+    (data, labels), _ = load_synthetic_data(num_samples, input_size, num_classes, sparsity)
+    num_labelled = max(num_classes + 1, int(args.label_fraction * num_samples))
+
+    results = {}
+    for storage in args.storage:
+        pool_bytes, error = round_trip_error(data, storage)
+        results['pool/{}'.format(storage)] = {'pool_bytes': pool_bytes, 'max_error': error}
+        print('{}: pool {:.1f} MB, largest error {:.2e}'.format(storage, pool_bytes / 2 ** 20, error))
+
+    with tempfile.TemporaryDirectory() as state_path:
+        for model_name in args.models:
+            for storage in args.storage:
+                key = '{}/{}'.format(model_name, storage)
+                results[key] = benchmark_model(model_name, storage, data, labels, num_classes, num_labelled,
+                                               args.batch_size, args.epochs, state_path)
+
+                print('{}: {:.1f} samples/sec, validation accuracy {:.4f}, peak RSS {:.0f} MB'.format(
+                    key, results[key]['samples_per_sec'], results[key]['validation_accuracy'],
+                    results[key]['peak_rss_bytes'] / 2 ** 20))
+
+    if args.output is not None:
+        save_results(results, args.output, shape=args.shape, num_samples=num_samples, input_size=input_size,
+                     num_classes=num_classes, num_labelled=num_labelled, batch_size=args.batch_size,
+                     epochs=args.epochs)
+
+    if args.baseline is not None:
+        timed = {key: result for key, result in results.items() if 'samples_per_sec' in result}
+        rows = compare(timed, load_results(args.baseline), 'samples_per_sec', args.threshold)
+        print_comparison(rows, 'samples_per_sec')
+
+        if any(regressed for *_, regressed in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    __main__()
@@ -0,0 +1,115 @@
+import argparse
+import sys
+import tempfile
+import torch
+from benchmarks.common import SHAPES, build_model, make_dataloaders, save_results, load_results, compare, \
+    print_comparison
+from utils.datautils import load_synthetic_data
+from utils.engine import TrainingEngine
+from utils.instrumentation import Instrumentation
+from utils.subsampling import feature_sampler
+
+MODELS = ['m1', 'm2']
+# the stage whose steps compute the reconstruction loss
+STAGES = {'m1': 'vae', 'm2': 'm2'}
+device = torch.device('cpu')
+
+
+def reconstruction_objective(model_name, model, validation_loader):
+    """The loss over all features on the validation data, whatever the model was trained with"""
+    if model_name == 'm1':
+        return model.unsupervised_validation_loss(validation_loader)
+
+    model.M2.eval()
+    data, _ = next(iter(validation_loader))
+
+    with torch.inference_mode():
+        return model.elbo(data.to(device)).item()
+
+
+def benchmark_model(model_name, sampling, num_features, data, labels, num_classes, num_labelled, batch_size, epochs,
+                    state_path):
+    torch.manual_seed(0)
+
+    model = build_model(model_name, data.size(1), num_classes, device, state_path)
+    model.engine = TrainingEngine(reconstruction_sampler=feature_sampler(sampling, data, num_features))
+    model.instrumentation = Instrumentation(enabled=True)
+
+    dataloaders = make_dataloaders(model_name, data, labels, num_labelled, batch_size)
+    model.train_model(epochs, dataloaders)
+
+    records = [r for r in model.instrumentation.records if r['stage'] == STAGES[model_name]]
+
+    return {
+        'samples_per_sec': sum(r['samples'] for r in records) / sum(r['seconds'] for r in records),
+        'reconstruction_objective': reconstruction_objective(model_name, model, dataloaders[2]),
+        'validation_accuracy': model.test_model(dataloaders[2]),
+    }
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Training speed against convergence of M1 and M2 when each step only '
+                                                 'reconstructs a random subset of the features')
+    parser.add_argument('--shape', type=str, choices=list(SHAPES), default='tcga', help='Dataset shape to imitate')
+    parser.add_argument('--num_samples', type=int, default=3000, help='Override the number of samples')
+    parser.add_argument('--input_size', type=int, default=None, help='Override the number of features')
+    parser.add_argument('--label_fraction', type=float, default=0.1, help='Fraction of training samples labelled')
+    parser.add_argument('--models', type=str, nargs='+', choices=MODELS, default=MODELS)
+    parser.add_argument('--features', type=int, nargs='+', default=[500, 2000, 5000],
+                        help='Features reconstructed per step, compared against reconstructing all of them')
+    parser.add_argument('--sampling', type=str, nargs='+', choices=['uniform', 'variance'],
+                        default=['uniform', 'variance'])
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--epochs', type=int, default=3, help='Epochs per training stage')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--output', type=str, default=None, help='JSON file to write the results to')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative drop in samples/sec that counts as a regression')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    num_samples, input_size, num_classes, sparsity = SHAPES[args.shape]
+    num_samples = args.num_samples or num_samples
+    input_size = args.input_size or input_size
+
+    print('==Generating {} x {} synthetic data=='.format(num_samples, input_size))
+    (data, labels), _ = load_synthetic_data(num_samples, input_size, num_classes, sparsity)
+    num_labelled = max(num_classes + 1, int(args.label_fraction * num_samples))
+
+    configurations = [('all', None)] + [(sampling, features) for sampling in args.sampling
+                                        for features in args.features]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as state_path:
+        for model_name in args.models:
+            for sampling, features in configurations:
+                key = '{}/{}'.format(model_name, sampling if features is None else
+                                     '{}_{}'.format(sampling, features))
+                results[key] = benchmark_model(model_name, sampling, features, data, labels, num_classes,
+                                               num_labelled, args.batch_size, args.epochs, state_path)
+
+                full = results['{}/all'.format(model_name)]
+                print('{}: {:.1f} samples/sec ({:.2f}x), reconstruction objective {:.2f}, validation accuracy '
+                      '{:.4f}'.format(key, results[key]['samples_per_sec'],
+                                      results[key]['samples_per_sec'] / full['samples_per_sec'],
+                                      results[key]['reconstruction_objective'],
+                                      results[key]['validation_accuracy']))
+
+    if args.output is not None:
+        save_results(results, args.output, shape=args.shape, num_samples=num_samples, input_size=input_size,
+                     num_classes=num_classes, num_labelled=num_labelled, batch_size=args.batch_size,
+                     epochs=args.epochs)
+
+    if args.baseline is not None:
+        rows = compare(results, load_results(args.baseline), 'samples_per_sec', args.threshold)
+        print_comparison(rows, 'samples_per_sec')
+
+        if any(regressed for *_, regressed in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    __main__()
@@ -0,0 +1,102 @@
+import argparse
+import sys
+import tempfile
+import torch
+from benchmarks.common import SHAPES, build_model, make_dataloaders, save_results, load_results, compare, \
+    print_comparison
+from utils.datautils import load_synthetic_data
+from utils.engine import TrainingEngine
+from utils.instrumentation import Instrumentation
+
+MODELS = ['simple', 'm1', 'sdae', 'm2', 'ladder']
+device = torch.device('cpu')
+
+
+def benchmark_model(model_name, data, labels, num_classes, num_labelled, batch_size, epochs, state_path, prefetch=0):
+    torch.manual_seed(0)
+
+    model = build_model(model_name, data.size(1), num_classes, device, state_path)
+    model.instrumentation = Instrumentation(enabled=True)
+    model.engine = TrainingEngine(prefetch=prefetch)
+
+    dataloaders = make_dataloaders(model_name, data, labels, num_labelled, batch_size)
+    model.train_model(epochs, dataloaders)
+
+    records = model.instrumentation.records
+    seconds = sum(r['seconds'] for r in records)
+    steps = sum(r['steps'] for r in records)
+    samples = sum(r['samples'] for r in records)
+
+    phase_seconds = {}
+    stage_samples_per_sec = {}
+    for r in records:
+        for phase, t in r['phase_seconds'].items():
+            phase_seconds[phase] = phase_seconds.get(phase, 0.) + t
+        stage_samples_per_sec[r['stage']] = r['samples_per_sec']
+
+    return {
+        'samples_per_sec': samples / seconds,
+        'steps_per_sec': steps / seconds,
+        'seconds_per_step': seconds / steps,
+        'seconds_per_epoch': seconds / len(records),
+        'phase_seconds': phase_seconds,
+        'stage_samples_per_sec': stage_samples_per_sec,
+        'peak_rss_bytes': max(r['peak_rss_bytes'] for r in records),
+    }
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='End-to-end training throughput benchmark on synthetic data')
+    parser.add_argument('--shape', type=str, choices=list(SHAPES), default='tcga', help='Dataset shape to imitate')
+    parser.add_argument('--num_samples', type=int, default=None, help='Override the number of samples')
+    parser.add_argument('--input_size', type=int, default=None, help='Override the number of features')
+    parser.add_argument('--label_fraction', type=float, default=0.1, help='Fraction of training samples labelled')
+    parser.add_argument('--models', type=str, nargs='+', choices=MODELS, default=MODELS)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[50, 100, 200])
+    parser.add_argument('--threads', type=int, nargs='+', default=[torch.get_num_threads()])
+    parser.add_argument('--epochs', type=int, default=1, help='Epochs per training stage')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='Batches to prepare ahead on a background thread, 0 prepares them inline')
+    parser.add_argument('--output', type=str, default=None, help='JSON file to write the results to')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative drop in samples/sec that counts as a regression')
+    args = parser.parse_args()
+
+    num_samples, input_size, num_classes, sparsity = SHAPES[args.shape]
+    num_samples = args.num_samples or num_samples
+    input_size = args.input_size or input_size
+
+    print('==Generating {} x {} synthetic data=='.format(num_samples, input_size))
+    (data, labels), _ = load_synthetic_data(num_samples, input_size, num_classes, sparsity)
+    num_labelled = max(num_classes + 1, int(args.label_fraction * num_samples))
+
+    results = {}
+    with tempfile.TemporaryDirectory() as state_path:
+        for threads in args.threads:
+            torch.set_num_threads(threads)
+
+            for model_name in args.models:
+                for batch_size in args.batch_sizes:
+                    key = '{}/batch_{}/threads_{}'.format(model_name, batch_size, threads)
+                    results[key] = benchmark_model(model_name, data, labels, num_classes, num_labelled, batch_size,
+                                                   args.epochs, state_path, args.prefetch)
+
+                    print('{}: {:.1f} samples/sec, {:.4f} s/step, {:.2f} s waiting for batches'.format(
+                        key, results[key]['samples_per_sec'], results[key]['seconds_per_step'],
+                        results[key]['phase_seconds'].get('batch', 0.)))
+
+    if args.output is not None:
+        save_results(results, args.output, shape=args.shape, num_samples=num_samples, input_size=input_size,
+                     num_classes=num_classes, num_labelled=num_labelled, epochs=args.epochs, prefetch=args.prefetch)
+
+    if args.baseline is not None:
+        rows = compare(results, load_results(args.baseline), 'samples_per_sec', args.threshold)
+        print_comparison(rows, 'samples_per_sec')
+
+        if any(regressed for *_, regressed in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    __main__()
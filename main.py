@@ -3,7 +3,12 @@ import pickle
 import argparse
 from utils.datautils import *
 from Models import *
-import torch.nn.functional as F
+from utils.profiling import Profiler, profile_classify
+from utils.inference import load_bundle, ensemble_classify
+from utils.instrumentation import memory_tracker
+from utils import distributed
+from utils.distributed import is_main_process, broadcast_value
+from utils.storage import STORAGE_TYPES
 import csv
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -13,42 +18,99 @@ parser.add_argument('data_filepath', type=str, help='File to load data from')
 parser.add_argument('output_folder', type=str, help='Folder to save outputs to')
 parser.add_argument('--classification_file', type=str, default='outputs.csv', help='File to save classification '
                                                                                    'results to')
+parser.add_argument('--profile', default=False, action='store_true',
+                    help='Capture a torch.profiler trace of a window of training steps (train) or of classification '
+                         '(classify)')
+parser.add_argument('--profile_warmup', type=int, default=10, help='Training steps to run before profiling')
+parser.add_argument('--profile_steps', type=int, default=5, help='Training steps to profile')
+parser.add_argument('--memory_report', default=False, action='store_true',
+                    help='Track peak RSS and tensor allocations per model and phase, printing a breakdown and writing '
+                         'it to memory_<mode>.json in the output folder')
+parser.add_argument('--distributed', default=False, action='store_true',
+                    help='Train data-parallel across the processes of a torchrun launch, e.g. torchrun --standalone '
+                         '--nproc_per_node 4 main.py train ... --distributed')
+parser.add_argument('--threads', type=int, default=None,
+                    help='Threads per process with --distributed, defaults to the cores split between the processes')
+parser.add_argument('--unlabelled_storage', type=str, choices=STORAGE_TYPES, default='float32',
+                    help='Store the unlabelled training data as float32, float16 or per-feature scaled uint8')
 args = parser.parse_args()
 
+if args.memory_report and args.profile:
+    parser.error('--memory_report cannot be combined with --profile')
+if args.distributed and args.mode != 'train':
+    parser.error('--distributed only applies to train')
+
+if args.distributed:
+    distributed.init(args.threads)
+
+# only rank 0 asks questions and writes outputs, the other processes train the same models
+main_process = is_main_process()
+if not main_process:
+    args.profile = False
+    args.memory_report = False
+
 mode = args.mode
 output_folder = args.output_folder
 
-if not os.path.exists(output_folder):
+if main_process and not os.path.exists(output_folder):
     print('{} does not exist - making directories'.format(output_folder))
     os.makedirs(output_folder)
 
 state_path = '{}/state'.format(output_folder)
+profile_path = '{}/profile'.format(output_folder)
 
-if mode == 'train':
-    if not os.path.exists(state_path):
-        os.mkdir(state_path)
-    else:
-        print('WARNING: Possibly overriding previous data in {}'.format(output_folder))
-        press = input('Press Enter to continue, or \'e\' followed by Enter to exit:')
+if args.memory_report:
+    memory_tracker.model = 'data'
+    memory_tracker.start()
 
-        if press == 'e':
-            sys.exit()
+if mode == 'train':
+    press = None
+    if main_process:
+        if not os.path.exists(state_path):
+            os.mkdir(state_path)
+        else:
+            print('WARNING: Possibly overriding previous data in {}'.format(output_folder))
+            press = input('Press Enter to continue, or \'e\' followed by Enter to exit:')
+
+    # rank 0's answer, so that every process exits or carries on together
+    if broadcast_value(press) == 'e':
+        sys.exit()
 
     print('==Loading Data==')
 
-    (labelled_data, labels), unlabelled_data, label_map, col_means = load_train_data_from_file(args.data_filepath)
+    with memory_tracker.phase('data load'):
+        (labelled_data, labels), unlabelled_data, label_map, col_means = load_train_data_from_file(args.data_filepath)
 
     train_val_fold = list(stratified_k_fold(labelled_data, labels, 2))
 
+    m2_profiler = None
+    ladder_profiler = None
+    if args.profile:
+        m2_profiler = Profiler(profile_path, 'm2', 'train', args.profile_warmup, args.profile_steps)
+        ladder_profiler = Profiler(profile_path, 'ladder', 'train', args.profile_warmup, args.profile_steps)
+
     print("==M2 optimisation==")
 
+    memory_tracker.model = 'm2'
+
     m2, m2_normalizer, m2_accuracies = m2_tool_loop(train_val_fold, labelled_data, labels, unlabelled_data, output_folder,
-                                                    device)
+                                                    device, m2_profiler, args.unlabelled_storage)
 
     print("==Ladder optimisation==")
 
+    memory_tracker.model = 'ladder'
+
     ladder, ladder_normalizer, ladder_accuracies = ladder_tool_loop(train_val_fold, labelled_data, labels, unlabelled_data,
-                                                                    output_folder, device)
+                                                                    output_folder, device, ladder_profiler,
+                                                                    args.unlabelled_storage)
+
+    for profiler in [m2_profiler, ladder_profiler]:
+        if profiler is not None:
+            profiler.close()
+
+    if not main_process:
+        distributed.shutdown()
+        sys.exit()
 
     print('==Saving State==')
 
@@ -88,29 +150,20 @@ if mode == 'classify':
 
     print('==Loading Data==')
 
-    col_means = pickle.load(open('{}/imputation_means.p'.format(state_path), 'rb'))
-    int_string_map = pickle.load(open('{}/label_map.p'.format(state_path), 'rb'))
-    sample_names, data = load_data_to_classify_from_file(args.data_filepath, col_means)
-
-    if device.type == 'cpu':
-        m2 = torch.load('{}/m2.pt'.format(state_path), map_location='cpu')
-        ladder = torch.load('{}/ladder.pt'.format(state_path), map_location='cpu')
-    else:
-        m2 = torch.load('{}/m2.pt'.format(state_path))
-        ladder = torch.load('{}/ladder.pt'.format(state_path))
+    bundle = load_bundle(state_path, device)
+    int_string_map = bundle['label_map']
+    with memory_tracker.phase('data load'):
+        sample_names, data = load_data_to_classify_from_file(args.data_filepath, bundle['imputation_means'])
 
     print('==Classifying==')
 
-    m2_normalizer = pickle.load(open('{}/m2_normalizer.p'.format(state_path), 'rb'))
-    ladder_normalizer = pickle.load(open('{}/ladder_normalizer.p'.format(state_path), 'rb'))
+    profiler = Profiler(profile_path, 'ensemble', 'classify') if args.profile else None
 
-    m2_data = torch.tensor(m2_normalizer.transform(data)).float()
-    m2_results = m2.classify(data)
+    memory_tracker.model = 'ensemble'
 
-    ladder_data = torch.tensor(ladder_normalizer.transform(data)).float()
-    ladder_results = ladder.classify(data)
-
-    predictions = (F.softmax(m2_results, dim=1) + F.softmax(ladder_results, dim=1))/2
+    with profile_classify(profiler), memory_tracker.phase('classify'):
+        predictions = ensemble_classify(bundle['m2'], bundle['m2_normalizer'], bundle['ladder'],
+                                        bundle['ladder_normalizer'], data)
 
     _, predictions = torch.max(predictions.data, 1)
 
@@ -126,3 +179,9 @@ if mode == 'classify':
 
     file.close()
 
+if args.memory_report:
+    memory_tracker.stop()
+    print(memory_tracker.table())
+    memory_tracker.dump('{}/memory_{}.json'.format(output_folder, mode), mode=mode)
+
+distributed.shutdown()
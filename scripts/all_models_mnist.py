@@ -1,8 +1,23 @@
 from utils.datautils import *
 from torch.utils.data import DataLoader
 from Models import *
+from utils.trainingutils import TimeBudget, EvaluationSchedule
+from utils.profiling import Profiler
+from utils.instrumentation import memory_tracker
+from utils.shared_data import attach
+from utils.engine import TrainingEngine
+from utils.compilation import COMPILE_CACHE, enable_compile_cache
+from utils import distributed
+from utils.distributed import is_main_process, train_loader
+from utils.sparse import DENSITY_THRESHOLD, density, training_dataset
+from utils.subsampling import feature_sampler
+from utils.tuning import TUNING_FILE, tuned_batch_size
+from utils.storage import STORAGE_TYPES, unlabelled_dataset
 import argparse
 import pickle
+import time
+
+start_time = time.time()
 
 model_func_dict = {
     'simple': simple_hyperparameter_loop,
@@ -18,8 +33,62 @@ parser.add_argument('model', type=str, choices=['simple', 'm1', 'sdae', 'm2', 'l
 parser.add_argument('num_labelled', type=int, help='Number of labelled examples to use')
 parser.add_argument('num_folds', type=int, help='Number of folds')
 parser.add_argument('fold', type=int, help='Fold to run')
+parser.add_argument('--output_path', type=str, default='./outputs', help='Folder to write results and state to')
+parser.add_argument('--shared_data', type=str, default=None,
+                    help='Attach to data published by scripts/publish_data.py under this prefix instead of loading it')
+parser.add_argument('--time_budget', type=float, default=None,
+                    help='Wall-clock budget for the job in hours, epochs are capped to finish within it')
+parser.add_argument('--eval_every', type=int, default=1, help='Run validation every this many epochs')
+parser.add_argument('--eval_plateau', type=float, default=None,
+                    help='Only start validating once the relative change in training loss drops below this')
+parser.add_argument('--instrument', default=False, action='store_true',
+                    help='Record per-epoch phase timings, throughput and peak RSS to a JSON lines file')
+parser.add_argument('--profile', type=str, choices=['train', 'classify'], default=None,
+                    help='Capture a torch.profiler trace of a window of training steps or of the test set classify')
+parser.add_argument('--profile_warmup', type=int, default=10, help='Training steps to run before profiling')
+parser.add_argument('--profile_steps', type=int, default=5, help='Training steps to profile')
+parser.add_argument('--memory_report', default=False, action='store_true',
+                    help='Track peak RSS and tensor allocations per model and phase, printing a breakdown and writing '
+                         'it to JSON')
+parser.add_argument('--precision', type=str, choices=['fp32', 'bf16'], default='fp32',
+                    help='Run the forward pass and loss under bfloat16 autocast')
+parser.add_argument('--accumulation_steps', type=int, default=1,
+                    help='Batches whose gradients are summed before each optimizer step')
+parser.add_argument('--compile', default=False, action='store_true',
+                    help='torch.compile the training losses and the classify forward passes, running eagerly if '
+                         'compilation fails')
+parser.add_argument('--compile_cache', type=str, default=COMPILE_CACHE,
+                    help='Folder compiled graphs are cached in, shared by all sweep processes')
+parser.add_argument('--distributed', default=False, action='store_true',
+                    help='Train data-parallel across the processes of a torchrun launch, e.g. torchrun --standalone '
+                         '--nproc_per_node 4 -m scripts.all_models_mnist ... --distributed')
+parser.add_argument('--threads', type=int, default=None,
+                    help='Intra-op threads per process. Default: with --distributed the cores split between the '
+                         'processes, otherwise the tuned thread count')
+parser.add_argument('--sparse_inputs', default=False, action='store_true',
+                    help='Keep the training data in CSR form, with sparse first layers, if its density is below '
+                         '--sparse_threshold')
+parser.add_argument('--sparse_threshold', type=float, default=DENSITY_THRESHOLD,
+                    help='Fraction of non-zero inputs below which --sparse_inputs switches to sparse data')
+parser.add_argument('--reconstruction_features', type=int, default=None,
+                    help='Features M1 and M2 reconstruct per training step, rescaled to an unbiased estimate of the '
+                         'loss over all of them. Default: all features')
+parser.add_argument('--reconstruction_sampling', type=str, choices=['uniform', 'variance'], default='uniform',
+                    help='Draw the reconstructed features uniformly, or in proportion to their standard deviation')
+parser.add_argument('--batch_size', type=int, default=None,
+                    help='Batch size of the training loaders. Default: the one scripts/tune.py saved for the model '
+                         'and input shape, or 100')
+parser.add_argument('--tuning_file', type=str, default=TUNING_FILE, help='Settings saved by scripts/tune.py')
+parser.add_argument('--prefetch', type=int, default=0,
+                    help='Training batches to prepare ahead on a background thread, 0 prepares them inline')
+parser.add_argument('--unlabelled_storage', type=str, choices=STORAGE_TYPES, default='float32',
+                    help='Store the unlabelled pool as float32, float16 or per-feature scaled uint8, converting each '
+                         'batch to float32')
 args = parser.parse_args()
 
+if args.memory_report and args.profile is not None:
+    parser.error('--memory_report cannot be combined with --profile')
+
 model_name = args.model
 model_func = model_func_dict[model_name]
 fold_i = args.fold
@@ -28,24 +97,42 @@ num_labelled = args.num_labelled
 num_folds = args.num_folds
 max_epochs = 100
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-output_path = './outputs'
+output_path = args.output_path
 results_path = '{}/{}/{}/results'.format(output_path, dataset_name, model_name)
 state_path = '{}/{}/{}/state'.format(output_path, dataset_name, model_name)
 
-if not os.path.exists(output_path):
-    os.mkdir(output_path)
-if not os.path.exists('{}/{}'.format(output_path, dataset_name)):
-    os.mkdir('{}/{}'.format(output_path, dataset_name))
-if not os.path.exists('{}/{}/{}'.format(output_path, dataset_name, model_name)):
-    os.mkdir('{}/{}/{}'.format(output_path, dataset_name, model_name))
-if not os.path.exists(results_path):
-    os.mkdir(results_path)
-if not os.path.exists(state_path):
-    os.mkdir(state_path)
+if args.distributed:
+    distributed.init(args.threads)
+elif args.threads is not None:
+    torch.set_num_threads(args.threads)
+
+os.makedirs(results_path, exist_ok=True)
+os.makedirs(state_path, exist_ok=True)
+
+# only rank 0 writes results, timings, traces and memory reports, the other processes train the same models
+main_process = is_main_process()
+args.instrument = args.instrument and main_process
+args.memory_report = args.memory_report and main_process
+if not main_process:
+    args.profile = None
+
+if args.memory_report:
+    memory_tracker.model = model_name
+    memory_tracker.start()
 
 print('===Loading Data===')
-(train_and_val_data, train_and_val_labels), (test_data, test_labels) = load_MNIST_data()
-folds, label_indices = pickle.load(open('./data/MNIST/{}_labelled_{}_folds.p'.format(num_labelled, num_folds), 'rb'))
+with memory_tracker.phase('data load'):
+    if args.shared_data is not None:
+        shared_tensors, shared_objects = attach(args.shared_data)
+        train_and_val_data, train_and_val_labels = shared_tensors['train_data'], shared_tensors['train_labels']
+        test_data, test_labels = shared_tensors['test_data'], shared_tensors['test_labels']
+    else:
+        (train_and_val_data, train_and_val_labels), (test_data, test_labels) = load_MNIST_data()
+if args.shared_data is not None:
+    folds, label_indices = shared_objects['folds_{}_{}'.format(num_labelled, num_folds)]
+else:
+    folds, label_indices = pickle.load(open('./data/MNIST/{}_labelled_{}_folds.p'.format(num_labelled, num_folds),
+                                            'rb'))
 t_d = TensorDataset(test_data, test_labels)
 
 results_dict = {}
@@ -57,30 +144,72 @@ print('Validation Fold {}'.format(fold_i))
 train_data = train_and_val_data[train_indices]
 train_labels = train_and_val_labels[train_indices]
 
-s_d = TensorDataset(train_data[labelled_indices], train_labels[labelled_indices])
-u_d = TensorDataset(train_data, -1 * torch.ones(train_labels.size(0)))
+make_dataset = TensorDataset
+sparse_threshold = None
+if args.sparse_inputs:
+    print('Training data density {:.3f}'.format(density(train_data)))
+    make_dataset = lambda d, l: training_dataset(d, l, args.sparse_threshold)
+    sparse_threshold = args.sparse_threshold
+
+s_d = make_dataset(train_data[labelled_indices], train_labels[labelled_indices])
 v_d = TensorDataset(train_and_val_data[val_indices], train_and_val_labels[val_indices])
 
-u_dl = DataLoader(u_d, batch_size=100, shuffle=True)
-s_dl = DataLoader(s_d, batch_size=100, shuffle=True)
+# tuned thread counts were measured in one process, data-parallel runs split the cores between the processes instead
+batch_size = tuned_batch_size(model_name, 784, 10, not args.distributed and args.threads is None,
+                              args.tuning_file)
+if args.batch_size is not None:
+    batch_size = args.batch_size
+
+s_dl = train_loader(s_d, batch_size)
 v_dl = DataLoader(v_d, batch_size=v_d.__len__())
 t_dl = DataLoader(t_d, batch_size=t_d.__len__())
 
+# M2 only sees the unlabelled part of the training data as unlabelled, the other models see all of it
+unlabelled_rows = None
 if model_name == 'm2':
-    unlabelled_ind = list(set(range(len(train_data))) - set(labelled_indices))
-    unlabelled_data = train_data[unlabelled_ind]
-    if len(unlabelled_data) == 0:
-        u_d = None
-        u_dl = None
-    else:
-        u_d = TensorDataset(unlabelled_data, -1 * torch.ones(unlabelled_data.size(0)))
-        u_dl = DataLoader(u_d, batch_size=100, shuffle=True)
+    unlabelled_rows = sorted(set(range(len(train_data))) - set(labelled_indices))
+
+if unlabelled_rows is not None and len(unlabelled_rows) == 0:
+    u_d = None
+    u_dl = None
+else:
+    u_d = unlabelled_dataset(train_data, args.unlabelled_storage, sparse_threshold, unlabelled_rows)
+    u_dl = train_loader(u_d, batch_size)
 
 dataloaders = (u_dl, s_dl, v_dl, t_dl)
 
-model_name, result, _ = model_func(fold_i, 0, state_path, results_path, dataloaders, 784, 10, max_epochs, device)
+evaluation_schedule = EvaluationSchedule(args.eval_every, args.eval_plateau)
+if args.compile:
+    enable_compile_cache(args.compile_cache)
+engine = TrainingEngine(args.precision, args.accumulation_steps, args.compile,
+                        feature_sampler(args.reconstruction_sampling, train_data, args.reconstruction_features),
+                        args.prefetch)
+
+profiler = None
+if args.profile is not None:
+    profiler = Profiler('{}/profile'.format(results_path), '{}_{}'.format(fold_i, num_labelled), args.profile,
+                        args.profile_warmup, args.profile_steps)
+
+budget = None
+if args.time_budget is not None:
+    budget = TimeBudget(args.time_budget * 3600, start_time=start_time)
+
+model_name, result, _ = model_func(fold_i, 0, state_path, results_path, dataloaders, 784, 10, max_epochs, device,
+                                   budget, evaluation_schedule, args.instrument, profiler, engine)
 
 results_dict[model_name] = result
 
-print('===Saving Results===')
-pickle.dump(results_dict, open('{}/{}_{}_test_results.p'.format(results_path, fold_i, num_labelled), 'wb'))
+if profiler is not None:
+    profiler.close()
+
+if main_process:
+    print('===Saving Results===')
+    pickle.dump(results_dict, open('{}/{}_{}_test_results.p'.format(results_path, fold_i, num_labelled), 'wb'))
+
+if args.memory_report:
+    memory_tracker.stop()
+    print(memory_tracker.table())
+    memory_tracker.dump('{}/{}_{}_memory.json'.format(results_path, fold_i, num_labelled), fold=fold_i,
+                        num_labelled=num_labelled)
+
+distributed.shutdown()
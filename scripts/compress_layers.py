@@ -0,0 +1,103 @@
+import argparse
+import os
+import shutil
+import time
+import torch
+from statistics import median
+from utils.compression import compress_linear_layers, compress_ladder, parameter_count
+from utils.datautils import load_train_data_from_file
+from utils.inference import load_bundle, ensemble_classify
+
+parser = argparse.ArgumentParser(description='Compress the wide layers of a model trained with main.py train by '
+                                             'truncated SVD, and report the effect on size, speed and accuracy')
+parser.add_argument('output_folder', type=str, help='Output folder of main.py train')
+parser.add_argument('compressed_folder', type=str, help='Folder to save the compressed models to, usable as the '
+                                                        'output folder of main.py classify')
+parser.add_argument('--rank', type=int, default=64, help='Rank of the factorized layers')
+parser.add_argument('--min_features', type=int, default=1000,
+                    help='Only layers with at least this many inputs or outputs are compressed')
+parser.add_argument('--data_filepath', type=str, default=None,
+                    help='Data in the format of main.py train. Accuracy is measured on its labelled samples, and '
+                         'agreement and speed on all of them. Without it speed is measured on random inputs')
+parser.add_argument('--batch_size', type=int, default=1000, help='Batch size of the random inputs')
+parser.add_argument('--repeats', type=int, default=10)
+args = parser.parse_args()
+
+device = torch.device('cpu')
+state_path = '{}/state'.format(args.output_folder)
+compressed_path = '{}/state'.format(args.compressed_folder)
+
+if not os.path.exists(compressed_path):
+    os.makedirs(compressed_path)
+
+print('==Loading Models==')
+
+bundle = load_bundle(state_path, device)
+num_features = len(bundle['imputation_means'])
+
+labels = None
+if args.data_filepath is not None:
+    (labelled_data, file_labels), unlabelled_data, file_label_map, _ = load_train_data_from_file(args.data_filepath)
+    data = torch.cat((labelled_data, unlabelled_data), 0)
+
+    # the file numbers its labels in its own order, the models in that of their training data
+    string_int_map = {v: k for k, v in bundle['label_map'].items()}
+    labels = torch.tensor([string_int_map[file_label_map[l]] for l in file_labels.tolist()])
+else:
+    data = torch.rand(args.batch_size, num_features)
+
+
+def classify():
+    return ensemble_classify(bundle['m2'], bundle['m2_normalizer'], bundle['ladder'], bundle['ladder_normalizer'],
+                             data)
+
+
+def evaluate():
+    classify()  # warm up
+
+    times = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        probabilities = classify()
+        times.append(time.perf_counter() - start)
+
+    predictions = probabilities.argmax(dim=1)
+    parameters = parameter_count(bundle['m2'].M2) + parameter_count(bundle['ladder'].ladder)
+    accuracy = None
+    if labels is not None:
+        accuracy = (predictions[:labels.size(0)] == labels).float().mean().item()
+
+    return {'parameters': parameters, 'seconds': median(times), 'accuracy': accuracy, 'predictions': predictions}
+
+
+before = evaluate()
+
+print('==Compressing==')
+
+errors = [('m2.' + name, error) for name, error in compress_linear_layers(bundle['m2'].M2, args.rank,
+                                                                          args.min_features)]
+errors += [('ladder.' + name, error) for name, error in compress_ladder(bundle['ladder'].ladder, args.rank)]
+
+for name, error in errors:
+    print('{:<40} relative error {:.4f}'.format(name, error))
+
+after = evaluate()
+
+print('==Results==')
+
+print('parameters: {} -> {} ({:.1f}%)'.format(before['parameters'], after['parameters'],
+                                              100 * after['parameters'] / before['parameters']))
+print('classify time on {} samples: {:.2f} ms -> {:.2f} ms ({:.2f}x)'.format(
+    data.size(0), 1e3 * before['seconds'], 1e3 * after['seconds'], before['seconds'] / after['seconds']))
+if labels is not None:
+    print('accuracy: {:.4f} -> {:.4f}'.format(before['accuracy'], after['accuracy']))
+    print('agreement with the uncompressed predictions: {:.4f}'.format(
+        (before['predictions'] == after['predictions']).float().mean().item()))
+
+print('==Saving State==')
+
+torch.save(bundle['m2'], '{}/m2.pt'.format(compressed_path))
+torch.save(bundle['ladder'], '{}/ladder.pt'.format(compressed_path))
+
+for name in ['m2_normalizer', 'ladder_normalizer', 'imputation_means', 'label_map']:
+    shutil.copy('{}/{}.p'.format(state_path, name), compressed_path)
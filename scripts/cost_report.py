@@ -0,0 +1,40 @@
+import argparse
+import json
+from utils.costmodel import grid_costs, task_cost
+
+parser = argparse.ArgumentParser(description='Static cost of every configuration in the model grids: parameters, '
+                                             'FLOPs per sample and activation memory, without allocating anything')
+parser.add_argument('--models', type=str, nargs='+', choices=['simple', 'm1', 'sdae', 'm2', 'ladder'],
+                    default=['simple', 'm1', 'sdae', 'm2', 'ladder'])
+parser.add_argument('--input_size', type=int, default=20000, help='Number of features')
+parser.add_argument('--num_classes', type=int, default=33)
+parser.add_argument('--batch_size', type=int, default=100)
+parser.add_argument('--num_train', type=int, default=8000, help='Training samples, for the per-epoch totals')
+parser.add_argument('--num_labelled', type=int, default=1000, help='Labelled training samples')
+parser.add_argument('--output', type=str, default=None, help='JSON file to write the costs to')
+args = parser.parse_args()
+
+report = {}
+
+print('{:<8} {:<10} {:>12} {:>16} {:>18} {:>15} {:>17} {:>17}'.format(
+    'model', 'config', 'parameters', 'GFLOP/labelled', 'GFLOP/unlabelled', 'GFLOP/classify', 'activations (MB)',
+    'training (MB)'))
+
+for model_name in args.models:
+    costs = grid_costs(model_name, args.input_size, args.num_classes, args.batch_size)
+
+    for config, cost in costs.items():
+        print('{:<8} {:<10} {:>12} {:>16.4f} {:>18.4f} {:>15.4f} {:>17.1f} {:>17.1f}'.format(
+            model_name, config, cost['parameters'], cost['labelled_flops'] / 1e9, cost['unlabelled_flops'] / 1e9,
+            cost['classify_flops'] / 1e9, cost['activation_bytes'] / 2 ** 20, cost['training_bytes'] / 2 ** 20))
+
+    task = task_cost(model_name, args.input_size, args.num_classes, args.num_train, args.num_labelled, costs=costs)
+    print('{:<8} {:<10} peak {:.1f} MB, {:.1f} TFLOP per epoch of the whole grid'.format(
+        model_name, 'task', task['peak_training_bytes'] / 2 ** 20, task['flops_per_epoch'] / 1e12))
+
+    report[model_name] = {'configurations': costs, 'task': task}
+
+if args.output is not None:
+    with open(args.output, 'w') as f:
+        json.dump({'input_size': args.input_size, 'num_classes': args.num_classes, 'batch_size': args.batch_size,
+                   'num_train': args.num_train, 'num_labelled': args.num_labelled, 'models': report}, f, indent=2)
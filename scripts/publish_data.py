@@ -0,0 +1,58 @@
+import argparse
+import pickle
+import signal
+from utils.datautils import *
+from utils.shared_data import SharedData, dataset_prefix
+
+parser = argparse.ArgumentParser(description='Loads a dataset and its fold indices once and publishes them in shared '
+                                             'memory for the sweep scripts to attach to with --shared_data. Runs '
+                                             'until interrupted or terminated, then removes the shared memory.')
+parser.add_argument('dataset', type=str, choices=['tcga', 'mnist'])
+parser.add_argument('--num_labelled', type=int, nargs='+', default=[100, 500, 1000, 100000],
+                    help='Label counts whose fold indices to publish')
+parser.add_argument('--num_folds', type=int, default=5)
+parser.add_argument('--imputation_type', type=str, choices=[i.name.lower() for i in ImputationType],
+                    default='drop_samples')
+parser.add_argument('--prefix', type=str, default=None, help='Shared memory name prefix, defaults to one derived '
+                                                              'from the dataset (and imputation for TCGA)')
+args = parser.parse_args()
+
+objects = {}
+
+if args.dataset == 'tcga':
+    imputation_type = ImputationType[args.imputation_type.upper()]
+    prefix = args.prefix or dataset_prefix('tcga', args.imputation_type)
+
+    (data, labels), (input_size, num_classes) = load_tcga_data(imputation_type)
+    arrays = {'data': data, 'labels': labels}
+    objects['shape'] = (input_size, num_classes)
+
+    str_drop = 'drop_samples' if imputation_type == ImputationType.DROP_SAMPLES else 'no_drop'
+    for n in args.num_labelled:
+        objects['folds_{}_{}'.format(n, args.num_folds)] = \
+            pickle.load(open('./data/tcga/{}_labelled_{}_folds_{}.p'.format(n, args.num_folds, str_drop), 'rb'))
+else:
+    prefix = args.prefix or dataset_prefix('mnist')
+
+    (train_and_val_data, train_and_val_labels), (test_data, test_labels) = load_MNIST_data()
+    arrays = {'train_data': train_and_val_data, 'train_labels': train_and_val_labels, 'test_data': test_data,
+              'test_labels': test_labels}
+
+    for n in args.num_labelled:
+        objects['folds_{}_{}'.format(n, args.num_folds)] = \
+            pickle.load(open('./data/MNIST/{}_labelled_{}_folds.p'.format(n, args.num_folds), 'rb'))
+
+shared = SharedData(prefix)
+
+# exit through the finally block on SIGTERM as well as Ctrl-C, so the shared memory is always removed
+signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+try:
+    shared.publish(arrays, objects)
+    print('ready {}'.format(prefix), flush=True)
+
+    signal.pause()
+except KeyboardInterrupt:
+    pass
+finally:
+    shared.close()
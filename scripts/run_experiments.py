@@ -0,0 +1,355 @@
+import argparse
+import math
+import os
+import pickle
+import shlex
+import subprocess
+import sys
+import time
+import torch
+from utils.costmodel import task_cost
+from utils.shared_data import dataset_prefix
+from utils.storage import NORMALIZED_DTYPE
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (samples, features, classes) of each dataset, for estimating task sizes
+DATASETS = {
+    'tcga': (10000, 20000, 33),
+    'mnist': (60000, 784, 10),
+}
+# a sweep process holds the loaded float32 matrix, unless it is attached from shared memory, and a normalized copy
+LOADED_BYTES_PER_VALUE = torch.finfo(torch.float32).bits // 8
+NORMALIZED_BYTES_PER_VALUE = torch.finfo(NORMALIZED_DTYPE).bits // 8
+
+
+class Task:
+    """One run of all_models_tcga.py or all_models_mnist.py, i.e. the full grid of one model on one fold"""
+    def __init__(self, dataset, model, num_labelled, fold, num_folds, output_path, scaler=None, imputation=None):
+        self.dataset = dataset
+        self.model = model
+        self.num_labelled = num_labelled
+        self.fold = fold
+        self.num_folds = num_folds
+        self.scaler = scaler
+        self.imputation = imputation
+
+        # results and saved state are not keyed by scaler or imputation, so each combination gets its own folder
+        if dataset == 'tcga':
+            self.output_path = '{}/{}_{}'.format(output_path, scaler, imputation)
+        else:
+            self.output_path = output_path
+
+        self.shared_data = None
+        self.memory = 0
+        self.flops = 0
+        self.attempts = 0
+        self.process = None
+        self.log = None
+        self.start_time = None
+
+    @property
+    def name(self):
+        parts = [self.dataset, self.model, self.num_labelled, self.fold]
+        if self.dataset == 'tcga':
+            parts += [self.scaler, self.imputation]
+
+        return '_'.join(str(p) for p in parts)
+
+    def command(self, python, extra_args):
+        if self.dataset == 'tcga':
+            args = ['-m', 'scripts.all_models_tcga', self.model, str(self.num_labelled), str(self.num_folds),
+                    str(self.fold), self.scaler, '--imputation_type', self.imputation]
+        else:
+            args = ['-m', 'scripts.all_models_mnist', self.model, str(self.num_labelled), str(self.num_folds),
+                    str(self.fold)]
+
+        if self.shared_data is not None:
+            args += ['--shared_data', self.shared_data]
+
+        return [python] + args + ['--output_path', self.output_path] + extra_args
+
+    def results_file(self):
+        results_path = os.path.join(root, '{}/{}/{}/results'.format(self.output_path, self.dataset, self.model))
+
+        if self.dataset == 'tcga':
+            return '{}/{}_{}_{}_test_results.p'.format(results_path, self.fold, self.imputation.upper(),
+                                                        self.num_labelled)
+
+        return '{}/{}_{}_test_results.p'.format(results_path, self.fold, self.num_labelled)
+
+    def expected_results(self):
+        """Number of validation/test splits the task saves a result for"""
+        if self.dataset == 'mnist':
+            return 1
+
+        str_drop = 'drop_samples' if self.imputation == 'drop_samples' else 'no_drop'
+        folds_file = '{}/data/tcga/{}_labelled_{}_folds_{}.p'.format(root, self.num_labelled, self.num_folds, str_drop)
+        _, _, val_test_split = pickle.load(open(folds_file, 'rb'))
+
+        return len(val_test_split[self.fold])
+
+    def done(self):
+        # the TCGA script writes its results file before training and adds to it after each split
+        if not os.path.exists(self.results_file()):
+            return False
+
+        results = pickle.load(open(self.results_file(), 'rb'))
+
+        return len(results) >= self.expected_results()
+
+
+def build_tasks(args):
+    tasks = []
+
+    for model in args.models:
+        for num_labelled in args.num_labelled:
+            for fold in args.folds:
+                if args.dataset == 'tcga':
+                    for scaler in args.scalers:
+                        for imputation in args.imputations:
+                            tasks.append(Task('tcga', model, num_labelled, fold, args.num_folds, args.output_path,
+                                              scaler, imputation))
+                else:
+                    tasks.append(Task('mnist', model, num_labelled, fold, args.num_folds, args.output_path))
+
+    return tasks
+
+
+def estimate(tasks, dataset, memory_per_task, shared_data):
+    """Fills in the memory and FLOPs of each task from the data size and the static cost model"""
+    num_samples, input_size, num_classes = DATASETS[dataset]
+    bytes_per_value = NORMALIZED_BYTES_PER_VALUE if shared_data else LOADED_BYTES_PER_VALUE + NORMALIZED_BYTES_PER_VALUE
+    data_bytes = bytes_per_value * num_samples * input_size
+    costs = {}
+
+    for task in tasks:
+        num_train = num_samples - num_samples // task.num_folds
+        key = (task.model, task.num_labelled)
+
+        if key not in costs:
+            costs[key] = task_cost(task.model, input_size, num_classes, num_train, min(task.num_labelled, num_train))
+
+        task.flops = costs[key]['flops_per_epoch']
+        task.memory = memory_per_task if memory_per_task is not None else \
+            data_bytes + costs[key]['peak_training_bytes']
+
+
+def available_memory():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def start_publishers(tasks, args):
+    """
+    Starts a scripts/publish_data.py process for each dataset (and imputation) the tasks need, waits until each has
+    published, and points the tasks at it
+    """
+    publishers = {}
+
+    for task in tasks:
+        prefix = dataset_prefix(task.dataset, task.imputation)
+        task.shared_data = prefix
+
+        if prefix in publishers:
+            continue
+
+        command = [args.python, '-m', 'scripts.publish_data', task.dataset, '--prefix', prefix, '--num_folds',
+                   str(args.num_folds), '--num_labelled'] + [str(n) for n in args.num_labelled]
+        if task.imputation is not None:
+            command += ['--imputation_type', task.imputation]
+
+        publisher = subprocess.Popen(command, cwd=root, stdout=subprocess.PIPE, text=True)
+        publishers[prefix] = publisher
+
+        # loading may print progress before the publisher announces it is ready, or exit without announcing it
+        line = publisher.stdout.readline()
+        while line and line.strip() != 'ready {}'.format(prefix):
+            line = publisher.stdout.readline()
+
+        if not line:
+            stop_publishers(publishers)
+            sys.exit('Publishing {} to shared memory failed'.format(prefix))
+
+        print('published {} to shared memory'.format(prefix))
+
+    return publishers
+
+
+def stop_publishers(publishers):
+    for publisher in publishers.values():
+        publisher.terminate()
+        publisher.wait()
+
+
+def progress(message, finished, failed, running, total, start_time):
+    print('[{:>6.0f}s] {}/{} done, {} running, {} failed | {}'.format(time.time() - start_time, finished, total,
+                                                                      running, failed, message), flush=True)
+
+
+def run_local(tasks, python, extra_args, cores, threads, memory, retries, log_path, poll=1.):
+    """
+    Runs the tasks as subprocesses, largest first, starting a task whenever enough cores and memory are free. A task
+    too large for the machine still runs once nothing else is running. Failed tasks are retried up to retries times.
+    """
+    pending = sorted(tasks, key=lambda t: t.flops, reverse=True)
+    running = []
+    finished = []
+    failed = []
+    start_time = time.time()
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads))
+
+    while pending or running:
+        for task in list(running):
+            code = task.process.poll()
+            if code is None:
+                continue
+
+            running.remove(task)
+            task.log.close()
+            seconds = time.time() - task.start_time
+
+            if code == 0:
+                finished.append(task)
+                message = 'finished {} in {:.0f}s'.format(task.name, seconds)
+            elif task.attempts <= retries:
+                pending.append(task)
+                message = '{} exited with {}, retrying (attempt {} of {})'.format(task.name, code, task.attempts + 1,
+                                                                               retries + 1)
+            else:
+                failed.append(task)
+                message = '{} exited with {}, giving up, see {}'.format(task.name, code, task.log.name)
+
+            progress(message, len(finished), len(failed), len(running), len(tasks), start_time)
+
+        free_cores = cores - threads * len(running)
+        free_memory = memory - sum(t.memory for t in running)
+
+        for task in list(pending):
+            if running and (free_cores < threads or task.memory > free_memory):
+                continue
+
+            pending.remove(task)
+            task.attempts += 1
+            task.log = open('{}/{}.log'.format(log_path, task.name), 'a')
+            task.start_time = time.time()
+            task.process = subprocess.Popen(task.command(python, extra_args), cwd=root, env=env, stdout=task.log,
+                                            stderr=subprocess.STDOUT)
+            running.append(task)
+
+            free_cores -= threads
+            free_memory -= task.memory
+
+            progress('started {} ({:.1f} GB estimated)'.format(task.name, task.memory / 2 ** 30), len(finished),
+                     len(failed), len(running), len(tasks), start_time)
+
+        time.sleep(poll)
+
+    return finished, failed
+
+
+def submit_slurm(tasks, python, extra_args, threads, log_path, sbatch_args):
+    """Submits each task as its own SLURM job, with the memory estimate as its memory request"""
+    for task in tasks:
+        command = ' '.join(shlex.quote(c) for c in task.command(python, extra_args))
+
+        sbatch = ['sbatch', '--job-name', task.name, '--cpus-per-task', str(threads),
+                  '--mem', '{}M'.format(math.ceil(task.memory / 2 ** 20)), '--chdir', root,
+                  '--output', '{}/{}.log'.format(log_path, task.name)] + shlex.split(sbatch_args) + ['--wrap', command]
+
+        subprocess.run(sbatch, check=True)
+        print('submitted {}'.format(task.name))
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Runs the full matrix of sweep tasks on the local cores or on SLURM. '
+                                                 'Arguments not listed here are passed on to every task.')
+    parser.add_argument('dataset', type=str, choices=list(DATASETS))
+    parser.add_argument('--models', type=str, nargs='+', choices=['simple', 'm1', 'sdae', 'm2', 'ladder'],
+                        default=['simple', 'm1', 'sdae', 'm2', 'ladder'])
+    parser.add_argument('--num_labelled', type=int, nargs='+', default=[100, 500, 1000, 100000])
+    parser.add_argument('--num_folds', type=int, default=5)
+    parser.add_argument('--folds', type=int, nargs='+', default=None, help='Folds to run, all of them by default')
+    parser.add_argument('--scalers', type=str, nargs='+', choices=['standard', 'minmax'], default=['standard'],
+                        help='TCGA only')
+    parser.add_argument('--imputations', type=str, nargs='+', default=['drop_samples'],
+                        choices=['drop_samples', 'drop_genes', 'mean_value', 'zero'], help='TCGA only')
+    parser.add_argument('--output_path', type=str, default='./outputs')
+    parser.add_argument('--cores', type=int, default=os.cpu_count(), help='Cores to pack tasks onto')
+    parser.add_argument('--threads', type=int, default=1, help='Cores (torch threads) per task')
+    parser.add_argument('--memory', type=float, default=None, help='GB of memory to pack tasks into, defaults to the '
+                                                                   'memory currently available')
+    parser.add_argument('--memory_per_task', type=float, default=None,
+                        help='GB to reserve per task instead of the estimate from the cost model')
+    parser.add_argument('--shared_data', default=False, action='store_true',
+                        help='Load each dataset once into shared memory for all local tasks to attach to')
+    parser.add_argument('--retries', type=int, default=1, help='Times to rerun a failed task')
+    parser.add_argument('--python', type=str, default=sys.executable, help='Interpreter to run tasks with')
+    parser.add_argument('--slurm', default=False, action='store_true', help='Submit each task with sbatch instead')
+    parser.add_argument('--sbatch_args', type=str, default='', help='Extra sbatch options, e.g. "-A ACC -p pascal"')
+    parser.add_argument('--dry_run', default=False, action='store_true', help='List the tasks that would run')
+    args, extra_args = parser.parse_known_args()
+
+    if args.slurm and args.shared_data:
+        parser.error('--shared_data only works for tasks on this machine, not with --slurm')
+
+    if args.folds is None:
+        args.folds = list(range(args.num_folds))
+
+    # tasks are packed onto --threads cores each, which takes precedence over any tuned thread count
+    extra_args += ['--threads', str(args.threads)]
+
+    tasks = build_tasks(args)
+    todo = [task for task in tasks if not task.done()]
+    print('{} tasks, {} already have results'.format(len(tasks), len(tasks) - len(todo)))
+
+    memory_per_task = args.memory_per_task * 2 ** 30 if args.memory_per_task is not None else None
+    estimate(todo, args.dataset, memory_per_task, args.shared_data)
+
+    if args.dry_run:
+        for task in todo:
+            print('{}: {:.1f} GB, {:.2f} TFLOP per epoch | {}'.format(task.name, task.memory / 2 ** 30,
+                                                                     task.flops / 1e12,
+                                                                     ' '.join(task.command(args.python, extra_args))))
+        return
+
+    log_path = os.path.join(root, args.output_path, 'logs')
+    if not os.path.exists(log_path):
+        os.makedirs(log_path)
+
+    if args.slurm:
+        submit_slurm(todo, args.python, extra_args, args.threads, log_path, args.sbatch_args)
+        return
+
+    memory = args.memory * 2 ** 30 if args.memory is not None else available_memory()
+
+    publishers = {}
+    if args.shared_data and todo:
+        publishers = start_publishers(todo, args)
+
+        num_samples, input_size, _ = DATASETS[args.dataset]
+        memory -= len(publishers) * LOADED_BYTES_PER_VALUE * num_samples * input_size
+
+    try:
+        finished, failed = run_local(todo, args.python, extra_args, args.cores, args.threads, memory, args.retries,
+                                     log_path)
+    finally:
+        stop_publishers(publishers)
+
+    print('{} tasks finished, {} failed'.format(len(finished), len(failed)))
+    for task in failed:
+        print('failed: {}'.format(task.name))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    __main__()
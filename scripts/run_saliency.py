@@ -38,10 +38,6 @@ def __main__():
     vanilla_saliency = VanillaSaliency(model.Classifier, device).generate_saliency(input, prediction)
     guided_saliency = GuidedSaliency(model.Classifier, device).generate_saliency(input, prediction)
 
-    if device.type == 'cuda':
-        vanilla_saliency = vanilla_saliency.cpu()
-        guided_saliency = guided_saliency.cpu()
-
     for s in [(vanilla_saliency, 'vanilla'), (guided_saliency, 'guided')]:
         saliency, string = s
 
@@ -0,0 +1,101 @@
+import argparse
+import sys
+import time
+import numpy as np
+import pandas as pd
+import torch
+from Saliency import VanillaSaliency, GuidedSaliency, IntegratedGradients, SmoothGrad, CohortStatistics
+from utils.inference import load_bundle, affine_normalizer
+
+parser = argparse.ArgumentParser(description='Streams a cohort through a model trained with main.py train and ranks '
+                                             'the genes of each class by their saliency, in memory independent of the '
+                                             'size of the cohort')
+parser.add_argument('output_folder', type=str, help='Output folder of main.py train')
+parser.add_argument('data_filepath', type=str, help='Data in the format of main.py train or main.py classify')
+parser.add_argument('rankings_file', type=str, help='File to write the rankings to, .npz for every statistic of '
+                                                    'every gene as arrays, otherwise CSV')
+parser.add_argument('--model', type=str, choices=['m2', 'ladder'], default='m2', help='Model of the bundle to explain')
+parser.add_argument('--method', type=str, choices=['vanilla', 'guided', 'integrated', 'smoothgrad'], default='vanilla',
+                    help='integrated integrates from the normalized imputation means of the bundle')
+parser.add_argument('--steps', type=int, default=50,
+                    help='Path points of integrated gradients, or noisy copies of each sample of smoothgrad')
+parser.add_argument('--target', type=str, choices=['predicted', 'true'], default='predicted',
+                    help='Class to compute the saliency of. true needs a label column, and skips unlabelled samples')
+parser.add_argument('--chunk_size', type=int, default=500, help='Samples read from the data file at a time')
+parser.add_argument('--memory_budget', type=int, default=256,
+                    help='MB the gradients of a chunk may take up, larger chunks are split to fit')
+parser.add_argument('--top_k', type=int, default=100,
+                    help='Counts how often each gene is among the top_k of a sample by absolute saliency')
+parser.add_argument('--num_genes', type=int, default=None, help='Genes per class written to a CSV, default all')
+args = parser.parse_args()
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+print('==Loading Models==')
+
+bundle = load_bundle('{}/state'.format(args.output_folder), device)
+label_map = bundle['label_map']
+string_int_map = {v: k for k, v in label_map.items()}
+class_names = [label_map[i] for i in range(len(label_map))]
+
+# genes are attributed on the scale the model sees them on, after its normalizer
+scale, shift = affine_normalizer(bundle['{}_normalizer'.format(args.model)])
+imputation_means = np.asarray(bundle['imputation_means'])
+num_features = len(imputation_means)
+
+# plain modules from inputs to logits, sharing the weights of the trained models
+model = bundle['m2'].M2.Classifier if args.model == 'm2' else bundle['ladder'].ladder.export_encoder()
+memory_budget = args.memory_budget * 2 ** 20
+
+if args.method == 'integrated':
+    baseline = torch.addcmul(shift, torch.tensor(imputation_means).float(), scale)
+    saliency = IntegratedGradients(model, device, memory_budget, args.steps, baseline)
+elif args.method == 'smoothgrad':
+    saliency = SmoothGrad(model, device, memory_budget, args.steps)
+else:
+    saliency = {'vanilla': VanillaSaliency, 'guided': GuidedSaliency}[args.method](model, device, memory_budget)
+statistics = CohortStatistics(len(class_names), num_features, args.top_k)
+
+print('==Computing Saliency==')
+
+feature_names = None
+num_samples = 0
+start = time.perf_counter()
+
+for chunk in pd.read_csv(args.data_filepath, index_col=0, chunksize=args.chunk_size, low_memory=False):
+    features = chunk[chunk.columns[:num_features]]
+    feature_names = list(features.columns)
+
+    features = features.fillna(pd.Series(imputation_means, index=features.columns))
+    data = torch.addcmul(shift, torch.tensor(features.values).float(), scale)
+
+    if args.target == 'true':
+        if chunk.shape[1] == num_features:
+            sys.exit('{} has no label column to take the true classes from'.format(args.data_filepath))
+
+        # unlabelled samples, and classes the model was not trained on, have no class to explain
+        labels = chunk[chunk.columns[-1]].map(string_int_map)
+        known = labels.notna().values
+
+        data = data[torch.from_numpy(known)]
+        classes = torch.tensor(labels[known].values.astype(np.int64))
+    else:
+        with torch.no_grad():
+            classes = saliency.forward(data.to(device)).argmax(dim=1).cpu()
+
+    if data.size(0) > 0:
+        statistics.update(saliency.saliency(data, classes), classes)
+
+    num_samples += data.size(0)
+    print('{} samples, {:.1f} samples/sec'.format(num_samples, num_samples / (time.perf_counter() - start)))
+
+print('==Saving Rankings==')
+
+if args.rankings_file.endswith('.npz'):
+    statistics.save_npz(args.rankings_file, class_names, feature_names)
+else:
+    statistics.save_csv(args.rankings_file, class_names, feature_names, args.num_genes)
+
+for name, count in zip(class_names, statistics.counts.tolist()):
+    print('{}: {} samples'.format(name, count))
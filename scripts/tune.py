@@ -0,0 +1,98 @@
+import argparse
+import os
+import tempfile
+import torch
+from benchmarks.common import SHAPES, build_model, make_dataloaders
+from utils.costmodel import task_cost
+from utils.datautils import load_synthetic_data
+from utils.instrumentation import Instrumentation, peak_rss, reset_peak_rss
+from utils.tuning import TUNING_FILE, save_settings
+
+parser = argparse.ArgumentParser(description='Probe batch sizes and intra-op thread counts for each model on synthetic '
+                                             'data of a given shape, and save the fastest setting that fits in '
+                                             'memory for the training entry points to use')
+parser.add_argument('--models', type=str, nargs='+', choices=['simple', 'm1', 'sdae', 'm2', 'ladder'],
+                    default=['simple', 'm1', 'sdae', 'm2', 'ladder'])
+parser.add_argument('--shape', type=str, choices=list(SHAPES), default='tcga', help='Dataset shape to tune for')
+parser.add_argument('--input_size', type=int, default=None, help='Override the number of features')
+parser.add_argument('--num_classes', type=int, default=None, help='Override the number of classes')
+parser.add_argument('--num_samples', type=int, default=2000, help='Synthetic samples trained on per probe')
+parser.add_argument('--label_fraction', type=float, default=0.1, help='Fraction of training samples labelled')
+parser.add_argument('--batch_sizes', type=int, nargs='+', default=[50, 100, 200, 400, 800])
+parser.add_argument('--threads', type=int, nargs='+', default=None,
+                    help='Intra-op thread counts to probe. Default: powers of two up to the number of cores')
+parser.add_argument('--memory_limit', type=float, default=None,
+                    help='Memory ceiling in GB. Batch sizes whose estimated or measured training memory exceeds it '
+                         'are skipped')
+parser.add_argument('--epochs', type=int, default=2,
+                    help='Epochs per training stage and probe, all but the first are timed')
+parser.add_argument('--output', type=str, default=TUNING_FILE, help='JSON file to save the settings to')
+args = parser.parse_args()
+
+if args.epochs < 2:
+    parser.error('--epochs must be at least 2, the first epoch is not timed')
+
+num_samples, input_size, num_classes, sparsity = SHAPES[args.shape]
+input_size = args.input_size or input_size
+num_classes = args.num_classes or num_classes
+num_labelled = max(num_classes + 1, int(args.label_fraction * args.num_samples))
+device = torch.device('cpu')
+
+thread_counts = args.threads
+if thread_counts is None:
+    cores = os.cpu_count() or 1
+    thread_counts = sorted({min(2 ** i, cores) for i in range(cores.bit_length() + 1)})
+
+memory_limit = args.memory_limit * 2 ** 30 if args.memory_limit is not None else None
+
+print('==Generating {} x {} synthetic data=='.format(args.num_samples, input_size))
+(data, labels), _ = load_synthetic_data(args.num_samples, input_size, num_classes, sparsity)
+
+
+def probe(model_name, batch_size, threads, state_path):
+    """(samples/sec, peak RSS in bytes) of training model_name's mid-grid configuration"""
+    torch.set_num_threads(threads)
+    torch.manual_seed(0)
+    reset_peak_rss()
+
+    model = build_model(model_name, input_size, num_classes, device, state_path)
+    model.instrumentation = Instrumentation(enabled=True)
+    model.train_model(args.epochs, make_dataloaders(model_name, data, labels, num_labelled, batch_size))
+
+    records = [r for r in model.instrumentation.records if r['epoch'] > 0]
+
+    return sum(r['samples'] for r in records) / sum(r['seconds'] for r in records), peak_rss()
+
+
+with tempfile.TemporaryDirectory() as state_path:
+    for model_name in args.models:
+        best = None
+
+        for batch_size in args.batch_sizes:
+            # the whole grid of the sweep trains at this batch size, so its largest configuration has to fit
+            estimate = task_cost(model_name, input_size, num_classes, args.num_samples, num_labelled,
+                                 batch_size)['peak_training_bytes']
+            if memory_limit is not None and estimate > memory_limit:
+                print('{} batch {}: estimated {:.0f} MB exceeds the memory limit, skipped'.format(
+                    model_name, batch_size, estimate / 2 ** 20))
+                continue
+
+            for threads in thread_counts:
+                samples_per_sec, rss = probe(model_name, batch_size, threads, state_path)
+                fits = memory_limit is None or rss <= memory_limit
+
+                print('{} batch {} threads {}: {:.1f} samples/sec, peak RSS {:.0f} MB{}'.format(
+                    model_name, batch_size, threads, samples_per_sec, rss / 2 ** 20,
+                    '' if fits else ', exceeds the memory limit'))
+
+                if fits and (best is None or samples_per_sec > best['samples_per_sec']):
+                    best = {'batch_size': batch_size, 'threads': threads, 'samples_per_sec': samples_per_sec,
+                            'peak_rss_bytes': rss}
+
+        if best is None:
+            print('{}: no setting fits in the memory limit, nothing saved'.format(model_name))
+            continue
+
+        save_settings(model_name, input_size, num_classes, best, args.output)
+        print('{}: batch size {} with {} threads, {:.1f} samples/sec, saved to {}'.format(
+            model_name, best['batch_size'], best['threads'], best['samples_per_sec'], args.output))
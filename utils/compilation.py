@@ -0,0 +1,55 @@
+import os
+import warnings
+import torch
+
+# shared by every sweep process started from the repository root, so graphs compiled by one are reused by the rest
+COMPILE_CACHE = './compile_cache'
+
+
+def enable_compile_cache(cache_dir=COMPILE_CACHE):
+    """Keeps inductor's compiled graphs, including the backward graphs, in cache_dir across processes"""
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+
+    from torch._inductor import config as inductor_config
+    inductor_config.fx_graph_cache = True
+
+    from torch._functorch import config as functorch_config
+    if hasattr(functorch_config, 'enable_autograd_cache'):
+        functorch_config.enable_autograd_cache = True
+
+
+def compile_errors():
+    """Exception types of dynamo and its backends failing to compile, as opposed to errors of the function itself"""
+    from torch._dynamo import exc
+
+    return exc.TorchDynamoException, exc.BackendCompilerFailed
+
+
+class CompiledFunction:
+    """
+    A function compiled with torch.compile that falls back to running eagerly, with a warning, if compilation fails.
+    Compilation happens on the first call, so that is where failures show up. Any other error is the function's own and
+    is raised as usual, without running the function again.
+    """
+    def __init__(self, fn, name, mode=None):
+        self.fn = fn
+        self.name = name
+
+        try:
+            self.compiled = torch.compile(fn, mode=mode)
+        except Exception as e:
+            self.fallback(e)
+
+    def fallback(self, error):
+        warnings.warn('Compiling {} failed, running it eagerly: {}: {}'.format(self.name, type(error).__name__, error))
+        self.compiled = None
+
+    def __call__(self, *args):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args)
+            except compile_errors() as e:
+                self.fallback(e)
+
+        return self.fn(*args)
@@ -0,0 +1,66 @@
+import torch
+from torch import nn
+from Models.BuildingBlocks.LowRankLinear import LowRankLinear, truncated_svd, saves_parameters
+
+
+def relative_error(weight, approximation):
+    return ((weight - approximation).norm() / weight.norm()).item()
+
+
+def compress_linear_layers(module, rank, min_features=1000):
+    """
+    Replaces, in place, every nn.Linear of module with at least min_features inputs or outputs by its truncated SVD
+    factorization, where that saves parameters.
+
+    Returns:
+        [(str, float)]: Name and relative Frobenius error of the weight of each replaced layer
+    """
+    errors = []
+
+    for name, child in list(module.named_modules()):
+        for attribute, layer in list(child.named_children()):
+            if not isinstance(layer, nn.Linear) or max(layer.in_features, layer.out_features) < min_features:
+                continue
+            # also skips the factors of layers that are already factorized
+            if not saves_parameters(layer.in_features, layer.out_features, rank):
+                continue
+
+            compressed = LowRankLinear.from_linear(layer, rank)
+            setattr(child, attribute, compressed)
+
+            errors.append(('{}.{}'.format(name, attribute).lstrip('.'),
+                           relative_error(layer.weight.detach(), compressed.weight.detach())))
+
+    return errors
+
+
+def compress_ladder(ladder, rank):
+    """
+    Factorizes, in place, the input weight W[0] of a Ladder's encoders and the matching decoder weight V[0], as the
+    Ladder's input_rank does.
+
+    Returns:
+        [(str, float)]: Name and relative Frobenius error of each factorized weight
+    """
+    encoders, decoders = ladder.encoders, ladder.decoders
+    in_features, out_features = encoders.W[0].shape
+
+    if getattr(encoders, 'W0_up', None) is not None or not saves_parameters(in_features, out_features, rank):
+        return []
+
+    with torch.no_grad():
+        w, v = encoders.W[0].detach(), decoders.V[0].detach()
+
+        left, right = truncated_svd(w, rank)
+        encoders.W[0] = nn.Parameter(left)
+        encoders.W0_up = nn.Parameter(right)
+
+        down, up = truncated_svd(v, rank)
+        decoders.V0_down = nn.Parameter(down)
+        decoders.V[0] = nn.Parameter(up)
+
+    return [('encoders.W.0', relative_error(w, left @ right)), ('decoders.V.0', relative_error(v, down @ up))]
+
+
+def parameter_count(module):
+    return sum(p.numel() for p in module.parameters())
@@ -0,0 +1,184 @@
+import torch
+from torch import nn
+from torch.autograd.graph import saved_tensors_hooks
+from torch.utils.flop_counter import FlopCounterMode
+from Models import SimpleNetwork, M1, SDAE, M2Runner, LadderNetwork
+from Models.SDAE import AutoencoderSDAE
+from Models.Model import LR, hidden_layer_size
+from Models.SimpleNetwork import HIDDEN_LAYERS as SIMPLE_HIDDEN_LAYERS
+from Models.M1 import PARAMETER_GRID as M1_GRID, CLASSIFIER_HIDDEN_SIZE as M1_CLASSIFIER_HIDDEN_SIZE
+from Models.SDAE import HIDDEN_LAYERS as SDAE_HIDDEN_LAYERS
+from Models.M2 import PARAMETER_GRID as M2_GRID
+from Models.Ladder import HIDDEN_LAYERS as LADDER_HIDDEN_LAYERS, denoising_cost
+
+META = torch.device('meta')
+
+# float32 weights, gradients and the two Adam moment estimates
+TRAINING_BYTES_PER_PARAMETER = 16
+
+
+def grid(model_name, input_size, num_classes, lr=LR):
+    """
+    (configuration name, constructor) pairs for every configuration the model's hyperparameter_loop trains. The
+    constructors take the device to build on.
+    """
+    hidden_size = hidden_layer_size(input_size, num_classes)
+
+    if model_name == 'simple':
+        return [('{}'.format(h), lambda device, h=h: SimpleNetwork(input_size, [hidden_size] * h, num_classes, lr,
+                                                                    device, 'cost', None))
+                for h in SIMPLE_HIDDEN_LAYERS]
+
+    if model_name == 'm1':
+        return [('{}_{}_{}'.format(h_v, h_c, z),
+                 lambda device, h_v=h_v, h_c=h_c, z=z: M1(input_size, h_v * [hidden_size], z,
+                                                          h_c * [M1_CLASSIFIER_HIDDEN_SIZE], num_classes,
+                                                          nn.Sigmoid(), lr, device, 'cost', None))
+                for h_v, h_c, z in M1_GRID]
+
+    if model_name == 'sdae':
+        return [('{}'.format(h), lambda device, h=h: SDAE(input_size, [hidden_size] * h, num_classes, lr, device,
+                                                           'cost', None))
+                for h in SDAE_HIDDEN_LAYERS]
+
+    if model_name == 'm2':
+        return [('{}_{}_{}'.format(h_v, h_c, z),
+                 lambda device, h_v=h_v, h_c=h_c, z=z: M2Runner(input_size, [hidden_size] * h_v, [hidden_size] * h_c,
+                                                                z, num_classes, nn.Sigmoid(), lr, device, 'cost',
+                                                                None))
+                for h_v, h_c, z in M2_GRID]
+
+    if model_name == 'ladder':
+        return [('{}'.format(h), lambda device, h=h: LadderNetwork(input_size, [hidden_size] * h, num_classes,
+                                                                    denoising_cost(h), lr, device, 'cost',
+                                                                    None))
+                for h in LADDER_HIDDEN_LAYERS]
+
+    raise ValueError('Unknown model {}'.format(model_name))
+
+
+def training_loss(model_name, model, labelled_data, labels, unlabelled_data):
+    """The loss of one step of each of the model's training stages, summed"""
+    if model_name == 'simple':
+        return model.classifier_loss(labelled_data, labels)
+
+    if model_name == 'm1':
+        return model.vae_loss(unlabelled_data) + model.classifier_loss(labelled_data, labels)
+
+    if model_name == 'sdae':
+        loss = model.classifier_loss(labelled_data, labels)
+
+        for i, layer in enumerate(model.SDAEClassifier.hidden_layers):
+            loss = loss + model.pretraining_loss(AutoencoderSDAE(layer), nn.MSELoss(),
+                                                 model.SDAEClassifier.hidden_layers[0:i], unlabelled_data)
+
+        return loss
+
+    if model_name == 'm2':
+        return model.loss(labelled_data, labels, unlabelled_data, 1.)
+
+    if model_name == 'ladder':
+        return model.loss(labelled_data, labels, unlabelled_data)
+
+    raise ValueError('Unknown model {}'.format(model_name))
+
+
+class _SavedActivations(saved_tensors_hooks):
+    """Adds up the bytes of the tensors autograd saves for the backward pass, leaving out the parameters"""
+    def __init__(self, parameters):
+        self.parameters = {id(p) for p in parameters}
+        self.bytes = 0
+        super(_SavedActivations, self).__init__(self.pack, lambda t: t)
+
+    def pack(self, t):
+        base = t._base if t._base is not None else t
+        if id(base) not in self.parameters:
+            self.bytes += t.numel() * t.element_size()
+
+        return t
+
+
+def step_cost(model_name, model, num_labelled, num_unlabelled, input_size, num_classes):
+    """(matmul FLOPs of the forward and backward pass, bytes of saved activations) of one training step on META"""
+    labelled_data = torch.rand(num_labelled, input_size, device=META)
+    labels = torch.randint(num_classes, (num_labelled,), device=META)
+    unlabelled_data = torch.rand(num_unlabelled, input_size, device=META)
+
+    saved = _SavedActivations(model.parameters())
+
+    with FlopCounterMode(display=False) as flop_counter:
+        with saved:
+            loss = training_loss(model_name, model, labelled_data, labels, unlabelled_data)
+        loss.backward()
+
+    return flop_counter.get_total_flops(), saved.bytes
+
+
+def configuration_cost(model_name, build, input_size, num_classes, batch_size=100):
+    """
+    Builds a configuration on the meta device, so nothing is allocated, and works out its cost from one traced training
+    step with batch_size labelled and batch_size unlabelled samples, and one with twice as many unlabelled samples to
+    separate the per-sample cost of the two.
+    """
+    with torch.device(META):
+        model = build(META)
+
+        parameters = sum(p.numel() for p in model.parameters())
+
+        flops, activation_bytes = step_cost(model_name, model, batch_size, batch_size, input_size, num_classes)
+        more_unlabelled_flops, _ = step_cost(model_name, model, batch_size, 2 * batch_size, input_size, num_classes)
+
+        with FlopCounterMode(display=False) as flop_counter, torch.no_grad():
+            model.eval()
+            model.forward(torch.rand(batch_size, input_size))
+
+    unlabelled_flops = (more_unlabelled_flops - flops) / batch_size
+    labelled_flops = flops / batch_size - unlabelled_flops
+
+    return {
+        'parameters': parameters,
+        'parameter_bytes': 4 * parameters,
+        'labelled_flops': labelled_flops,
+        'unlabelled_flops': unlabelled_flops,
+        'classify_flops': flop_counter.get_total_flops() / batch_size,
+        'activation_bytes': activation_bytes,
+        'training_bytes': TRAINING_BYTES_PER_PARAMETER * parameters + activation_bytes,
+        'batch_size': batch_size,
+    }
+
+
+def grid_costs(model_name, input_size, num_classes, batch_size=100):
+    return {name: configuration_cost(model_name, build, input_size, num_classes, batch_size)
+            for name, build in grid(model_name, input_size, num_classes)}
+
+
+def epoch_samples(model_name, num_train, num_labelled):
+    """(labelled, unlabelled) samples one epoch of each training stage goes through, as the sweep scripts load them"""
+    if model_name == 'simple':
+        return num_labelled, 0
+
+    if model_name == 'm2':
+        # the labelled loader is cycled alongside the unlabelled one, which only holds the unlabelled samples
+        return num_train - num_labelled, num_train - num_labelled
+
+    if model_name == 'ladder':
+        return num_train, num_train
+
+    return num_labelled, num_train
+
+
+def task_cost(model_name, input_size, num_classes, num_train, num_labelled, batch_size=100, costs=None):
+    """
+    Cost of one sweep task (every configuration of the grid trained in turn): the peak training memory of its largest
+    configuration, and the FLOPs of one epoch of every configuration.
+    """
+    if costs is None:
+        costs = grid_costs(model_name, input_size, num_classes, batch_size)
+
+    labelled, unlabelled = epoch_samples(model_name, num_train, num_labelled)
+
+    return {
+        'peak_training_bytes': max(c['training_bytes'] for c in costs.values()),
+        'flops_per_epoch': sum(labelled * c['labelled_flops'] + unlabelled * c['unlabelled_flops']
+                               for c in costs.values()),
+    }
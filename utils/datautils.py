@@ -124,6 +124,30 @@ def load_tcga_data(imputation_type=ImputationType.DROP_SAMPLES):
     return (data, labels), (input_size, num_classes)
 
 
+def load_synthetic_data(num_samples, input_size, num_classes, sparsity=0., seed=0, chunk_size=1000):
+    """
+    Random [0, 1] data with class-dependent feature means, for benchmarking without the real datasets.
+    sparsity is the expected fraction of features set to zero in each sample.
+    """
+    generator = torch.Generator().manual_seed(seed)
+
+    labels = torch.randint(num_classes, (num_samples,), generator=generator)
+    class_means = torch.rand(num_classes, input_size, generator=generator)
+
+    data = torch.empty(num_samples, input_size)
+    # fill in chunks to avoid temporaries the size of the whole matrix
+    for i in range(0, num_samples, chunk_size):
+        chunk_labels = labels[i:i + chunk_size]
+        chunk = class_means[chunk_labels] + 0.1 * torch.randn(chunk_labels.size(0), input_size, generator=generator)
+
+        if sparsity > 0:
+            chunk[torch.rand(chunk.size(), generator=generator) < sparsity] = 0
+
+        data[i:i + chunk_size] = chunk.clamp_(0, 1)
+
+    return (data, labels), (input_size, num_classes)
+
+
 def load_MNIST_data():
     mnist_train = datasets.MNIST(root='data/MNIST', train=True, download=True, transform=None)
     mnist_test = datasets.MNIST(root='data/MNIST', train=False, download=True, transform=None)
@@ -0,0 +1,166 @@
+import os
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader, DistributedSampler, RandomSampler, BatchSampler
+
+# Data-parallel training across local CPU processes. Scripts started with torchrun and --distributed call init(); every
+# process then builds the same models and trains on its shard of each training set, and TrainingEngine averages the
+# gradients. Outside of a torchrun launch all of these helpers do nothing.
+
+
+def init(threads=None):
+    """
+    Joins the gloo process group of a torchrun launch and splits the cores between the local processes.
+
+    Args:
+        threads (int): Threads per process. Default: the cores divided by the number of local processes
+
+    Returns:
+        (int, int): Rank of this process and number of processes
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+
+    if world_size > 1:
+        if not dist.is_initialized():
+            dist.init_process_group('gloo')
+
+        # torchrun sets OMP_NUM_THREADS to 1, which leaves most of the cores idle
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+        torch.set_num_threads(threads or max(1, (os.cpu_count() or 1) // local_world_size))
+
+    return rank(), world_size
+
+
+def shutdown():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_value(value):
+    """Rank 0's value of a picklable object, so every process takes the same decision from it"""
+    if not is_distributed():
+        return value
+
+    values = [value]
+    dist.broadcast_object_list(values, src=0)
+
+    return values[0]
+
+
+def any_process(flag):
+    """Whether flag is set on any process"""
+    if not is_distributed():
+        return flag
+
+    flag = torch.tensor(int(flag))
+    dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+
+    return bool(flag)
+
+
+def minimum(value):
+    """Smallest integer value across processes"""
+    if not is_distributed():
+        return value
+
+    value = torch.tensor(value)
+    dist.all_reduce(value, op=dist.ReduceOp.MIN)
+
+    return int(value)
+
+
+def average_(tensor):
+    """Replaces tensor in place by its mean across processes"""
+    if is_distributed():
+        dist.all_reduce(tensor)
+        tensor /= world_size()
+
+    return tensor
+
+
+def broadcast_module(module):
+    """Copies rank 0's parameters and buffers to every process"""
+    with torch.no_grad():
+        for t in list(module.parameters()) + list(module.buffers()):
+            dist.broadcast(t, src=0)
+
+
+def average_gradients(module):
+    """Averages the gradients of module's parameters across processes in one all-reduce"""
+    # parameters a step didn't reach keep no gradient, so the optimizer skips them as it would in one process
+    parameters = [p for p in module.parameters() if p.grad is not None]
+    if not parameters:
+        return
+
+    flat = torch.cat([p.grad.reshape(-1) for p in parameters])
+    average_(flat)
+
+    offset = 0
+    for p in parameters:
+        p.grad.copy_(flat[offset:offset + p.numel()].view_as(p.grad))
+        offset += p.numel()
+
+
+def average_buffers(module):
+    """Averages floating point buffers, e.g. BatchNorm running statistics, across processes"""
+    with torch.no_grad():
+        for b in module.buffers():
+            if b.is_floating_point():
+                average_(b)
+
+
+def save_state(state, filename):
+    """Saves on rank 0 only, and returns once the file is there for every process to load"""
+    if is_main_process():
+        torch.save(state, filename)
+
+    barrier()
+
+
+class ShardedSampler(DistributedSampler):
+    """A DistributedSampler that reshuffles on every pass over it, as a shuffling DataLoader does"""
+    def __iter__(self):
+        indices = super(ShardedSampler, self).__iter__()
+        self.set_epoch(self.epoch + 1)
+
+        return indices
+
+
+def train_loader(dataset, batch_size):
+    """
+    A shuffling DataLoader over dataset. In data-parallel mode each process gets a disjoint shard of it, padded so that
+    every process has the same number of batches. Datasets with a true batched attribute are indexed with whole
+    batches of indices instead of one sample at a time.
+    """
+    if not is_distributed():
+        sampler = RandomSampler(dataset)
+    else:
+        # one seed for all processes, so their shards partition the same permutation
+        seed = broadcast_value(int(torch.randint(2 ** 31, ())))
+        sampler = ShardedSampler(dataset, shuffle=True, seed=seed)
+
+    if getattr(dataset, 'batched', False):
+        return DataLoader(dataset, batch_size=None, sampler=BatchSampler(sampler, batch_size, drop_last=False))
+
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler)
@@ -0,0 +1,244 @@
+import torch
+from utils.compilation import CompiledFunction
+from utils.prefetch import Prefetcher
+from utils.distributed import is_distributed, broadcast_value, any_process, minimum, average_, broadcast_module, \
+    average_gradients, average_buffers
+
+
+class Hook:
+    """Callbacks made by TrainingEngine.run, subclasses override the ones they need"""
+    def before_training(self, module):
+        pass
+
+    def before_step(self, module):
+        """After the gradients of a step are complete, before the optimizer uses them"""
+        pass
+
+    def after_epoch(self, module):
+        """After the last step of an epoch, before validation"""
+        pass
+
+    def after_validation(self, epoch, score):
+        pass
+
+    def should_stop(self):
+        return False
+
+    def after_training(self):
+        pass
+
+
+class EarlyStoppingHook(Hook):
+    """
+    Feeds validation scores to an EarlyStopping, which checkpoints module whenever they improve, stops training once it
+    runs out of patience and reloads the best checkpoint when training ends
+    """
+    def __init__(self, early_stopping, module, instrumentation, to_loss=lambda score: 1 - score, restore=True):
+        """
+        Args:
+            early_stopping (EarlyStopping): Tracks the best validation loss and holds the checkpoint.
+            module (nn.Module): Module to checkpoint and restore.
+            instrumentation (Instrumentation): Times checkpointing.
+            to_loss (callable): Turns a validation score into a loss, accuracy by default.
+            restore (bool): Whether to load the best checkpoint back when training ends.
+        """
+        self.early_stopping = early_stopping
+        self.module = module
+        self.instrumentation = instrumentation
+        self.to_loss = to_loss
+        self.restore = restore
+
+    def after_validation(self, epoch, score):
+        with self.instrumentation.phase('checkpoint'):
+            self.early_stopping(self.to_loss(score), self.module)
+
+    def should_stop(self):
+        return self.early_stopping.early_stop
+
+    def after_training(self):
+        if self.restore:
+            self.early_stopping.load_checkpoint(self.module)
+
+
+class DataParallelHook(Hook):
+    """
+    Keeps the copies of a module in data-parallel processes identical: they start from rank 0's parameters, average
+    their gradients before every optimizer step and average their BatchNorm running statistics after every epoch.
+    Batch statistics during training stay per process, so each process normalizes its batches exactly as a single
+    process would.
+    """
+    def before_training(self, module):
+        broadcast_module(module)
+
+    def before_step(self, module):
+        average_gradients(module)
+
+    def after_epoch(self, module):
+        average_buffers(module)
+
+
+class TrainingEngine:
+    """
+    The epoch and batch loop shared by all models. A model describes one stage of its training by a function moving a
+    batch to the device and one computing its loss; the engine does the optimisation, validation on the model's
+    evaluation schedule, instrumentation and the time budget.
+    """
+    def __init__(self, precision='fp32', accumulation_steps=1, compiled=False, reconstruction_sampler=None,
+                 prefetch=0):
+        """
+        Args:
+            precision (str): 'fp32', or 'bf16' to run the loss computation under bfloat16 autocast.
+            accumulation_steps (int): Number of batches whose gradients are summed before each optimizer step.
+            compiled (bool): Whether to torch.compile the loss computations and the classify forward passes.
+            reconstruction_sampler (FeatureSampler): Draws the output features the training losses of M1 and M2
+                reconstruct at each step. Default: all of them
+            prefetch (int): Number of batches prepared ahead on a background thread. Default: 0, batches are prepared
+                on the main thread as they are needed
+        """
+        self.precision = precision
+        self.accumulation_steps = accumulation_steps
+        self.compiled = compiled
+        self.reconstruction_sampler = reconstruction_sampler
+        self.prefetch = prefetch
+
+    def autocast(self, device):
+        return torch.autocast(device.type, dtype=torch.bfloat16, enabled=self.precision == 'bf16')
+
+    def sample_features(self, device):
+        """A FeatureSample of the output features to reconstruct in a training step, or None for all of them"""
+        if self.reconstruction_sampler is None:
+            return None
+
+        return self.reconstruction_sampler.sample(device)
+
+    def compile(self, fn, name):
+        """fn compiled if the engine is in compiled mode, falling back to fn if compilation fails, else fn itself"""
+        if not self.compiled:
+            return fn
+
+        return CompiledFunction(fn, name)
+
+    def run(self, model, stage, module, optimizer, prepare, compute_loss, batches, max_epochs, validate=None,
+            hooks=()):
+        """
+        Args:
+            model (Model): Supplies the device, instrumentation, evaluation schedule, profiler and deadline.
+            stage (str): Name of the stage in the instrumentation records.
+            module (nn.Module): Module being trained, put in training mode before every step.
+            optimizer (Optimizer): Optimizer of the module's parameters.
+            prepare (callable): Takes a batch and returns (arguments for compute_loss, number of samples).
+            compute_loss (callable): Returns the loss of a batch.
+            batches (callable): Returns an iterable over the batches of one epoch.
+            max_epochs (int): Maximum number of epochs to train for.
+            validate (callable): Returns a validation score, or None to train without validation.
+            hooks (list): Hooks for early stopping, checkpointing and the optimizer step.
+
+        Returns:
+            (list, list, list): Epochs trained, the sum of the batch losses of each epoch and the validation scores
+        """
+        epochs = []
+        train_losses = []
+        validation_scores = []
+
+        model.evaluation_schedule.reset()
+        model.instrumentation.reset()
+
+        if is_distributed():
+            hooks = list(hooks) + [DataParallelHook()]
+            # every process has to run the same number of epochs, or the all-reduces stop matching up
+            max_epochs = minimum(max_epochs)
+
+        for hook in hooks:
+            hook.before_training(module)
+
+        # the backward pass is compiled along with the loss, autograd traces through the compiled forward
+        compute_loss = self.compile(compute_loss, '{} {} loss'.format(model.model_name, stage))
+
+        for epoch in range(max_epochs):
+            if any(hook.should_stop() for hook in hooks):
+                break
+
+            train_loss = self.train_epoch(model, module, optimizer, prepare, compute_loss, batches(), hooks)
+
+            for hook in hooks:
+                hook.after_epoch(module)
+
+            if validate is not None and model.evaluation_schedule(epoch, train_loss):
+                with model.instrumentation.phase('validation'):
+                    # rank 0's score, so all processes early stop together
+                    score = broadcast_value(validate())
+                validation_scores.append(score)
+
+                for hook in hooks:
+                    hook.after_validation(epoch, score)
+
+            epochs.append(epoch)
+            train_losses.append(train_loss)
+            # models pickled before the counter existed start from 0
+            model.epochs_trained = getattr(model, 'epochs_trained', 0) + 1
+            model.instrumentation.end_epoch(stage, epoch)
+
+            if any_process(model.out_of_time()):
+                break
+
+        for hook in hooks:
+            hook.after_training()
+
+        return epochs, train_losses, validation_scores
+
+    def train_epoch(self, model, module, optimizer, prepare, compute_loss, batches, hooks):
+        instrumentation = model.instrumentation
+        # summed on the device in float64, which gives the same total as adding up loss.item() without a sync per step
+        train_loss = torch.zeros((), dtype=torch.float64, device=model.device)
+        accumulated = 0
+
+        if self.prefetch:
+            # the batches come prepared, and the main thread's wait for them is recorded as the batch phase
+            batches = Prefetcher(batches, prepare, self.prefetch, pin_memory=model.device.type == 'cuda')
+            prepare = lambda prepared: prepared
+
+        for batch in instrumentation.batches(batches):
+            module.train()
+
+            with instrumentation.phase('batch'):
+                args, num_samples = prepare(batch)
+
+            if accumulated == 0:
+                optimizer.zero_grad()
+
+            with instrumentation.phase('forward'), self.autocast(model.device):
+                loss = compute_loss(*args)
+
+            with instrumentation.phase('backward'):
+                if self.accumulation_steps > 1:
+                    (loss / self.accumulation_steps).backward()
+                else:
+                    loss.backward()
+
+            accumulated += 1
+            if accumulated == self.accumulation_steps:
+                self.optimizer_step(model, module, optimizer, hooks)
+                accumulated = 0
+
+            train_loss += loss.detach()
+            model.end_step(num_samples)
+
+        # the last batches of an epoch that didn't fill an accumulation window
+        if accumulated:
+            # their losses were divided by accumulation_steps, the mean over the window divides by accumulated
+            with torch.no_grad():
+                for p in module.parameters():
+                    if p.grad is not None:
+                        p.grad.mul_(self.accumulation_steps / accumulated)
+
+            self.optimizer_step(model, module, optimizer, hooks)
+
+        # the mean over the processes' shards, which the evaluation schedule's plateau test needs to agree on
+        return average_(train_loss).item()
+
+    def optimizer_step(self, model, module, optimizer, hooks):
+        with model.instrumentation.phase('step'):
+            for hook in hooks:
+                hook.before_step(module)
+
+            optimizer.step()
@@ -0,0 +1,70 @@
+import pickle
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def load_bundle(state_path, device):
+    """Loads the models, normalizers and metadata that main.py train saves to state_path"""
+    map_location = 'cpu' if device.type == 'cpu' else None
+
+    bundle = {
+        'm2': torch.load('{}/m2.pt'.format(state_path), map_location=map_location, weights_only=False),
+        'ladder': torch.load('{}/ladder.pt'.format(state_path), map_location=map_location, weights_only=False),
+    }
+
+    for name in ['m2_normalizer', 'ladder_normalizer', 'imputation_means', 'label_map']:
+        with open('{}/{}.p'.format(state_path, name), 'rb') as f:
+            bundle[name] = pickle.load(f)
+
+    return bundle
+
+
+def ensemble_classify(m2, m2_normalizer, ladder, ladder_normalizer, data):
+    """Averaged class probabilities of M2 and the Ladder network, each on its own normalization of data"""
+    m2_data = torch.tensor(m2_normalizer.transform(data)).float()
+    m2_results = m2.classify(m2_data)
+
+    ladder_data = torch.tensor(ladder_normalizer.transform(data)).float()
+    ladder_results = ladder.classify(ladder_data)
+
+    return (F.softmax(m2_results, dim=1) + F.softmax(ladder_results, dim=1))/2
+
+
+def affine_normalizer(normalizer):
+    """
+    (scale, shift) float32 tensors such that x * scale + shift == normalizer.transform(x) for a fitted MinMaxScaler or
+    StandardScaler, so normalization can run in torch without a float64 numpy round trip
+    """
+    if hasattr(normalizer, 'data_min_'):
+        return torch.tensor(normalizer.scale_).float(), torch.tensor(normalizer.min_).float()
+
+    # a StandardScaler fitted with_mean=False still has mean_, which transform does not subtract
+    mean = normalizer.mean_ if normalizer.with_mean else np.zeros(normalizer.n_features_in_)
+    std = normalizer.scale_ if normalizer.with_std else np.ones(normalizer.n_features_in_)
+
+    scale = 1 / torch.tensor(std).float()
+
+    return scale, -torch.tensor(mean).float() * scale
+
+
+class EnsembleClassifier:
+    """Same predictions as ensemble_classify, normalizing in torch and running both models in one inference pass"""
+    def __init__(self, m2, m2_normalizer, ladder, ladder_normalizer, device):
+        self.m2 = m2
+        self.ladder = ladder
+        self.device = device
+        self.m2_scale, self.m2_shift = [t.to(device) for t in affine_normalizer(m2_normalizer)]
+        self.ladder_scale, self.ladder_shift = [t.to(device) for t in affine_normalizer(ladder_normalizer)]
+
+        self.m2.M2.eval()
+        self.ladder.ladder.eval()
+
+    def __call__(self, data):
+        with torch.inference_mode():
+            data = data.float().to(self.device)
+
+            m2_results = self.m2.forward(torch.addcmul(self.m2_shift, data, self.m2_scale))
+            ladder_results = self.ladder.forward(torch.addcmul(self.ladder_shift, data, self.ladder_scale))
+
+            return (F.softmax(m2_results, dim=1) + F.softmax(ladder_results, dim=1))/2
@@ -0,0 +1,265 @@
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from torch.profiler import profile, ProfilerActivity
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes since the last reset_peak_rss()"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS, and can't be reset
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def current_rss():
+    """Resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return peak_rss()
+
+
+def reset_peak_rss():
+    # writing 5 to clear_refs resets VmHWM to the current RSS (Linux only)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase:
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.instrumentation.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class MemoryTracker:
+    """
+    Memory accounting by model and phase. While enabled, a background thread samples RSS and every open phase keeps the
+    highest sample seen, and the first call of each phase is run under torch.profiler to count the tensor memory it
+    allocates and keeps alive. Not to be combined with a Profiler, as torch.profiler sessions cannot be nested.
+    """
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.enabled = False
+        self.model = 'all'
+        self.stats = {}
+        self.peak_rss = 0
+        self._open = []
+        self._profiling = False
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self.enabled = True
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.enabled = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _sample(self):
+        while self.enabled:
+            self._observe(current_rss())
+            time.sleep(self.interval)
+
+    def _observe(self, rss):
+        with self._lock:
+            self.peak_rss = max(self.peak_rss, rss)
+            for frame in self._open:
+                frame['peak'] = max(frame['peak'], rss)
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        key = (self.model, name)
+        frame = {'start': current_rss()}
+        frame['peak'] = frame['start']
+
+        with self._lock:
+            self._open.append(frame)
+
+        profiled = key not in self.stats and not self._profiling
+        prof = None
+
+        try:
+            if profiled:
+                self._profiling = True
+                with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+                    yield
+            else:
+                yield
+        finally:
+            if profiled:
+                self._profiling = False
+
+            self._observe(current_rss())
+            with self._lock:
+                self._open.remove(frame)
+
+            self._record(key, frame, prof)
+
+    def _record(self, key, frame, prof):
+        stats = self.stats.setdefault(key, {'calls': 0, 'peak_rss_bytes': 0, 'rss_increase_bytes': 0,
+                                            'allocated_bytes': 0, 'retained_bytes': 0})
+        stats['calls'] += 1
+        stats['peak_rss_bytes'] = max(stats['peak_rss_bytes'], frame['peak'])
+        stats['rss_increase_bytes'] = max(stats['rss_increase_bytes'], frame['peak'] - frame['start'])
+
+        if prof is not None:
+            events = [e for e in prof.events() if e.name == '[memory]']
+            usage = [e.cpu_memory_usage + getattr(e, 'device_memory_usage', 0) for e in events]
+
+            stats['allocated_bytes'] = sum(u for u in usage if u > 0)
+            stats['retained_bytes'] = sum(usage)
+
+    def rows(self):
+        return [dict(model=model, phase=phase, **stats) for (model, phase), stats in self.stats.items()]
+
+    def table(self):
+        """Breakdown of the tracked phases, in MB, largest RSS increase first"""
+        lines = ['{:<12} {:<12} {:>7} {:>14} {:>16} {:>14} {:>13}'.format(
+            'model', 'phase', 'calls', 'peak RSS (MB)', 'RSS increase (MB)', 'allocated (MB)', 'retained (MB)')]
+
+        for row in sorted(self.rows(), key=lambda r: r['rss_increase_bytes'], reverse=True):
+            lines.append('{:<12} {:<12} {:>7} {:>14.1f} {:>16.1f} {:>14.1f} {:>13.1f}'.format(
+                row['model'], row['phase'], row['calls'], row['peak_rss_bytes'] / 2 ** 20,
+                row['rss_increase_bytes'] / 2 ** 20, row['allocated_bytes'] / 2 ** 20,
+                row['retained_bytes'] / 2 ** 20))
+
+        lines.append('overall peak RSS: {:.1f} MB'.format(self.peak_rss / 2 ** 20))
+
+        return '\n'.join(lines)
+
+    def dump(self, filename, **fields):
+        with open(filename, 'w') as f:
+            json.dump(dict(fields, peak_rss_bytes=self.peak_rss, phases=self.rows()), f, indent=2)
+
+
+# shared by all models, enabled by the scripts' --memory_report option
+memory_tracker = MemoryTracker()
+
+
+class Instrumentation:
+    """Phase timers and throughput counters for a training run, collected per epoch"""
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.records = []
+        self.reset()
+
+    def reset(self):
+        self.phase_times = {}
+        self.steps = 0
+        self.samples = 0
+        self.epoch_start = time.perf_counter()
+
+        if self.enabled:
+            reset_peak_rss()
+
+    def phase(self, name):
+        if memory_tracker.enabled:
+            return self._tracked_phase(name)
+
+        if not self.enabled:
+            return _NULL_PHASE
+
+        return _Phase(self, name)
+
+    @contextmanager
+    def _tracked_phase(self, name):
+        with memory_tracker.phase(name), (_Phase(self, name) if self.enabled else _NULL_PHASE):
+            yield
+
+    def add_time(self, name, seconds):
+        self.phase_times[name] = self.phase_times.get(name, 0.) + seconds
+
+    def batches(self, iterable, name='batch'):
+        """Wraps an iterable so that the time spent waiting for each item is recorded under name"""
+        if not self.enabled:
+            return iterable
+
+        return self._timed(iterable, name)
+
+    def _timed(self, iterable, name):
+        iterator = iter(iterable)
+
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add_time(name, time.perf_counter() - start)
+
+            yield item
+
+    def step(self, num_samples):
+        self.steps += 1
+        self.samples += num_samples
+
+    def end_epoch(self, stage, epoch):
+        if not self.enabled:
+            return
+
+        seconds = time.perf_counter() - self.epoch_start
+        self.records.append({
+            'stage': stage,
+            'epoch': epoch,
+            'seconds': seconds,
+            'steps': self.steps,
+            'samples': self.samples,
+            'steps_per_sec': self.steps / seconds if seconds > 0 else 0.,
+            'samples_per_sec': self.samples / seconds if seconds > 0 else 0.,
+            'phase_seconds': self.phase_times,
+            'peak_rss_bytes': peak_rss(),
+        })
+        self.reset()
+
+    def dump(self, filename, **fields):
+        """Appends the collected records to a JSON lines file, adding fields to each record"""
+        if not self.enabled:
+            return
+
+        with open(filename, 'a') as f:
+            for record in self.records:
+                f.write(json.dumps(dict(fields, **record)) + '\n')
+
+        self.records = []
@@ -0,0 +1,80 @@
+import queue
+import threading
+import torch
+
+_DONE = object()
+
+
+def pin(batch):
+    """batch with its dense CPU tensors in pinned memory, so their copies to the GPU can overlap with compute"""
+    if isinstance(batch, torch.Tensor):
+        return batch.pin_memory() if batch.layout == torch.strided and not batch.is_cuda else batch
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(pin(b) for b in batch)
+
+    return batch
+
+
+class _Failure:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class Prefetcher:
+    """
+    Iterates over batches, preparing each one on a background thread while the main thread trains on the previous
+    ones. The thread gathers a batch from the loader (or the zip of labelled and unlabelled loaders), pins it if
+    pin_memory is set, and passes it to prepare, which converts it and moves it to the device. At most depth prepared
+    batches are held at a time. An exception raised on the thread is raised again where the batch would have been.
+    """
+    def __init__(self, batches, prepare, depth=2, pin_memory=False):
+        self.batches = batches
+        self.prepare = prepare
+        self.depth = depth
+        self.pin_memory = pin_memory
+
+    @staticmethod
+    def _put(prepared, item, stop):
+        """Waits for room in the queue, giving up if the consumer has stopped. Returns whether item was queued"""
+        while not stop.is_set():
+            try:
+                prepared.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _produce(self, prepared, stop):
+        try:
+            for batch in self.batches:
+                if self.pin_memory:
+                    batch = pin(batch)
+
+                if not self._put(prepared, self.prepare(batch), stop):
+                    return
+        except Exception as e:
+            self._put(prepared, _Failure(e), stop)
+            return
+
+        self._put(prepared, _DONE, stop)
+
+    def __iter__(self):
+        prepared = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(prepared, stop), daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                item = prepared.get()
+
+                if item is _DONE:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.exception
+
+                yield item
+        finally:
+            stop.set()
+            thread.join()
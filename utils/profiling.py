@@ -0,0 +1,88 @@
+import os
+from contextlib import contextmanager, nullcontext
+import torch
+from torch.profiler import profile, schedule, ProfilerActivity
+
+
+def activities():
+    if torch.cuda.is_available():
+        return [ProfilerActivity.CPU, ProfilerActivity.CUDA]
+
+    return [ProfilerActivity.CPU]
+
+
+def write_profile(prof, output_folder, name, row_limit=30):
+    """Writes a Chrome trace and a table of the most expensive operators (grouped by input shape)"""
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    prof.export_chrome_trace('{}/{}_trace.json'.format(output_folder, name))
+
+    sort_by = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+    table = prof.key_averages(group_by_input_shape=True).table(sort_by=sort_by, row_limit=row_limit)
+
+    with open('{}/{}_top_operators.txt'.format(output_folder, name), 'w') as f:
+        f.write(table)
+
+
+class Profiler:
+    """Captures either a window of training steps after a warm-up, or the classify pass, with torch.profiler"""
+    def __init__(self, output_folder, name, mode='train', warmup=10, steps=5):
+        """
+        Args:
+            output_folder (str): Folder the traces and operator tables are written to.
+            name (str): Prefix for the output files.
+            mode (str): 'train' to profile training steps, 'classify' to profile classification.
+            warmup (int): Number of training steps to run before profiling starts.
+            steps (int): Number of training steps to profile.
+        """
+        self.output_folder = output_folder
+        self.name = name
+        self.mode = mode
+        self.warmup = warmup
+        self.steps = steps
+        self.profiler = None
+        self.finished = False
+        self.classify_runs = 0
+
+    def step(self):
+        """Called at the end of every training step"""
+        if self.mode != 'train' or self.finished:
+            return
+
+        if self.profiler is None:
+            self.profiler = profile(activities=activities(),
+                                    schedule=schedule(wait=self.warmup, warmup=1, active=self.steps, repeat=1),
+                                    on_trace_ready=self.trace_ready, record_shapes=True, profile_memory=True)
+            self.profiler.start()
+
+        self.profiler.step()
+
+        if self.finished:
+            self.profiler.stop()
+
+    def trace_ready(self, prof):
+        write_profile(prof, self.output_folder, '{}_train'.format(self.name))
+        self.finished = True
+
+    def close(self):
+        """Stops a training window that was cut short by training ending"""
+        if self.profiler is not None and not self.finished:
+            self.finished = True
+            self.profiler.stop()
+
+    @contextmanager
+    def classify(self):
+        if self.mode != 'classify':
+            yield
+            return
+
+        with profile(activities=activities(), record_shapes=True, profile_memory=True) as prof:
+            yield
+
+        write_profile(prof, self.output_folder, '{}_classify_{}'.format(self.name, self.classify_runs))
+        self.classify_runs += 1
+
+
+def profile_classify(profiler):
+    return profiler.classify() if profiler is not None else nullcontext()
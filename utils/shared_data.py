@@ -0,0 +1,120 @@
+import json
+import mmap
+import os
+import pickle
+import warnings
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+import torch
+
+# blocks attached through SharedMemory, which must outlive the tensors made from their buffers
+_attached = []
+
+
+def dataset_prefix(dataset, imputation=None):
+    """Shared memory name prefix the publisher and the sweep scripts agree on for a dataset"""
+    if imputation is None:
+        return 'semi_supervised_{}'.format(dataset)
+
+    return 'semi_supervised_{}_{}'.format(dataset, imputation)
+
+
+def _block_name(prefix, key):
+    return '{}_{}'.format(prefix, key)
+
+
+class SharedData:
+    """
+    Publishes arrays and picklable objects in POSIX shared memory, one block each under a common prefix, with a
+    manifest block describing them. The blocks are unlinked on close(), or when the publishing process exits.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.blocks = []
+
+    def _create(self, key, nbytes):
+        block = shared_memory.SharedMemory(name=_block_name(self.prefix, key), create=True, size=max(nbytes, 1))
+        self.blocks.append(block)
+
+        return block
+
+    def publish(self, arrays, objects=None):
+        """
+        Args:
+            arrays (dict): Name to tensor or numpy array. Attached as tensors without copying.
+            objects (dict): Name to picklable object, e.g. fold indices. Unpickled on attach.
+        """
+        manifest = {'arrays': {}, 'objects': {}}
+
+        for key, value in arrays.items():
+            array = np.ascontiguousarray(value.numpy() if isinstance(value, torch.Tensor) else value)
+
+            block = self._create(key, array.nbytes)
+            np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+
+            manifest['arrays'][key] = {'shape': list(array.shape), 'dtype': array.dtype.str}
+
+        for key, value in (objects or {}).items():
+            data = pickle.dumps(value)
+
+            block = self._create(key, len(data))
+            block.buf[:len(data)] = data
+
+            manifest['objects'][key] = len(data)
+
+        # written last, so attaching processes never see a manifest for blocks that are not filled in yet
+        data = json.dumps(manifest).encode()
+        block = self._create('manifest', len(data))
+        block.buf[:len(data)] = data
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+        self.blocks = []
+
+
+def _open_read_only(name):
+    """
+    Maps a shared memory block read-only where POSIX shared memory lives under /dev/shm, so that writing to a tensor
+    made from it faults instead of silently changing every other process' data
+    """
+    path = os.path.join('/dev/shm', name)
+
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    block = shared_memory.SharedMemory(name=name)
+    # attaching registers the block with this process' resource tracker, which would unlink it when we exit
+    resource_tracker.unregister(block._name, 'shared_memory')
+    _attached.append(block)
+
+    return block.buf
+
+
+def attach(prefix):
+    """
+    Attaches to data published under prefix.
+
+    Returns:
+        (dict, dict): Name to read-only tensor on the shared memory, and name to unpickled object
+    """
+    manifest = bytes(_open_read_only(_block_name(prefix, 'manifest'))).rstrip(b'\x00')
+    manifest = json.loads(manifest.decode())
+
+    tensors = {}
+    for key, spec in manifest['arrays'].items():
+        array = np.ndarray(spec['shape'], np.dtype(spec['dtype']), buffer=_open_read_only(_block_name(prefix, key)))
+
+        with warnings.catch_warnings():
+            # torch warns that the array is not writable, which is the point
+            warnings.simplefilter('ignore', UserWarning)
+            tensors[key] = torch.from_numpy(array)
+
+    objects = {}
+    for key, size in manifest['objects'].items():
+        objects[key] = pickle.loads(bytes(_open_read_only(_block_name(prefix, key))[:size]))
+
+    return tensors, objects
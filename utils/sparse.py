@@ -0,0 +1,94 @@
+import torch
+from torch.utils.data import Dataset, TensorDataset
+
+# below this fraction of non-zero inputs the sparse first layer beats the dense matmul, forward and backward, for the
+# batch sizes and widths the sweeps use (benchmarks/sparse_benchmark.py measures the crossover on a given machine)
+DENSITY_THRESHOLD = 0.3
+
+
+def density(data):
+    return data.count_nonzero().item() / max(data.numel(), 1)
+
+
+def is_sparse(x):
+    return x.layout == torch.sparse_csr
+
+
+def to_dense(x):
+    return x.to_dense() if is_sparse(x) else x
+
+
+def cat_rows(a, b):
+    """Stacks two batches along the sample dimension, either both dense or both CSR"""
+    if not is_sparse(a):
+        return torch.cat((a, b), 0)
+
+    crow = torch.cat((a.crow_indices(), b.crow_indices()[1:] + a.crow_indices()[-1]))
+
+    return torch.sparse_csr_tensor(crow, torch.cat((a.col_indices(), b.col_indices())),
+                                   torch.cat((a.values(), b.values())), (a.size(0) + b.size(0), a.size(1)))
+
+
+def slice_rows(x, start, end):
+    """Samples start to end of a batch, either dense or CSR"""
+    if not is_sparse(x):
+        return x[start:end]
+
+    crow = x.crow_indices()[start:end + 1]
+    first, last = int(crow[0]), int(crow[-1])
+
+    return torch.sparse_csr_tensor(crow - first, x.col_indices()[first:last], x.values()[first:last],
+                                   (crow.size(0) - 1, x.size(1)))
+
+
+def split_rows(x, n):
+    """The first n samples of a batch and the rest, either both dense or both CSR"""
+    return slice_rows(x, 0, n), slice_rows(x, n, x.size(0))
+
+
+class CSRDataset(Dataset):
+    """
+    Samples and labels with the samples held as one CSR matrix. Indexed by a list of indices, it returns the batch of
+    those samples as a CSR tensor, so it is loaded with a BatchSampler (see utils.distributed.train_loader). Without
+    labels it returns the batch alone, as unlabelled datasets do.
+    """
+    batched = True
+
+    def __init__(self, data, labels=None):
+        csr = data.float().to_sparse_csr()
+
+        self.crow = csr.crow_indices()
+        self.col = csr.col_indices()
+        self.values = csr.values()
+        self.width = data.size(1)
+        self.labels = labels
+
+    def __len__(self):
+        return self.crow.size(0) - 1
+
+    def __getitem__(self, indices):
+        indices = torch.as_tensor(indices)
+
+        starts = self.crow[indices]
+        lengths = self.crow[indices + 1] - starts
+
+        crow = torch.zeros(indices.size(0) + 1, dtype=self.crow.dtype)
+        torch.cumsum(lengths, 0, out=crow[1:])
+
+        # position of each of the batch's non-zeros in the full matrix
+        positions = torch.repeat_interleave(starts - crow[:-1], lengths) + torch.arange(int(crow[-1]))
+
+        batch = torch.sparse_csr_tensor(crow, self.col[positions], self.values[positions], (indices.size(0), self.width))
+
+        if self.labels is None:
+            return batch
+
+        return batch, self.labels[indices]
+
+
+def training_dataset(data, labels, threshold=DENSITY_THRESHOLD):
+    """A CSRDataset if data is sparse enough for the sparse first layers to be faster, a TensorDataset otherwise"""
+    if density(data) < threshold:
+        return CSRDataset(data, labels)
+
+    return TensorDataset(data, labels)
@@ -0,0 +1,100 @@
+import torch
+from torch.utils.data import Dataset
+from utils.sparse import CSRDataset, density
+
+STORAGE_TYPES = ['float32', 'float16', 'uint8']
+# dtype the sweep scripts convert normalized data to, sklearn's normalizers return float64
+NORMALIZED_DTYPE = torch.float32
+
+
+class UnlabelledDataset(Dataset):
+    """
+    Samples without labels, indexed by a list of indices like CSRDataset, so it is loaded with a BatchSampler (see
+    utils.distributed.train_loader). Batches are always float32, whatever the samples are stored as:
+
+    - float32: the rows of data themselves, without a copy when data is already float32
+    - float16: half the memory, with a relative rounding error of at most 2 ** -11
+    - uint8: a quarter of the memory, each feature scaled between its minimum and maximum, with an absolute rounding
+      error of at most half of (maximum - minimum) / 255
+    """
+    batched = True
+
+    def __init__(self, data, storage='float32', rows=None, chunk_size=1000):
+        """
+        Args:
+            data (Tensor): Samples to store.
+            storage (str): One of STORAGE_TYPES.
+            rows (Tensor): Only store these rows of data. Default: all of them
+            chunk_size (int): Rows converted at a time, which bounds the temporaries of compressing data
+        """
+        if storage not in STORAGE_TYPES:
+            raise ValueError('Unknown storage type {}'.format(storage))
+
+        self.storage = storage
+        self.rows = None
+        self.offset = None
+        self.scale = None
+
+        if storage == 'float32' and data.dtype == torch.float32:
+            # kept by reference, and indexed through rows, so selecting some rows doesn't duplicate them
+            self.data = data
+            self.rows = torch.as_tensor(rows) if rows is not None else None
+            return
+
+        rows = torch.as_tensor(rows) if rows is not None else torch.arange(data.size(0))
+
+        if storage == 'uint8':
+            self.offset = torch.stack([data[rows[i:i + chunk_size]].float().amin(dim=0)
+                                       for i in range(0, rows.size(0), chunk_size)]).amin(dim=0)
+            maximum = torch.stack([data[rows[i:i + chunk_size]].float().amax(dim=0)
+                                   for i in range(0, rows.size(0), chunk_size)]).amax(dim=0)
+            # constant features store 0 and decode to their value
+            self.scale = ((maximum - self.offset) / 255).masked_fill_(maximum == self.offset, 1.)
+
+        self.data = torch.empty(rows.size(0), data.size(1), dtype=getattr(torch, storage))
+        for i in range(0, rows.size(0), chunk_size):
+            self.data[i:i + chunk_size] = self.encode(data[rows[i:i + chunk_size]].float())
+
+    def encode(self, x):
+        if self.storage == 'uint8':
+            return ((x - self.offset) / self.scale).round_().clamp_(0, 255)
+
+        return x
+
+    def decode(self, x):
+        if self.storage == 'uint8':
+            return torch.addcmul(self.offset, x.float(), self.scale)
+
+        return x.float()
+
+    @property
+    def nbytes(self):
+        """Memory of the samples the dataset holds or refers to"""
+        nbytes = self.data.numel() * self.data.element_size()
+
+        if self.rows is not None:
+            nbytes += self.rows.numel() * self.rows.element_size()
+
+        return nbytes
+
+    def __len__(self):
+        return self.rows.size(0) if self.rows is not None else self.data.size(0)
+
+    def __getitem__(self, indices):
+        indices = torch.as_tensor(indices)
+
+        if self.rows is not None:
+            indices = self.rows[indices]
+
+        return self.decode(self.data[indices])
+
+
+def unlabelled_dataset(data, storage='float32', threshold=None, rows=None):
+    """
+    An unlabelled dataset of data, or of the given rows of it: a CSRDataset if a density threshold is given and data is
+    sparser than it, an UnlabelledDataset with the given storage otherwise
+    """
+    if threshold is not None and density(data) < threshold:
+        return CSRDataset(data[rows] if rows is not None else data)
+
+    return UnlabelledDataset(data, storage, rows)
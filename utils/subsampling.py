@@ -0,0 +1,65 @@
+import torch
+from collections import namedtuple
+
+# Output features a training step reconstructs, and the weight of each one's loss. The weighted sum of the sampled
+# features' losses is an unbiased estimate of the sum over all features.
+FeatureSample = namedtuple('FeatureSample', ['indices', 'weights'])
+
+
+class FeatureSampler:
+    """
+    Draws the output features whose reconstruction loss a training step computes, so the decoder only evaluates the
+    matching rows of its output layer.
+    """
+    def __init__(self, num_features, num_samples, probabilities=None):
+        """
+        Args:
+            num_features (int): Number of output features.
+            num_samples (int): Features drawn per step.
+            probabilities (Tensor): Probability of drawing each feature. Default: uniform, drawn without replacement
+        """
+        self.num_features = num_features
+        self.num_samples = min(num_samples, num_features)
+        self.probabilities = probabilities
+
+    def sample(self, device):
+        if self.probabilities is None:
+            indices = torch.randperm(self.num_features, device=device)[:self.num_samples]
+            weights = torch.full((self.num_samples,), self.num_features / self.num_samples, device=device)
+
+            return FeatureSample(indices, weights)
+
+        # drawing with replacement keeps 1 / (num_samples * p) exact as the inverse inclusion weight
+        probabilities = self.probabilities.to(device)
+        indices = torch.multinomial(probabilities, self.num_samples, replacement=True)
+
+        return FeatureSample(indices, 1 / (self.num_samples * probabilities[indices]))
+
+    @classmethod
+    def variance_weighted(cls, data, num_samples, uniform_fraction=0.5):
+        """
+        A sampler drawing features in proportion to their standard deviation in data, mixed with uniform draws so
+        that no feature has probability 0 and the estimate stays unbiased.
+        """
+        std = data.float().std(dim=0)
+        uniform = torch.full_like(std, 1 / std.numel())
+
+        if std.sum() == 0:
+            return cls(std.numel(), num_samples, uniform)
+
+        return cls(std.numel(), num_samples, uniform_fraction * uniform + (1 - uniform_fraction) * std / std.sum())
+
+
+def feature_sampler(sampling, data, num_samples):
+    """A FeatureSampler over the columns of data, 'uniform' or 'variance' weighted, or None if num_samples is None"""
+    if num_samples is None:
+        return None
+    if sampling == 'variance':
+        return FeatureSampler.variance_weighted(data, num_samples)
+
+    return FeatureSampler(data.size(1), num_samples)
+
+
+def sample_indices(sample):
+    """The features of a FeatureSample, or None for all of them"""
+    return sample.indices if sample is not None else None
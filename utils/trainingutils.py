@@ -1,20 +1,64 @@
+import time
+import weakref
 import torch
+from torch import nn
+from torch.utils.data import TensorDataset
+from utils.distributed import is_main_process, barrier
+from utils.sparse import slice_rows
 
+EVALUATION_CHUNK_SIZE = 1024
 
-def accuracy(model, dataloader, device):
-    model.eval()
+# TensorDataset -> {device: (data, labels)} so evaluation sets are only copied to the device once
+_staged_datasets = weakref.WeakKeyDictionary()
+
+
+def stage(dataset, device):
+    staged = _staged_datasets.setdefault(dataset, {})
+    key = str(device)
+
+    if key not in staged:
+        data, labels = dataset.tensors[:2]
+        staged[key] = (data.float().to(device), labels.to(device))
+
+    return staged[key]
+
+
+def evaluation_batches(dataloader, device, chunk_size=EVALUATION_CHUNK_SIZE):
+    """Yields (data, labels) chunks on the device, reading TensorDatasets from staged tensors instead of the loader"""
+    dataset = dataloader.dataset
+
+    if isinstance(dataset, TensorDataset):
+        data, labels = stage(dataset, device)
+
+        for i in range(0, data.size(0), chunk_size):
+            yield data[i:i + chunk_size], labels[i:i + chunk_size]
+    else:
+        for data, labels in dataloader:
+            yield data.float().to(device), labels.to(device)
+
+
+def predict(forward, data, device, chunk_size=EVALUATION_CHUNK_SIZE):
+    """Runs forward over dense or CSR data in fixed-size chunks in inference mode and concatenates the outputs"""
+    with torch.inference_mode():
+        outputs = [forward(slice_rows(data, i, i + chunk_size).float().to(device))
+                   for i in range(0, data.size(0), chunk_size)]
+
+    return torch.cat(outputs)
+
+
+def accuracy(model, dataloader, device, chunk_size=EVALUATION_CHUNK_SIZE):
+    if isinstance(model, nn.Module):
+        model.eval()
 
     correct = 0
 
-    with torch.no_grad():
-        for batch_idx, (data, labels) in enumerate(dataloader):
-            outputs = model(data.float().to(device))
-            labels = labels.to(device)
- 
-            _, predicted = torch.max(outputs.data, 1)
-            correct += (predicted == labels).sum().item()
+    with torch.inference_mode():
+        for data, labels in evaluation_batches(dataloader, device, chunk_size):
+            outputs = model(data)
 
-    return correct / len(dataloader.dataset)
+            correct += (outputs.argmax(dim=1) == labels).sum()
+
+    return int(correct) / len(dataloader.dataset)
 
 
 def unsupervised_validation_loss(model, dataloader, criterion, device):
@@ -75,8 +119,89 @@ class EarlyStopping:
         if self.verbose:
             print('Validation loss decreased ({:.6f} --> {:.6f}).  Saving model ...'
                   .format(self.val_loss_min, val_loss))
-        torch.save(model.state_dict(), self.filename)
+        # in data-parallel training the processes hold the same parameters, so only rank 0 writes them
+        if is_main_process():
+            torch.save(model.state_dict(), self.filename)
         self.val_loss_min = val_loss
 
     def load_checkpoint(self, model):
+        barrier()
         model.load_state_dict(torch.load(self.filename))
+
+
+class EvaluationSchedule:
+    """Decides which epochs run validation"""
+    def __init__(self, every=1, plateau=None):
+        """
+        Args:
+            every (int): Validate every this many epochs. Early stopping patience counts validations, so it is
+                         stretched by the same factor.
+            plateau (float): If set, skip validation until the relative improvement in training loss between
+                             epochs drops below this value.
+        """
+        self.every = every
+        self.plateau = plateau
+        self.reset()
+
+    def reset(self):
+        self.previous_loss = None
+        self.plateaued = self.plateau is None
+
+    def __call__(self, epoch, train_loss):
+        if not self.plateaued and self.previous_loss is not None:
+            self.plateaued = abs(self.previous_loss - train_loss) <= self.plateau * abs(self.previous_loss)
+        self.previous_loss = train_loss
+
+        # always validate the first epoch so early stopping has a checkpoint to fall back on
+        if epoch == 0:
+            return True
+
+        return self.plateaued and epoch % self.every == 0
+
+
+class TimeBudget:
+    """Splits a wall-clock budget across the configurations of one or more hyperparameter sweeps."""
+    def __init__(self, seconds, num_sweeps=1, reserve=0.05, start_time=None):
+        """
+        Args:
+            seconds (float): Total wall-clock budget for the job.
+            num_sweeps (int): Number of hyperparameter sweeps the budget is shared between.
+            reserve (float): Fraction of the budget held back for final evaluation and saving results.
+            start_time (float): When the budget started counting. Default: now
+        """
+        start_time = time.time() if start_time is None else start_time
+        self.deadline = start_time + seconds * (1 - reserve)
+        self.sweeps_remaining = num_sweeps
+        self.sweep_deadline = self.deadline
+        self.configurations_remaining = 0
+        self.seconds_per_epoch = None
+
+    def start_sweep(self, num_configurations):
+        now = time.time()
+        self.sweep_deadline = now + max(0., self.deadline - now) / max(self.sweeps_remaining, 1)
+        self.sweeps_remaining -= 1
+        self.configurations_remaining = num_configurations
+        # the models of different sweeps take very different times per epoch, so each sweep measures its own
+        self.seconds_per_epoch = None
+
+    def start_configuration(self, max_epochs, num_stages=1):
+        """
+        Returns the epoch cap and training deadline for the next configuration of the current sweep. A model that trains
+        in num_stages stages, each up to the cap, gets its share of epochs split between them.
+        """
+        now = time.time()
+        share = max(0., self.sweep_deadline - now) / max(self.configurations_remaining, 1)
+        self.configurations_remaining -= 1
+
+        if self.seconds_per_epoch is None:
+            # nothing measured yet, the deadline alone stops training
+            epoch_cap = max_epochs
+        else:
+            epoch_cap = max(1, min(max_epochs, int(share // (self.seconds_per_epoch * num_stages))))
+
+        return epoch_cap, now + share
+
+    def record(self, num_epochs, seconds):
+        """num_epochs counts the epochs of every stage of the configuration, trained in seconds"""
+        if num_epochs > 0:
+            self.seconds_per_epoch = seconds / num_epochs
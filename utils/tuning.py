@@ -0,0 +1,53 @@
+import json
+import os
+import torch
+
+# written by scripts/tune.py and read by the training entry points, from the repository root
+TUNING_FILE = './tuning.json'
+# batch size of the training loaders of any model and input shape without tuned settings
+BATCH_SIZE = 100
+
+
+def settings_key(model_name, input_size, num_classes):
+    return '{}/{}x{}'.format(model_name, input_size, num_classes)
+
+
+def load_settings(model_name, input_size, num_classes, filename=TUNING_FILE):
+    """The tuned {'batch_size', 'threads', ...} of a model and input shape, or None if they have not been tuned"""
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename) as f:
+        return json.load(f).get(settings_key(model_name, input_size, num_classes))
+
+
+def save_settings(model_name, input_size, num_classes, settings, filename=TUNING_FILE):
+    """Adds or replaces the settings of a model and input shape, keeping those of the others"""
+    tuned = {}
+    if os.path.exists(filename):
+        with open(filename) as f:
+            tuned = json.load(f)
+
+    tuned[settings_key(model_name, input_size, num_classes)] = settings
+
+    with open(filename, 'w') as f:
+        json.dump(tuned, f, indent=2, sort_keys=True)
+
+
+def tuned_batch_size(model_name, input_size, num_classes, threads=True, filename=TUNING_FILE):
+    """
+    The tuned batch size of a model and input shape, BATCH_SIZE if there is none. Unless threads is False, this also
+    sets the number of intra-op threads to the tuned one.
+    """
+    settings = load_settings(model_name, input_size, num_classes, filename)
+
+    if settings is None:
+        return BATCH_SIZE
+
+    if threads and settings.get('threads') is not None:
+        torch.set_num_threads(settings['threads'])
+
+    print('Tuned settings for {}: batch size {}, {} threads'.format(
+        settings_key(model_name, input_size, num_classes), settings['batch_size'], torch.get_num_threads()))
+
+    return settings['batch_size']